@@ -133,7 +133,15 @@ class DatabaseManager:
         cursor.execute('SELECT * FROM documents WHERE id = ?', (document_id,))
         row = cursor.fetchone()
         return dict(row) if row else None
-    
+
+    def get_document_content(self, document_id: int) -> Optional[str]:
+        """Solo il testo del documento (usato dal RAG per risolvere gli offset dei chunk)"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('SELECT content FROM documents WHERE id = ?', (document_id,))
+        row = cursor.fetchone()
+        return row['content'] if row else None
+
     def delete_document(self, document_id: int, delete_physical_file: bool = False):
         """
         Elimina un documento dal database
@@ -0,0 +1,134 @@
+"""
+Benchmark del chunker lineare contro la vecchia implementazione ricorsiva.
+
+Uso (dalla root del progetto):
+    python -m scripts.benchmark_chunker                  # testo sintetico da 10 MB
+    python -m scripts.benchmark_chunker --size-mb 2 --chunk-size 800 --overlap 100
+    python -m scripts.benchmark_chunker --file appunti.txt
+"""
+import argparse
+import random
+import time
+import tracemalloc
+from typing import List
+
+from services import chunker
+
+
+def legacy_chunk_text_recursive(text: str, final_chunk_size: int, final_overlap: int) -> List[str]:
+    """Copia della vecchia RAGService.chunk_text_recursive, solo per confronto."""
+    separators = ["\n\n", "\n", ". ", " ", ""]
+    final_chunks = []
+
+    def _recursive_split(text: str, current_separators: List[str]):
+        if len(text) <= final_chunk_size:
+            if text.strip():
+                final_chunks.append(text.strip())
+            return
+
+        if not current_separators:
+            for i in range(0, len(text), final_chunk_size - final_overlap):
+                chunk = text[i: i + final_chunk_size]
+                if chunk.strip():
+                    final_chunks.append(chunk.strip())
+            return
+
+        separator = current_separators[0]
+        remaining_separators = current_separators[1:]
+
+        if separator == "":
+            splits = list(text)
+        else:
+            splits = text.split(separator)
+
+        current_chunk = ""
+        for i, part in enumerate(splits):
+            if i < len(splits) - 1:
+                part_with_separator = part + separator
+            else:
+                part_with_separator = part
+
+            if len(current_chunk) + len(part_with_separator) > final_chunk_size:
+                if current_chunk:
+                    _recursive_split(current_chunk.strip(), remaining_separators)
+                overlap_text = current_chunk[-final_overlap:]
+                if len(part_with_separator) > final_chunk_size:
+                    _recursive_split(part_with_separator.strip(), remaining_separators)
+                    current_chunk = ""
+                else:
+                    current_chunk = overlap_text + part_with_separator
+            else:
+                current_chunk += part_with_separator
+
+        if current_chunk.strip():
+            if len(current_chunk) > final_chunk_size:
+                _recursive_split(current_chunk.strip(), remaining_separators)
+            else:
+                final_chunks.append(current_chunk.strip())
+
+    _recursive_split(text, separators)
+    unique_chunks = list(dict.fromkeys(final_chunks))
+    return [chunk for chunk in unique_chunks if chunk]
+
+
+def synthetic_text(size_bytes: int, seed: int = 0) -> str:
+    """Testo simile a un PDF estratto: paragrafi, righe spezzate e qualche blocco senza spazi."""
+    rng = random.Random(seed)
+    words = ("rete neurale gradiente funzione errore apprendimento modello dati "
+             "matrice vettore derivata ottimizzazione strato peso bias").split()
+    parts: List[str] = []
+    total = 0
+    while total < size_bytes:
+        if rng.random() < 0.02:
+            block = "x" * rng.randint(500, 3000)  # tabelle/URL lunghi senza separatori
+        else:
+            sentences = []
+            for _ in range(rng.randint(2, 12)):
+                sentence = " ".join(rng.choice(words) for _ in range(rng.randint(5, 25)))
+                sentences.append(sentence.capitalize() + ".")
+            block = "\n".join(" ".join(sentences[i:i + 3]) for i in range(0, len(sentences), 3))
+        parts.append(block)
+        total += len(block) + 2
+    return "\n\n".join(parts)
+
+
+def _measure(label: str, fn):
+    tracemalloc.start()
+    started = time.perf_counter()
+    chunks = fn()
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    sizes = [len(c) for c in chunks]
+    print(f"{label:<12} {elapsed:>8.2f}s  picco {peak / 1024 / 1024:>7.1f} MB  "
+          f"{len(chunks):>7} chunk  (media {sum(sizes) / max(1, len(sizes)):.0f}, max {max(sizes, default=0)})")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Confronto chunker lineare vs ricorsivo")
+    parser.add_argument("--size-mb", type=float, default=10.0)
+    parser.add_argument("--file", help="Usa il contenuto di un file invece del testo sintetico")
+    parser.add_argument("--chunk-size", type=int, default=800)
+    parser.add_argument("--overlap", type=int, default=100)
+    parser.add_argument("--skip-legacy", action="store_true", help="Misura solo il nuovo chunker")
+    args = parser.parse_args()
+
+    if args.file:
+        with open(args.file, "r", encoding="utf-8", errors="ignore") as f:
+            text = f.read()
+    else:
+        text = synthetic_text(int(args.size_mb * 1024 * 1024))
+    print(f"Input: {len(text) / 1024 / 1024:.1f} MB, chunk_size={args.chunk_size}, overlap={args.overlap}")
+
+    new_time = _measure("lineare", lambda: [c for c, _, _ in chunker.chunk_text(text, args.chunk_size, args.overlap)])
+    # Alimentazione a pagine da 4 KB, come durante l'estrazione di un PDF
+    pages = [text[i:i + 4096] for i in range(0, len(text), 4096)]
+    _measure("a pagine", lambda: [c for c, _, _ in chunker.iter_chunks(pages, args.chunk_size, args.overlap)])
+    if not args.skip_legacy:
+        legacy_time = _measure("ricorsivo", lambda: legacy_chunk_text_recursive(text, args.chunk_size, args.overlap))
+        print(f"Speedup: {legacy_time / new_time:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
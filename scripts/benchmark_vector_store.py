@@ -0,0 +1,70 @@
+"""
+Benchmark del vector store piatto (NumPy mmap) contro il Qdrant embedded.
+
+Uso (dalla root del progetto):
+    python -m scripts.benchmark_vector_store
+    python -m scripts.benchmark_vector_store --sizes 1000 5000 20000 --dim 768 --queries 200
+"""
+import argparse
+import gc
+import tempfile
+import time
+import uuid
+
+import numpy as np
+from qdrant_client import QdrantClient
+from qdrant_client.models import Distance, VectorParams
+
+from services.flat_vector_store import FlatVectorStore
+
+
+def _bench(label: str, open_store, vectors: np.ndarray, queries: np.ndarray, k: int):
+    ids = [str(uuid.UUID(int=i)) for i in range(len(vectors))]
+    payloads = [{"document_id": i % 50, "chunk_index": i} for i in range(len(vectors))]
+
+    store = open_store()
+    started = time.perf_counter()
+    store.create_collection("bench", vectors_config=VectorParams(size=vectors.shape[1], distance=Distance.COSINE))
+    store.upload_collection("bench", vectors=vectors, payload=payloads, ids=ids, batch_size=256, wait=True)
+    upload_time = time.perf_counter() - started
+    store.close()
+    del store
+    gc.collect()
+
+    # Riapertura a freddo + prima ricerca: è il costo di "aprire una materia"
+    started = time.perf_counter()
+    store = open_store()
+    store.search("bench", queries[0], limit=k)
+    open_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for q in queries:
+        store.search("bench", q, limit=k)
+    search_ms = (time.perf_counter() - started) / len(queries) * 1000
+    store.close()
+
+    print(f"{label:<8} n={len(vectors):>6}  upload {upload_time:>6.2f}s  "
+          f"apertura {open_time * 1000:>7.1f} ms  ricerca {search_ms:>6.2f} ms/query")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Confronto FlatVectorStore vs Qdrant embedded")
+    parser.add_argument("--sizes", nargs="+", type=int, default=[1000, 5000, 20000])
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--k", type=int, default=15)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    for size in args.sizes:
+        vectors = rng.normal(size=(size, args.dim)).astype(np.float32)
+        queries = rng.normal(size=(args.queries, args.dim)).astype(np.float32)
+        flat_dir = tempfile.mkdtemp(prefix="flat_")
+        qdrant_dir = tempfile.mkdtemp(prefix="qdrant_")
+        _bench("flat", lambda: FlatVectorStore(flat_dir), vectors, queries, args.k)
+        _bench("qdrant", lambda: QdrantClient(path=qdrant_dir), vectors, queries, args.k)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+"""
+Report recall/spazio sulle collection Qdrant di Synapse.
+
+Uso (dalla root del progetto):
+    python -m scripts.embedding_report                      # tutte le collection
+    python -m scripts.embedding_report subject_1_analisi    # una collection
+    python -m scripts.embedding_report --dims 256 768 --k 10
+"""
+import argparse
+
+from config.env_loader import load_env
+from services.rag_service import RAGService
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recall@k per vettori troncati e quantizzati")
+    parser.add_argument("collections", nargs="*", help="Nomi delle collection (default: tutte)")
+    parser.add_argument("--dims", nargs="+", type=int, default=[256, 512, 768, 1536])
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+
+    load_env()
+    rag = RAGService()
+    names = args.collections or [c.name for c in rag.client.get_collections().collections]
+    for name in names:
+        try:
+            rag.embedding_storage_report(name, dims=args.dims, k=args.k, n_queries=args.queries)
+        except Exception as e:
+            print(f"[RAG] Report non disponibile per {name}: {e}")
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,32 @@
+"""
+Passa dal layout "una collection per materia" alla collection condivisa.
+
+Uso (dalla root del progetto, con Synapse chiuso):
+    python -m scripts.migrate_collection_layout              # copia, lascia le vecchie collection
+    python -m scripts.migrate_collection_layout --delete-old # copia ed elimina le vecchie
+
+Dopo la migrazione impostare RAG_COLLECTION_LAYOUT=shared nel .env.
+"""
+import argparse
+
+from config.env_loader import load_env
+from services.rag_service import RAGService
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrazione al layout a collection condivisa")
+    parser.add_argument("--delete-old", action="store_true",
+                        help="Elimina le collection per materia dopo la copia")
+    parser.add_argument("--batch-size", type=int, default=256)
+    args = parser.parse_args()
+
+    load_env()
+    rag = RAGService()
+    copied = rag.migrate_to_shared_layout(delete_old=args.delete_old, batch_size=args.batch_size)
+    print(f"[RAG] Migrazione completata: {copied} punti copiati")
+    if rag.collection_layout != "shared":
+        print("[RAG] Ricorda di impostare RAG_COLLECTION_LAYOUT=shared nel .env")
+
+
+if __name__ == "__main__":
+    main()
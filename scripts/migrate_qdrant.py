@@ -0,0 +1,105 @@
+"""
+Copia le collection dal Qdrant embedded (./qdrant_db) a un server Qdrant.
+
+Uso (dalla root del progetto, con Synapse chiuso: il database locale è bloccato
+dal processo che lo usa):
+    python -m scripts.migrate_qdrant --url http://127.0.0.1:6333
+    python -m scripts.migrate_qdrant subject_1_analisi --overwrite
+    python -m scripts.migrate_qdrant --source ./qdrant_db --batch-size 512
+
+Senza --url viene usato QDRANT_URL dal .env. I vettori vengono copiati così
+come sono (nessun nuovo embedding), insieme a payload e quantizzazione.
+"""
+import argparse
+import sys
+
+from qdrant_client import QdrantClient
+from qdrant_client.models import PayloadSchemaType, PointStruct
+
+from config.env_loader import load_env
+from services.vector_store import create_qdrant_client, qdrant_server_url
+
+
+def migrate_collection(source, target, name: str, batch_size: int, overwrite: bool) -> int:
+    info = source.get_collection(name)
+    existing = {c.name for c in target.get_collections().collections}
+    if name in existing:
+        if not overwrite:
+            print(f"[MIGRATE] {name}: già presente sul server, salto (usa --overwrite)")
+            return 0
+        target.delete_collection(name)
+
+    target.create_collection(
+        collection_name=name,
+        vectors_config=info.config.params.vectors,
+        quantization_config=info.config.quantization_config,
+    )
+    # Stessi indici di RAGService: filtri per documento e, col layout condiviso, per materia
+    for field_name in ("document_id", "subject_id"):
+        target.create_payload_index(
+            collection_name=name,
+            field_name=field_name,
+            field_schema=PayloadSchemaType.INTEGER,
+        )
+
+    copied = 0
+    next_offset = None
+    while True:
+        points, next_offset = source.scroll(
+            collection_name=name,
+            limit=batch_size,
+            offset=next_offset,
+            with_payload=True,
+            with_vectors=True,
+        )
+        if points:
+            target.upsert(
+                collection_name=name,
+                points=[PointStruct(id=p.id, vector=p.vector, payload=p.payload) for p in points],
+                wait=True,
+            )
+            copied += len(points)
+            print(f"[MIGRATE] {name}: {copied}/{info.points_count} punti")
+        if not points or not next_offset:
+            break
+
+    remote_count = target.count(name, exact=True).count
+    if remote_count != copied:
+        print(f"[MIGRATE] ATTENZIONE {name}: copiati {copied} punti, sul server {remote_count}")
+    return copied
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrazione Qdrant embedded -> server")
+    parser.add_argument("collections", nargs="*", help="Nomi delle collection (default: tutte)")
+    parser.add_argument("--source", default="./qdrant_db", help="Cartella del Qdrant embedded")
+    parser.add_argument("--url", help="URL del server (default: QDRANT_URL)")
+    parser.add_argument("--api-key", help="API key del server (default: QDRANT_API_KEY)")
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--overwrite", action="store_true", help="Ricrea le collection già presenti")
+    args = parser.parse_args()
+
+    load_env()
+    url = args.url or qdrant_server_url()
+    if not url:
+        print("[MIGRATE] Nessun server: passa --url o imposta QDRANT_URL")
+        sys.exit(1)
+
+    # La sorgente è sempre l'embedded, anche se QDRANT_URL è impostato
+    source = QdrantClient(path=args.source)
+    target = create_qdrant_client(url=url, api_key=args.api_key)
+
+    names = args.collections or [c.name for c in source.get_collections().collections]
+    total = 0
+    for name in names:
+        try:
+            total += migrate_collection(source, target, name, args.batch_size, args.overwrite)
+        except Exception as e:
+            print(f"[MIGRATE] Errore su {name}: {e}")
+    print(f"[MIGRATE] Completato: {total} punti in {len(names)} collection")
+    source.close()
+    target.close()
+
+
+if __name__ == "__main__":
+    main()
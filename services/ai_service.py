@@ -3,11 +3,13 @@ from typing import Dict, List
 
 from google import genai
 
+from services.key_scheduler import get_key_scheduler
+
 
 class AIService:
     def __init__(self, api_keys: List[str] | str, model_name: str = 'gemini-2.5-flash'):
         """
-        Initialize AIService with one or multiple API keys for round-robin usage.
+        Initialize AIService with one or multiple API keys, scheduled by key health.
         
         Args:
             api_keys: A single API key string or a list of API key strings.
@@ -22,28 +24,27 @@ class AIService:
             raise ValueError("At least one valid API key must be provided")
 
         # Create a pool of clients, one for each key
-        self.clients = [genai.Client(api_key=k) for k in self.api_keys]
-        self.current_client_index = 0
+        self.clients = {k: genai.Client(api_key=k) for k in self.api_keys}
         self.model_name = model_name
+
+        # Process-wide scheduler shared with the embedding service: picks the
+        # healthiest key and skips keys cooling down after a 429
+        self.scheduler = get_key_scheduler()
+        self.scheduler.register(self.api_keys)
         
         print(f"[AIService] Initialized with {len(self.clients)} API keys")
     
-    def _get_next_client(self):
-        """Returns the next client in the rotation"""
-        client = self.clients[self.current_client_index]
-        # Rotate index for next call
-        self.current_client_index = (self.current_client_index + 1) % len(self.clients)
-        return client
-    
-    def _call_api(self, prompt: str) -> str:
-        try:
-            # Get client from rotation
-            client = self._get_next_client()
-            
-            response = client.models.generate_content(
+    def _generate(self, prompt: str):
+        """Calls generate_content on the healthiest key, recording latency and errors"""
+        with self.scheduler.lease(self.api_keys) as key:
+            return self.clients[key].models.generate_content(
                 model=self.model_name,
                 contents=prompt
             )
+    
+    def _call_api(self, prompt: str) -> str:
+        try:
+            response = self._generate(prompt)
             
             if not hasattr(response, 'text') or not response.text:
                 print("Warning: Empty response or no text from Gemini")
@@ -91,13 +92,7 @@ class AIService:
                     [{{"front": "Atomic, precise question", "back": "Concise answer", "difficulty": "easy|medium|hard", "tags": ["tag1", "tag2"]}}]"""
 
         try:
-            # Get client from rotation
-            client = self._get_next_client()
-            
-            response = client.models.generate_content(
-                model=self.model_name,
-                contents=prompt
-            )
+            response = self._generate(prompt)
             content_text = response.text.strip()
             
             if content_text.startswith('```json'):
@@ -0,0 +1,206 @@
+"""Indice lessicale BM25 per collection, persistente e incrementale.
+
+Affianca la ricerca densa di Qdrant: termini esatti del corso, sigle e
+formule spesso non superano la soglia di similarità coseno ma compaiono
+letteralmente nei chunk. Le posting list sono salvate in SQLite accanto
+alla cache degli embedding e aggiornate documento per documento quando
+`index_document`/`remove_document` modificano la collection.
+"""
+from __future__ import annotations
+
+import math
+import re
+import sqlite3
+import threading
+from collections import Counter
+from pathlib import Path
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+# Parole, numeri e termini composti come "x^2", "3.14", "k-means", "tcp_ip"
+_TOKEN_RE = re.compile(r"\w+(?:[-_.^+]\w+)*")
+
+_STOPWORDS = frozenset("""
+il lo la i gli le un uno una di a da in con su per tra fra e o ed ma se che non
+del dello della dei degli delle al allo alla ai agli alle dal dallo dalla dai
+dagli dalle nel nello nella nei negli nelle sul sullo sulla sui sugli sulle
+è sono come anche più questo questa questi queste quello quella ci si ne
+the a an of to in on for with and or but if is are was were be been by as at
+from that this these those it its into about what which how why
+""".split())
+
+
+def tokenize(text: str) -> List[str]:
+    return [t for t in _TOKEN_RE.findall((text or "").casefold()) if t not in _STOPWORDS]
+
+
+class BM25Index:
+    def __init__(self, db_path: str, k1: float = 1.2, b: float = 0.75):
+        self.db_path = db_path
+        self.k1 = k1
+        self.b = b
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS chunks (
+                collection TEXT NOT NULL,
+                point_id TEXT NOT NULL,
+                document_id INTEGER NOT NULL,
+                length INTEGER NOT NULL,
+                PRIMARY KEY (collection, point_id)
+            )
+        ''')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS postings (
+                collection TEXT NOT NULL,
+                term TEXT NOT NULL,
+                point_id TEXT NOT NULL,
+                tf INTEGER NOT NULL,
+                PRIMARY KEY (collection, term, point_id)
+            ) WITHOUT ROWID
+        ''')
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_chunks_document ON chunks (collection, document_id)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_postings_point ON postings (collection, point_id)"
+        )
+        self._conn.commit()
+
+        # (numero di chunk, lunghezza totale) per collection, invalidato a ogni scrittura
+        self._stats: Dict[str, Tuple[int, int]] = {}
+
+    def _delete_points(self, collection: str, point_ids: Sequence[str]) -> None:
+        for i in range(0, len(point_ids), 500):
+            part = list(point_ids[i:i + 500])
+            placeholders = ",".join("?" * len(part))
+            self._conn.execute(
+                f"DELETE FROM postings WHERE collection = ? AND point_id IN ({placeholders})",
+                (collection, *part),
+            )
+            self._conn.execute(
+                f"DELETE FROM chunks WHERE collection = ? AND point_id IN ({placeholders})",
+                (collection, *part),
+            )
+
+    def _document_points(self, collection: str, document_id: int) -> List[str]:
+        return [row[0] for row in self._conn.execute(
+            "SELECT point_id FROM chunks WHERE collection = ? AND document_id = ?",
+            (collection, document_id),
+        )]
+
+    def replace_document(self, collection: str, document_id: int,
+                         point_ids: Sequence[str], texts: Sequence[str]) -> None:
+        """Sostituisce le posting del documento con quelle dei chunk attuali."""
+        chunk_rows = []
+        posting_rows = []
+        for point_id, text in zip(point_ids, texts):
+            counts = Counter(tokenize(text))
+            chunk_rows.append((collection, str(point_id), document_id, sum(counts.values())))
+            posting_rows.extend((collection, term, str(point_id), tf) for term, tf in counts.items())
+
+        with self._lock:
+            self._delete_points(collection, self._document_points(collection, document_id))
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO chunks (collection, point_id, document_id, length) VALUES (?, ?, ?, ?)",
+                chunk_rows,
+            )
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO postings (collection, term, point_id, tf) VALUES (?, ?, ?, ?)",
+                posting_rows,
+            )
+            self._conn.commit()
+            self._stats.pop(collection, None)
+
+    def remove_document(self, collection: str, document_id: int) -> None:
+        with self._lock:
+            self._delete_points(collection, self._document_points(collection, document_id))
+            self._conn.commit()
+            self._stats.pop(collection, None)
+
+    def drop_collection(self, collection: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM postings WHERE collection = ?", (collection,))
+            self._conn.execute("DELETE FROM chunks WHERE collection = ?", (collection,))
+            self._conn.commit()
+            self._stats.pop(collection, None)
+
+    def collections(self) -> List[str]:
+        with self._lock:
+            return [row[0] for row in self._conn.execute("SELECT DISTINCT collection FROM chunks")]
+
+    def has_document(self, collection: str, document_id: int) -> bool:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT 1 FROM chunks WHERE collection = ? AND document_id = ? LIMIT 1",
+                (collection, document_id),
+            ).fetchone() is not None
+
+    def _collection_stats(self, collection: str) -> Tuple[int, int]:
+        stats = self._stats.get(collection)
+        if stats is None:
+            n, total = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(length), 0) FROM chunks WHERE collection = ?",
+                (collection,),
+            ).fetchone()
+            stats = (int(n), int(total))
+            self._stats[collection] = stats
+        return stats
+
+    def size(self, collection: str) -> int:
+        with self._lock:
+            return self._collection_stats(collection)[0]
+
+    def search(self, collection: str, query: str, limit: int = 10) -> List[Tuple[str, float]]:
+        """[(point_id, punteggio BM25)] in ordine decrescente, solo chunk con almeno un termine."""
+        terms = set(tokenize(query))
+        if not terms:
+            return []
+
+        scores: Dict[str, float] = {}
+        with self._lock:
+            n, total_length = self._collection_stats(collection)
+            if n == 0:
+                return []
+            avg_length = total_length / n or 1.0
+            for term in terms:
+                rows = self._conn.execute(
+                    "SELECT p.point_id, p.tf, c.length FROM postings p "
+                    "JOIN chunks c ON c.collection = p.collection AND c.point_id = p.point_id "
+                    "WHERE p.collection = ? AND p.term = ?",
+                    (collection, term),
+                ).fetchall()
+                if not rows:
+                    continue
+                df = len(rows)
+                idf = math.log(1.0 + (n - df + 0.5) / (df + 0.5))
+                for point_id, tf, length in rows:
+                    norm = tf + self.k1 * (1.0 - self.b + self.b * length / avg_length)
+                    scores[point_id] = scores.get(point_id, 0.0) + idf * tf * (self.k1 + 1.0) / norm
+
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        return ranked[:limit]
+
+    def rebuild_collection(self, collection: str,
+                           chunks: Iterable[Tuple[str, int, str]]) -> int:
+        """Ricostruisce la collection da (point_id, document_id, testo); ritorna i chunk indicizzati."""
+        by_document: Dict[int, Tuple[List[str], List[str]]] = {}
+        for point_id, document_id, text in chunks:
+            ids, texts = by_document.setdefault(document_id, ([], []))
+            ids.append(point_id)
+            texts.append(text)
+
+        self.drop_collection(collection)
+        for document_id, (ids, texts) in by_document.items():
+            self.replace_document(collection, document_id, ids, texts)
+        return sum(len(ids) for ids, _ in by_document.values())
+
+    def close(self) -> None:
+        with self._lock:
+            try:
+                self._conn.close()
+            except Exception:
+                pass
@@ -0,0 +1,101 @@
+"""Chunker lineare a singolo passaggio per il RAG.
+
+Sostituisce la versione ricorsiva: scorre il testo una sola volta con una
+finestra di `chunk_size` caratteri, taglia sul separatore più "forte"
+disponibile nella finestra (paragrafo, riga, frase, parola) e riparte
+`chunk_overlap` caratteri (al più metà del chunk) prima della fine,
+allineandosi all'inizio di una parola. Produce tuple (testo, inizio, fine) con offset nel testo originale
+e può essere alimentato pagina per pagina.
+"""
+from __future__ import annotations
+
+from typing import Iterable, Iterator, List, Sequence, Tuple, Union
+
+DEFAULT_SEPARATORS = ("\n\n", "\n", ". ", " ")
+
+Chunk = Tuple[str, int, int]
+
+
+def iter_chunks(source: Union[str, Iterable[str]], chunk_size: int = 800,
+                chunk_overlap: int = 100,
+                separators: Sequence[str] = DEFAULT_SEPARATORS) -> Iterator[Chunk]:
+    """Genera (testo, char_start, char_end) in O(n).
+
+    `source` può essere una stringa o un iterabile di pagine, concatenate così
+    come sono. Gli offset si riferiscono al testo concatenato; ogni chunk è già
+    privo di spazi iniziali/finali e `testo == sorgente[char_start:char_end]`.
+    """
+    if chunk_size <= 0:
+        raise ValueError("chunk_size deve essere positivo")
+    overlap = max(0, min(chunk_overlap, chunk_size - 1))
+    # Non tagliare chunk più corti di metà finestra solo per trovare un separatore
+    min_split = max(1, chunk_size // 2)
+
+    pages = iter([source]) if isinstance(source, str) else iter(source)
+    buf = ""
+    buf_offset = 0  # offset globale di buf[0]
+    pos = 0         # inizio del chunk corrente dentro buf
+    exhausted = False
+
+    while True:
+        # Riempie il buffer finché c'è almeno una finestra intera oltre `pos`
+        while not exhausted and len(buf) - pos <= chunk_size:
+            try:
+                page = next(pages)
+            except StopIteration:
+                exhausted = True
+                break
+            if page:
+                buf = buf[pos:] + page
+                buf_offset += pos
+                pos = 0
+
+        remaining = len(buf) - pos
+        if remaining <= 0:
+            return
+
+        if exhausted and remaining <= chunk_size:
+            end = len(buf)
+        else:
+            window_end = pos + chunk_size
+            end = window_end
+            for sep in separators:
+                k = buf.rfind(sep, pos + min_split, window_end)
+                if k != -1 and k + len(sep) <= window_end:
+                    end = k + len(sep)
+                    break
+
+        start, stop = pos, end
+        while start < stop and buf[start].isspace():
+            start += 1
+        while stop > start and buf[stop - 1].isspace():
+            stop -= 1
+        if start < stop:
+            yield buf[start:stop], buf_offset + start, buf_offset + stop
+
+        if end >= len(buf) and exhausted:
+            return
+
+        next_pos = end
+        if overlap:
+            # Al più metà del chunk appena emesso: con overlap > min_split un chunk
+            # tagliato presto farebbe avanzare la finestra di pochi caratteri
+            next_pos = end - min(overlap, (end - pos) // 2)
+            # Riparte dall'inizio di una parola dentro la zona di overlap
+            space = buf.find(" ", next_pos, end)
+            if space != -1:
+                next_pos = space + 1
+        pos = max(next_pos, pos + 1)
+
+
+def chunk_text(text: str, chunk_size: int = 800, chunk_overlap: int = 100,
+               separators: Sequence[str] = DEFAULT_SEPARATORS) -> List[Chunk]:
+    """Chunk con offset, senza duplicati esatti (resta la prima occorrenza)."""
+    seen = set()
+    out: List[Chunk] = []
+    for chunk, start, end in iter_chunks(text, chunk_size, chunk_overlap, separators):
+        if chunk in seen:
+            continue
+        seen.add(chunk)
+        out.append((chunk, start, end))
+    return out
@@ -0,0 +1,82 @@
+"""Risoluzione pigra del testo dei chunk a partire dagli offset.
+
+Con RAG_PAYLOAD_LAYOUT=offsets i punti Qdrant contengono solo document_id e
+(char_start, char_end): il testo viene ritagliato dal contenuto del documento
+in SQLite, che resta l'unica copia. I documenti letti di recente restano in
+una piccola LRU, così i risultati di una ricerca (spesso dallo stesso
+documento) costano una sola query.
+"""
+from __future__ import annotations
+
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+from database.db_manager import DatabaseManager
+
+
+class DocumentTextResolver:
+    def __init__(self, db_path: str = "synapse.db", max_documents: int = 8):
+        self.db_path = db_path
+        self.max_documents = max(1, max_documents)
+        self._documents: "OrderedDict[int, Optional[str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        # sqlite3 non condivide le connessioni fra thread: una per thread
+        self._local = threading.local()
+
+    def _db(self) -> DatabaseManager:
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = DatabaseManager(self.db_path)
+            self._local.db = db
+        return db
+
+    def document_text(self, document_id: int) -> Optional[str]:
+        with self._lock:
+            if document_id in self._documents:
+                self._documents.move_to_end(document_id)
+                return self._documents[document_id]
+
+        try:
+            content = self._db().get_document_content(document_id)
+        except Exception as e:
+            print(f"[RAG] Impossibile leggere il documento {document_id}: {e}")
+            return None
+
+        with self._lock:
+            self._documents[document_id] = content
+            self._documents.move_to_end(document_id)
+            while len(self._documents) > self.max_documents:
+                self._documents.popitem(last=False)
+        return content
+
+    def resolve(self, payload: Dict[str, Any]) -> str:
+        """Testo del chunk: dal payload se presente, altrimenti dagli offset."""
+        text = payload.get("text")
+        if isinstance(text, str):
+            return text
+        start, end = payload.get("char_start"), payload.get("char_end")
+        document_id = payload.get("document_id")
+        if document_id is None or start is None or end is None:
+            return ""
+        content = self.document_text(document_id)
+        return content[start:end] if content else ""
+
+    def resolve_many(self, payloads: List[Dict[str, Any]]) -> List[str]:
+        """Come `resolve`, ma legge ogni documento una volta sola anche oltre la LRU."""
+        texts = [""] * len(payloads)
+        by_document: Dict[int, List[int]] = {}
+        for i, payload in enumerate(payloads):
+            if isinstance(payload.get("text"), str):
+                texts[i] = payload["text"]
+            elif payload.get("document_id") is not None:
+                by_document.setdefault(payload["document_id"], []).append(i)
+
+        for rows in by_document.values():
+            for i in rows:
+                texts[i] = self.resolve(payloads[i])
+        return texts
+
+    def invalidate(self, document_id: int) -> None:
+        with self._lock:
+            self._documents.pop(document_id, None)
@@ -0,0 +1,298 @@
+"""Cache persistente degli embedding, indirizzata per contenuto.
+
+Ogni vettore è identificato da (provider, modello, sha256(testo)) ed è salvato
+in un piccolo database SQLite come blob float32. Quando la dimensione totale
+supera il limite configurato vengono eliminate le voci usate meno di recente.
+"""
+from __future__ import annotations
+
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+
+
+def text_digest(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    def __init__(self, db_path: str, max_bytes: int = 512 * 1024 * 1024):
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+
+        # La cache è condivisa fra il thread UI e i QThread di indicizzazione
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS embeddings (
+                provider TEXT NOT NULL,
+                model TEXT NOT NULL,
+                digest TEXT NOT NULL,
+                dim INTEGER NOT NULL,
+                vector BLOB NOT NULL,
+                last_access REAL NOT NULL,
+                PRIMARY KEY (provider, model, digest)
+            )
+        ''')
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_embeddings_access ON embeddings (last_access)"
+        )
+        self._conn.commit()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._total_bytes = self._conn.execute(
+            "SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings"
+        ).fetchone()[0]
+
+    def get_many(self, provider: str, model: str, digests: Sequence[str]) -> Dict[str, np.ndarray]:
+        """Ritorna {digest: vettore float32} per i digest presenti in cache."""
+        found: Dict[str, np.ndarray] = {}
+        if not digests:
+            return found
+
+        unique = list(dict.fromkeys(digests))
+        now = time.time()
+        with self._lock:
+            # SQLite limita il numero di parametri per query
+            for i in range(0, len(unique), 500):
+                part = unique[i:i + 500]
+                placeholders = ",".join("?" * len(part))
+                rows = self._conn.execute(
+                    f"SELECT digest, vector FROM embeddings "
+                    f"WHERE provider = ? AND model = ? AND digest IN ({placeholders})",
+                    (provider, model, *part),
+                ).fetchall()
+                for digest, blob in rows:
+                    found[digest] = np.frombuffer(blob, dtype=np.float32)
+            if found:
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_access = ? WHERE provider = ? AND model = ? AND digest = ?",
+                    [(now, provider, model, d) for d in found],
+                )
+                self._conn.commit()
+
+            hit_count = sum(1 for d in digests if d in found)
+            self.hits += hit_count
+            self.misses += len(digests) - hit_count
+        return found
+
+    def put_many(self, provider: str, model: str, items: Dict[str, np.ndarray]) -> None:
+        if not items:
+            return
+
+        now = time.time()
+        rows = []
+        for digest, vector in items.items():
+            blob = np.asarray(vector, dtype=np.float32).tobytes()
+            rows.append((provider, model, digest, len(vector), blob, now))
+
+        with self._lock:
+            existing = self._existing_bytes(provider, model, list(items))
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (provider, model, digest, dim, vector, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            self._conn.commit()
+            self._total_bytes += sum(len(r[4]) for r in rows) - existing
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+
+    def _existing_bytes(self, provider: str, model: str, digests: List[str]) -> int:
+        total = 0
+        for i in range(0, len(digests), 500):
+            part = digests[i:i + 500]
+            placeholders = ",".join("?" * len(part))
+            total += self._conn.execute(
+                f"SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings "
+                f"WHERE provider = ? AND model = ? AND digest IN ({placeholders})",
+                (provider, model, *part),
+            ).fetchone()[0]
+        return total
+
+    def _evict(self) -> None:
+        # Scende al 90% del limite per non rieseguire l'eviction a ogni inserimento
+        target = int(self.max_bytes * 0.9)
+        cursor = self._conn.execute(
+            "SELECT rowid, LENGTH(vector) FROM embeddings ORDER BY last_access ASC"
+        )
+        to_delete = []
+        freed = 0
+        for rowid, size in cursor:
+            if self._total_bytes - freed <= target:
+                break
+            to_delete.append((rowid,))
+            freed += size
+        cursor.close()
+
+        self._conn.executemany("DELETE FROM embeddings WHERE rowid = ?", to_delete)
+        self._conn.commit()
+        self._total_bytes -= freed
+        self.evictions += len(to_delete)
+        print(f"[EMBED CACHE] Eviction: rimossi {len(to_delete)} vettori ({freed // 1024} KB)")
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits / lookups) if lookups else 0.0,
+                "evictions": self.evictions,
+                "entries": entries,
+                "bytes": self._total_bytes,
+            }
+
+    def close(self) -> None:
+        with self._lock:
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+
+
+class CachedEmbeddingFunction:
+    """Avvolge un embedder e ricalcola solo i testi non ancora in cache."""
+
+    def __init__(self, embedder, cache: EmbeddingCache):
+        self.embedder = embedder
+        self.cache = cache
+        self.provider = getattr(embedder, "provider", type(embedder).__name__)
+
+    @property
+    def model_name(self) -> str:
+        return self.embedder.model_name
+
+    @property
+    def embedding_id(self) -> str:
+        return getattr(self.embedder, "embedding_id", self.embedder.model_name)
+
+    def stats(self) -> Dict[str, float]:
+        return self.cache.stats()
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        return self.embed_with_mask(texts)[0]
+
+    def embed_with_mask(self, texts: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+        if isinstance(texts, str):
+            texts = [texts]
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32), np.zeros(0, dtype=bool)
+
+        model = self.embedding_id
+        digests = [text_digest(t) for t in texts]
+        cached = self.cache.get_many(self.provider, model, digests)
+
+        # Testi mancanti, deduplicati per digest
+        missing: Dict[str, str] = {}
+        for digest, text in zip(digests, texts):
+            if digest not in cached and digest not in missing:
+                missing[digest] = text
+
+        if missing:
+            fresh, ok = self.embedder.embed_with_mask(list(missing.values()))
+            to_store: Dict[str, np.ndarray] = {}
+            for row, digest in enumerate(missing):
+                # I testi falliti non vengono salvati e restano fuori dalla maschera
+                if ok[row]:
+                    cached[digest] = fresh[row]
+                    to_store[digest] = fresh[row]
+            self.cache.put_many(self.provider, model, to_store)
+
+        dim = next((len(v) for v in cached.values()), 0)
+        matrix = np.zeros((len(texts), dim), dtype=np.float32)
+        mask = np.zeros(len(texts), dtype=bool)
+        for i, digest in enumerate(digests):
+            vector = cached.get(digest)
+            if vector is not None and len(vector) == dim:
+                matrix[i] = vector
+                mask[i] = True
+        return matrix, mask
+
+
+class QueryEmbeddingCache:
+    """LRU in memoria degli embedding delle query, con contatori di hit rate.
+
+    La chiave è (modello, query normalizzata): spazi collassati e minuscole,
+    così "Reti  neurali" e "reti neurali" condividono lo stesso vettore.
+    """
+
+    def __init__(self, max_entries: int = 512):
+        self.max_entries = max(1, max_entries)
+        self._entries: "OrderedDict[Tuple[str, str], np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize(query: str) -> str:
+        return " ".join((query or "").split()).casefold()
+
+    def embed_queries(self, embedder, queries: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """Come `embed_with_mask`, ma calcola solo le query assenti dalla cache."""
+        if not queries:
+            return np.zeros((0, 0), dtype=np.float32), np.zeros(0, dtype=bool)
+
+        model = getattr(embedder, "embedding_id", embedder.model_name)
+        keys = [(model, self.normalize(q)) for q in queries]
+        found: Dict[Tuple[str, str], np.ndarray] = {}
+        missing: Dict[Tuple[str, str], str] = {}
+        with self._lock:
+            for key, query in zip(keys, queries):
+                vector = self._entries.get(key)
+                if vector is not None:
+                    self._entries.move_to_end(key)
+                    found[key] = vector
+                    self.hits += 1
+                else:
+                    self.misses += 1
+                    missing.setdefault(key, query)
+
+        if missing:
+            fresh, ok = embedder.embed_with_mask(list(missing.values()))
+            with self._lock:
+                for row, key in enumerate(missing):
+                    if not ok[row]:
+                        continue
+                    vector = fresh[row].copy()
+                    found[key] = vector
+                    self._entries[key] = vector
+                    self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+
+        dim = next((len(v) for v in found.values()), 0)
+        matrix = np.zeros((len(queries), dim), dtype=np.float32)
+        mask = np.zeros(len(queries), dtype=bool)
+        for i, key in enumerate(keys):
+            vector = found.get(key)
+            if vector is not None and len(vector) == dim:
+                matrix[i] = vector
+                mask[i] = True
+        return matrix, mask
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits / lookups) if lookups else 0.0,
+                "entries": len(self._entries),
+            }
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,112 @@
+"""Confronto recall/spazio per vettori troncati (Matryoshka) e quantizzati.
+
+Usa i vettori già salvati in una collection: un campione di vettori fa da
+insieme di query, la ricerca esatta a piena dimensione è il riferimento e
+per ogni dimensione ridotta si misura il recall@k con float32, int8 e
+binario (con e senza rescoring a precisione piena).
+"""
+from __future__ import annotations
+
+from typing import Dict, List, Sequence
+
+import numpy as np
+
+
+def truncate_and_normalize(matrix: np.ndarray, dim: int) -> np.ndarray:
+    """Tronca alle prime `dim` componenti e rinormalizza (L2) ogni riga."""
+    truncated = np.ascontiguousarray(matrix[:, :dim], dtype=np.float32)
+    norms = np.linalg.norm(truncated, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return truncated / norms
+
+
+def quantize_int8(matrix: np.ndarray, quantile: float = 0.99) -> np.ndarray:
+    """Simula la quantizzazione scalare int8 di Qdrant e ritorna i valori dequantizzati."""
+    low = float(np.quantile(matrix, 1.0 - quantile))
+    high = float(np.quantile(matrix, quantile))
+    scale = (high - low) / 255.0 or 1.0
+    codes = np.clip(np.round((matrix - low) / scale), 0, 255).astype(np.uint8)
+    return codes.astype(np.float32) * scale + low
+
+
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indici dei k punteggi più alti per colonna (una colonna per query)."""
+    k = min(k, scores.shape[0])
+    part = np.argpartition(-scores, k - 1, axis=0)[:k]
+    order = np.argsort(-np.take_along_axis(scores, part, axis=0), axis=0)
+    return np.take_along_axis(part, order, axis=0)
+
+
+def _recall(found: np.ndarray, truth: np.ndarray) -> float:
+    hits = 0
+    for q in range(truth.shape[1]):
+        hits += len(set(found[:, q].tolist()) & set(truth[:, q].tolist()))
+    return hits / truth.size
+
+
+def _rescore(candidates: np.ndarray, vectors: np.ndarray, queries: np.ndarray, k: int) -> np.ndarray:
+    out = np.empty((k, candidates.shape[1]), dtype=np.int64)
+    for q in range(candidates.shape[1]):
+        cand = candidates[:, q]
+        exact = vectors[cand] @ queries[:, q]
+        out[:, q] = cand[np.argsort(-exact)[:k]]
+    return out
+
+
+def recall_report(vectors: np.ndarray, dims: Sequence[int], k: int = 10,
+                  n_queries: int = 200, oversampling: float = 2.0,
+                  seed: int = 0) -> List[Dict[str, float]]:
+    """Recall@k e byte per vettore per ogni combinazione (dimensione, formato)."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    n, full_dim = vectors.shape
+    if n <= k:
+        raise ValueError(f"Servono più di {k} vettori per il report (trovati {n})")
+
+    rng = np.random.default_rng(seed)
+    query_idx = rng.choice(n, size=min(n_queries, n), replace=False)
+
+    def _exclude_self(scores: np.ndarray) -> np.ndarray:
+        scores[query_idx, np.arange(len(query_idx))] = -np.inf
+        return scores
+
+    full = truncate_and_normalize(vectors, full_dim)
+    truth = _top_k(_exclude_self(full @ full[query_idx].T), k)
+    candidates_k = int(np.ceil(k * oversampling))
+
+    rows: List[Dict[str, float]] = []
+    for dim in sorted({d for d in dims if 0 < d <= full_dim} | {full_dim}):
+        reduced = truncate_and_normalize(vectors, dim)
+        queries = reduced[query_idx].T
+
+        float_top = _top_k(_exclude_self(reduced @ queries), k)
+        rows.append({"dim": dim, "format": "float32", "bytes_per_vector": dim * 4,
+                     "recall": _recall(float_top, truth), "recall_rescored": _recall(float_top, truth)})
+
+        int8_scores = _exclude_self(quantize_int8(reduced) @ queries)
+        int8_top = _top_k(int8_scores, k)
+        int8_rescored = _rescore(_top_k(int8_scores, candidates_k), reduced, queries, k)
+        rows.append({"dim": dim, "format": "int8", "bytes_per_vector": dim,
+                     "recall": _recall(int8_top, truth), "recall_rescored": _recall(int8_rescored, truth)})
+
+        signs = np.where(reduced > 0, 1.0, -1.0).astype(np.float32)
+        binary_scores = _exclude_self(signs @ signs[query_idx].T)
+        binary_top = _top_k(binary_scores, k)
+        binary_rescored = _rescore(_top_k(binary_scores, candidates_k), reduced, queries, k)
+        rows.append({"dim": dim, "format": "binary", "bytes_per_vector": int(np.ceil(dim / 8)),
+                     "recall": _recall(binary_top, truth), "recall_rescored": _recall(binary_rescored, truth)})
+
+    full_bytes = full_dim * 4
+    for row in rows:
+        row["size_ratio"] = full_bytes / row["bytes_per_vector"]
+    return rows
+
+
+def format_report(rows: List[Dict[str, float]], k: int = 10) -> str:
+    lines = [f"{'dim':>6} {'formato':>8} {'byte/vett':>10} {'riduz.':>7} "
+             f"{'recall@' + str(k):>10} {'rescored':>9}"]
+    for row in rows:
+        lines.append(
+            f"{row['dim']:>6} {row['format']:>8} {row['bytes_per_vector']:>10} "
+            f"{row['size_ratio']:>6.1f}x {row['recall']:>10.3f} {row['recall_rescored']:>9.3f}"
+        )
+    return "\n".join(lines)
@@ -0,0 +1,362 @@
+"""Vector store piatto su file NumPy memory-mapped.
+
+Alternativa leggera al Qdrant embedded per materie piccole (qualche migliaio
+di chunk): ogni collection è una cartella con
+
+    vectors.npy     matrice float32 (capacità x dim), righe già normalizzate L2
+    points.json     id e payload di ogni riga valida, nello stesso ordine
+    meta.json       dimensione, numero di righe valide e capacità
+
+La ricerca è esatta: un solo prodotto matrice-vettore sulle righe valide.
+Le collection vengono aperte solo al primo uso e la matrice è in mmap, quindi
+l'avvio è immediato e la memoria occupata è quella che il sistema operativo
+carica davvero. Espone il sottoinsieme dell'API di QdrantClient usato da
+RAGService, con gli stessi modelli di risposta dove RAGService li legge.
+"""
+from __future__ import annotations
+
+import json
+import os
+import shutil
+import threading
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from qdrant_client.models import (CollectionDescription, CollectionsResponse,
+                                  CountResult, FieldCondition, Filter,
+                                  FilterSelector, HasIdCondition, MatchAny,
+                                  MatchValue, PointIdsList, Record, ScoredPoint,
+                                  VectorParams)
+
+_MIN_CAPACITY = 1024
+
+
+def _vector_size(vectors_config) -> int:
+    if hasattr(vectors_config, "size"):
+        return int(vectors_config.size)
+    return int(vectors_config["size"])
+
+
+def _select_payload(payload: Dict[str, Any], with_payload) -> Optional[Dict[str, Any]]:
+    if not with_payload:
+        return None
+    if isinstance(with_payload, (list, tuple)):
+        return {k: payload[k] for k in with_payload if k in payload}
+    return dict(payload)
+
+
+def _condition_matches(condition, point_id: str, payload: Dict[str, Any]) -> bool:
+    if isinstance(condition, Filter):
+        return _filter_matches(condition, point_id, payload)
+    if isinstance(condition, HasIdCondition):
+        return point_id in {str(i) for i in condition.has_id}
+    if isinstance(condition, FieldCondition):
+        value = payload.get(condition.key)
+        match = condition.match
+        if isinstance(match, MatchValue):
+            return value == match.value
+        if isinstance(match, MatchAny):
+            return value in match.any
+    raise ValueError(f"Condizione non supportata dal vector store piatto: {condition!r}")
+
+
+def _filter_matches(flt: Optional[Filter], point_id: str, payload: Dict[str, Any]) -> bool:
+    if flt is None:
+        return True
+    if flt.must and not all(_condition_matches(c, point_id, payload) for c in flt.must):
+        return False
+    if flt.must_not and any(_condition_matches(c, point_id, payload) for c in flt.must_not):
+        return False
+    if flt.should and not any(_condition_matches(c, point_id, payload) for c in flt.should):
+        return False
+    return True
+
+
+class _FlatCollection:
+    def __init__(self, path: Path):
+        self.path = path
+        with open(path / "meta.json", "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        self.dim = int(meta["dim"])
+        self.count = int(meta["count"])
+        self.capacity = int(meta["capacity"])
+        with open(path / "points.json", "r", encoding="utf-8") as f:
+            points = json.load(f)
+        self.ids: List[str] = [p[0] for p in points]
+        self.payloads: List[Dict[str, Any]] = [p[1] for p in points]
+        self.rows: Dict[str, int] = {pid: i for i, pid in enumerate(self.ids)}
+        self.vectors = np.load(path / "vectors.npy", mmap_mode="r+")
+
+    @classmethod
+    def create(cls, path: Path, dim: int) -> "_FlatCollection":
+        path.mkdir(parents=True, exist_ok=True)
+        matrix = np.lib.format.open_memmap(
+            path / "vectors.npy", mode="w+", dtype=np.float32, shape=(_MIN_CAPACITY, dim)
+        )
+        matrix.flush()
+        del matrix
+        cls._write_json(path / "points.json", [])
+        cls._write_json(path / "meta.json", {"dim": dim, "count": 0, "capacity": _MIN_CAPACITY})
+        return cls(path)
+
+    @staticmethod
+    def _write_json(path: Path, data: Any) -> None:
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, separators=(",", ":"))
+        os.replace(tmp_path, path)
+
+    def save(self) -> None:
+        self.vectors.flush()
+        self._write_json(self.path / "points.json", [[pid, p] for pid, p in zip(self.ids, self.payloads)])
+        self._write_json(self.path / "meta.json",
+                         {"dim": self.dim, "count": self.count, "capacity": self.capacity})
+
+    def _grow(self, needed: int) -> None:
+        if needed <= self.capacity:
+            return
+        capacity = max(needed, self.capacity * 2)
+        tmp_path = self.path / "vectors.grow.npy"
+        grown = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32,
+                                          shape=(capacity, self.dim))
+        grown[:self.count] = self.vectors[:self.count]
+        grown.flush()
+        del grown
+        # Su Windows il file in mmap non può essere sostituito finché è aperto
+        self.vectors = None
+        os.replace(tmp_path, self.path / "vectors.npy")
+        self.vectors = np.load(self.path / "vectors.npy", mmap_mode="r+")
+        self.capacity = capacity
+
+    def upsert(self, ids: Sequence[str], vectors: np.ndarray, payloads: Sequence[Dict[str, Any]]) -> None:
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(len(ids), -1)
+        if vectors.shape[1] != self.dim:
+            raise ValueError(f"Dimensione vettore {vectors.shape[1]} diversa da {self.dim}")
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        vectors = vectors / norms
+
+        new_ids = [pid for pid in dict.fromkeys(ids) if pid not in self.rows]
+        self._grow(self.count + len(new_ids))
+        for pid, vector, payload in zip(ids, vectors, payloads):
+            row = self.rows.get(pid)
+            if row is None:
+                row = self.count
+                self.rows[pid] = row
+                self.ids.append(pid)
+                self.payloads.append(dict(payload or {}))
+                self.count += 1
+            else:
+                self.payloads[row] = dict(payload or {})
+            self.vectors[row] = vector
+
+    def delete(self, ids: Sequence[str]) -> int:
+        """Rimozione swap-with-last: la matrice resta compatta, costo O(1) per punto."""
+        removed = 0
+        for pid in ids:
+            row = self.rows.pop(pid, None)
+            if row is None:
+                continue
+            last = self.count - 1
+            if row != last:
+                self.vectors[row] = self.vectors[last]
+                self.ids[row] = self.ids[last]
+                self.payloads[row] = self.payloads[last]
+                self.rows[self.ids[row]] = row
+            self.ids.pop()
+            self.payloads.pop()
+            self.count -= 1
+            removed += 1
+        return removed
+
+    def matching_rows(self, flt: Optional[Filter]) -> np.ndarray:
+        if flt is None:
+            return np.arange(self.count)
+        return np.fromiter(
+            (i for i in range(self.count) if _filter_matches(flt, self.ids[i], self.payloads[i])),
+            dtype=np.int64,
+        )
+
+    def record(self, row: int, with_payload, with_vectors) -> Record:
+        return Record(
+            id=self.ids[row],
+            payload=_select_payload(self.payloads[row], with_payload),
+            vector=self.vectors[row].tolist() if with_vectors else None,
+        )
+
+
+class FlatVectorStore:
+    def __init__(self, path: str):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._collections: Dict[str, _FlatCollection] = {}
+        self._lock = threading.RLock()
+
+    # ------------------ Collection ------------------
+    def _collection(self, name: str) -> _FlatCollection:
+        collection = self._collections.get(name)
+        if collection is None:
+            if not (self.path / name / "meta.json").exists():
+                raise ValueError(f"Collection {name} not found")
+            collection = _FlatCollection(self.path / name)
+            self._collections[name] = collection
+        return collection
+
+    def get_collections(self) -> CollectionsResponse:
+        with self._lock:
+            names = sorted(p.name for p in self.path.iterdir() if (p / "meta.json").exists())
+        return CollectionsResponse(collections=[CollectionDescription(name=n) for n in names])
+
+    def get_collection(self, collection_name: str):
+        with self._lock:
+            collection = self._collection(collection_name)
+            return SimpleNamespace(
+                points_count=collection.count,
+                vectors_count=collection.count,
+                payload_schema={},
+                config=SimpleNamespace(
+                    params=SimpleNamespace(vectors=VectorParams(size=collection.dim, distance="Cosine")),
+                    quantization_config=None,
+                ),
+            )
+
+    def create_collection(self, collection_name: str, vectors_config, **kwargs) -> bool:
+        # Quantizzazione e indici non servono: la ricerca è esatta su float32
+        with self._lock:
+            self.delete_collection(collection_name)
+            self._collections[collection_name] = _FlatCollection.create(
+                self.path / collection_name, _vector_size(vectors_config)
+            )
+        return True
+
+    def delete_collection(self, collection_name: str, **kwargs) -> bool:
+        with self._lock:
+            collection = self._collections.pop(collection_name, None)
+            if collection is not None:
+                collection.vectors = None
+            target = self.path / collection_name
+            if not target.exists():
+                return False
+            shutil.rmtree(target)
+            return True
+
+    def update_collection(self, collection_name: str, **kwargs) -> bool:
+        return True
+
+    def create_payload_index(self, collection_name: str, field_name: str, **kwargs) -> None:
+        return None
+
+    # ------------------ Scrittura ------------------
+    def upsert(self, collection_name: str, points, wait: bool = True, **kwargs) -> None:
+        if not points:
+            return
+        with self._lock:
+            collection = self._collection(collection_name)
+            collection.upsert(
+                [str(p.id) for p in points],
+                np.asarray([p.vector for p in points], dtype=np.float32),
+                [p.payload for p in points],
+            )
+            collection.save()
+
+    def upload_collection(self, collection_name: str, vectors, payload=None, ids=None,
+                          batch_size: int = 256, wait: bool = True, **kwargs) -> None:
+        vectors = np.asarray(vectors, dtype=np.float32)
+        payload = list(payload) if payload is not None else [{} for _ in range(len(vectors))]
+        with self._lock:
+            collection = self._collection(collection_name)
+            collection.upsert([str(i) for i in ids], vectors, payload)
+            collection.save()
+
+    def delete(self, collection_name: str, points_selector, wait: bool = True, **kwargs) -> None:
+        with self._lock:
+            collection = self._collection(collection_name)
+            if isinstance(points_selector, PointIdsList):
+                ids = [str(i) for i in points_selector.points]
+            else:
+                flt = points_selector.filter if isinstance(points_selector, FilterSelector) else points_selector
+                ids = [collection.ids[i] for i in collection.matching_rows(flt)]
+            if collection.delete(ids):
+                collection.save()
+
+    # ------------------ Lettura ------------------
+    def count(self, collection_name: str, count_filter: Filter = None, exact: bool = True, **kwargs) -> CountResult:
+        with self._lock:
+            collection = self._collection(collection_name)
+            if count_filter is None:
+                return CountResult(count=collection.count)
+            return CountResult(count=len(collection.matching_rows(count_filter)))
+
+    def scroll(self, collection_name: str, scroll_filter: Filter = None, limit: int = 10,
+               offset=None, with_payload=True, with_vectors=False, **kwargs) -> Tuple[List[Record], Any]:
+        """`offset` è la posizione nelle righe filtrate (opaca per il chiamante, come in Qdrant)."""
+        with self._lock:
+            collection = self._collection(collection_name)
+            rows = collection.matching_rows(scroll_filter)
+            start = int(offset or 0)
+            page = rows[start:start + limit]
+            records = [collection.record(int(r), with_payload, with_vectors) for r in page]
+            next_offset = start + limit if start + limit < len(rows) else None
+            return records, next_offset
+
+    def retrieve(self, collection_name: str, ids, with_payload=True, with_vectors=False, **kwargs) -> List[Record]:
+        with self._lock:
+            collection = self._collection(collection_name)
+            rows = [collection.rows.get(str(i)) for i in ids]
+            return [collection.record(r, with_payload, with_vectors) for r in rows if r is not None]
+
+    def _search(self, collection: _FlatCollection, vector, limit: int, score_threshold: float = None,
+                query_filter: Filter = None, with_payload=True, with_vectors=False) -> List[ScoredPoint]:
+        if collection.count == 0:
+            return []
+        query = np.asarray(vector, dtype=np.float32)
+        query = query / max(float(np.linalg.norm(query)), 1e-12)
+
+        rows = None if query_filter is None else collection.matching_rows(query_filter)
+        matrix = collection.vectors[:collection.count] if rows is None else collection.vectors[rows]
+        scores = matrix @ query
+        if len(scores) == 0:
+            return []
+        k = min(limit, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+
+        results = []
+        for i in top:
+            score = float(scores[i])
+            if score_threshold is not None and score < score_threshold:
+                break
+            row = int(i) if rows is None else int(rows[i])
+            results.append(ScoredPoint(
+                id=collection.ids[row],
+                version=0,
+                score=score,
+                payload=_select_payload(collection.payloads[row], with_payload),
+                vector=collection.vectors[row].tolist() if with_vectors else None,
+            ))
+        return results
+
+    def search(self, collection_name: str, query_vector, limit: int = 10, score_threshold: float = None,
+               query_filter: Filter = None, with_payload=True, with_vectors=False, **kwargs) -> List[ScoredPoint]:
+        with self._lock:
+            return self._search(self._collection(collection_name), query_vector, limit,
+                                score_threshold, query_filter, with_payload, with_vectors)
+
+    def search_batch(self, collection_name: str, requests, **kwargs) -> List[List[ScoredPoint]]:
+        with self._lock:
+            collection = self._collection(collection_name)
+            return [
+                self._search(collection, r.vector, r.limit, r.score_threshold, r.filter,
+                             r.with_payload, r.with_vector)
+                for r in requests
+            ]
+
+    def close(self) -> None:
+        with self._lock:
+            for collection in self._collections.values():
+                if collection.vectors is not None:
+                    collection.vectors.flush()
+                collection.vectors = None
+            self._collections.clear()
@@ -0,0 +1,158 @@
+"""Scheduler condiviso delle chiavi API Gemini.
+
+Un'unica istanza per processo tiene traccia dello stato di ogni chiave
+(cooldown appreso dai 429, richieste in corso, latenza recente) ed è usata
+sia da AIService sia da GeminiEmbeddingFunction: una chiave esaurita
+durante l'indicizzazione non viene scelta nemmeno per la generazione.
+"""
+from __future__ import annotations
+
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Optional, Sequence
+
+from services.rate_limiter import is_quota_error, parse_retry_delay
+
+
+@dataclass
+class KeyHealth:
+    label: str
+    cooldown_until: float = 0.0
+    in_flight: int = 0
+    latency_ewma: float = 0.0
+    quota_strikes: int = 0
+    failures: int = 0
+    successes: int = 0
+
+
+class KeyScheduler:
+    def __init__(self, base_cooldown: float = 2.0, max_cooldown: float = 60.0,
+                 latency_alpha: float = 0.3):
+        self.base_cooldown = base_cooldown
+        self.max_cooldown = max_cooldown
+        self.latency_alpha = latency_alpha
+        self._keys: Dict[str, KeyHealth] = {}
+        self._cond = threading.Condition()
+
+    def _state(self, key: str) -> KeyHealth:
+        state = self._keys.get(key)
+        if state is None:
+            state = KeyHealth(label=f"...{key[-4:]}" if len(key) > 4 else "key")
+            self._keys[key] = state
+        return state
+
+    def register(self, keys: Sequence[str]) -> None:
+        with self._cond:
+            for key in keys:
+                self._state(key)
+
+    def cooldown_remaining(self, key: str) -> float:
+        with self._cond:
+            return max(0.0, self._state(key).cooldown_until - time.monotonic())
+
+    def _score(self, state: KeyHealth):
+        # Meno richieste in corso, poi latenza più bassa, poi meno errori recenti
+        return (state.in_flight, state.latency_ewma, state.quota_strikes + state.failures)
+
+    def acquire(self, keys: Sequence[str], max_wait: Optional[float] = 60.0) -> str:
+        """Sceglie la chiave più sana fra `keys` e la segna come in uso.
+
+        Se tutte le chiavi sono in cooldown attende la prima che si libera
+        (al massimo `max_wait` secondi, poi usa comunque la meno penalizzata).
+        """
+        if not keys:
+            raise ValueError("Nessuna chiave API disponibile")
+        deadline = None if max_wait is None else time.monotonic() + max_wait
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                states = [(key, self._state(key)) for key in keys]
+                ready = [(key, s) for key, s in states if s.cooldown_until <= now]
+                if ready:
+                    key, state = min(ready, key=lambda item: self._score(item[1]))
+                    break
+                soonest = min(s.cooldown_until for _, s in states)
+                if deadline is not None and soonest > deadline:
+                    key, state = min(states, key=lambda item: item[1].cooldown_until)
+                    break
+                self._cond.wait(timeout=max(0.05, soonest - now))
+            state.in_flight += 1
+            return key
+
+    def release(self, key: str, latency: Optional[float] = None,
+                error: Optional[Exception] = None) -> None:
+        with self._cond:
+            state = self._state(key)
+            state.in_flight = max(0, state.in_flight - 1)
+            if error is None:
+                state.successes += 1
+                state.quota_strikes = 0
+                state.failures = 0
+                if latency is not None:
+                    if state.latency_ewma:
+                        state.latency_ewma += self.latency_alpha * (latency - state.latency_ewma)
+                    else:
+                        state.latency_ewma = latency
+            elif is_quota_error(error):
+                self._mark_rate_limited(state, parse_retry_delay(error))
+            else:
+                state.failures += 1
+            self._cond.notify_all()
+
+    def report_rate_limited(self, key: str, delay: Optional[float] = None) -> float:
+        with self._cond:
+            cooldown = self._mark_rate_limited(self._state(key), delay)
+            self._cond.notify_all()
+            return cooldown
+
+    def _mark_rate_limited(self, state: KeyHealth, delay: Optional[float]) -> float:
+        state.quota_strikes += 1
+        if delay is None:
+            delay = self.base_cooldown * (2 ** (state.quota_strikes - 1))
+        delay = min(delay, self.max_cooldown)
+        state.cooldown_until = max(state.cooldown_until, time.monotonic() + delay)
+        print(f"[KEYS] Chiave {state.label} in cooldown per {delay:.0f}s")
+        return delay
+
+    @contextmanager
+    def lease(self, keys: Sequence[str], max_wait: Optional[float] = 60.0) -> Iterator[str]:
+        """Context manager: acquisisce una chiave e registra latenza/esito della chiamata."""
+        key = self.acquire(keys, max_wait=max_wait)
+        started = time.perf_counter()
+        try:
+            yield key
+        except Exception as e:
+            self.release(key, error=e)
+            raise
+        else:
+            self.release(key, latency=time.perf_counter() - started)
+
+    def snapshot(self) -> List[Dict[str, float]]:
+        now = time.monotonic()
+        with self._cond:
+            return [
+                {
+                    "key": s.label,
+                    "cooldown_s": max(0.0, s.cooldown_until - now),
+                    "in_flight": s.in_flight,
+                    "latency_ewma_s": s.latency_ewma,
+                    "quota_strikes": s.quota_strikes,
+                    "failures": s.failures,
+                    "successes": s.successes,
+                }
+                for s in self._keys.values()
+            ]
+
+
+_scheduler: Optional[KeyScheduler] = None
+_scheduler_lock = threading.Lock()
+
+
+def get_key_scheduler() -> KeyScheduler:
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = KeyScheduler()
+        return _scheduler
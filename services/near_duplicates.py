@@ -0,0 +1,288 @@
+"""Indice MinHash/LSH dei chunk per collection, per scartare i quasi-duplicati.
+
+Slide, intestazioni e piè di pagina ripetuti producono chunk quasi identici
+che verrebbero embeddati, salvati e poi recuperati al posto di contenuto
+utile. Ogni chunk ha una firma MinHash sui trigrammi di parole; le firme
+sono divise in bande (LSH) e solo i chunk che condividono almeno una banda
+vengono confrontati. Firme e bucket sono salvati in SQLite accanto
+all'indice BM25, così il controllo vale anche fra documenti indicizzati in
+sessioni diverse. Ogni chunk scartato resta registrato insieme al punto che
+lo rappresenta: se quel punto sparisce, il documento scartato risulta
+"orfano" e va reindicizzato.
+"""
+from __future__ import annotations
+
+import hashlib
+import re
+import sqlite3
+import threading
+import zlib
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+
+import numpy as np
+
+_WORD_RE = re.compile(r"\w+")
+# Primo di Mersenne 2^31 - 1: a·x + b resta dentro uint64 senza overflow
+_PRIME = np.uint64((1 << 31) - 1)
+
+
+def shingles(text: str, size: int = 3) -> List[str]:
+    words = _WORD_RE.findall((text or "").casefold())
+    if len(words) <= size:
+        return [" ".join(words)]
+    return [" ".join(words[i:i + size]) for i in range(len(words) - size + 1)]
+
+
+class NearDuplicateIndex:
+    def __init__(self, db_path: str, threshold: float = 0.9, num_perm: int = 64, bands: int = 8):
+        if num_perm % bands:
+            raise ValueError("num_perm deve essere multiplo di bands")
+        self.db_path = db_path
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+
+        # Permutazioni fisse: le firme salvate restano confrontabili fra un avvio e l'altro
+        rng = np.random.default_rng(0x5EED)
+        self._a = rng.integers(1, int(_PRIME), size=num_perm, dtype=np.uint64)
+        self._b = rng.integers(0, int(_PRIME), size=num_perm, dtype=np.uint64)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS signatures (
+                collection TEXT NOT NULL,
+                point_id TEXT NOT NULL,
+                document_id INTEGER NOT NULL,
+                signature BLOB NOT NULL,
+                PRIMARY KEY (collection, point_id)
+            )
+        ''')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS buckets (
+                collection TEXT NOT NULL,
+                band INTEGER NOT NULL,
+                bucket INTEGER NOT NULL,
+                point_id TEXT NOT NULL,
+                PRIMARY KEY (collection, band, bucket, point_id)
+            ) WITHOUT ROWID
+        ''')
+        # Chunk scartati -> punto salvato che li rappresenta
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS duplicates (
+                collection TEXT NOT NULL,
+                point_id TEXT NOT NULL,
+                document_id INTEGER NOT NULL,
+                canonical_id TEXT NOT NULL,
+                PRIMARY KEY (collection, point_id)
+            )
+        ''')
+        # Chunk totali per documento: un documento fatto solo di quasi-duplicati
+        # non ha punti salvati da cui leggere total_chunks
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS documents (
+                collection TEXT NOT NULL,
+                document_id INTEGER NOT NULL,
+                total_chunks INTEGER NOT NULL,
+                PRIMARY KEY (collection, document_id)
+            )
+        ''')
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_signatures_document ON signatures (collection, document_id)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_duplicates_document ON duplicates (collection, document_id)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_buckets_point ON buckets (collection, point_id)"
+        )
+        self._conn.commit()
+
+    def signature(self, text: str) -> np.ndarray:
+        """Firma MinHash (uint32, `num_perm` valori) dei trigrammi di parole del testo."""
+        hashes = np.fromiter(
+            (zlib.crc32(s.encode("utf-8")) for s in set(shingles(text))),
+            dtype=np.uint64,
+        ) % _PRIME
+        permuted = (np.outer(hashes, self._a) + self._b) % _PRIME
+        return permuted.min(axis=0).astype(np.uint32)
+
+    def _band_keys(self, signature: np.ndarray) -> List[int]:
+        return [
+            int.from_bytes(
+                hashlib.blake2b(signature[band * self.rows:(band + 1) * self.rows].tobytes(),
+                                digest_size=8).digest(),
+                "little", signed=True,
+            )
+            for band in range(self.bands)
+        ]
+
+    def _similarity(self, left: np.ndarray, right: np.ndarray) -> float:
+        """Stima della similarità di Jaccard: frazione di valori MinHash uguali."""
+        return float(np.count_nonzero(left == right)) / self.num_perm
+
+    def find_duplicates(self, collection: str, point_ids: Sequence[str],
+                        signatures: Sequence[np.ndarray]) -> List[Optional[str]]:
+        """Per ogni chunk il point_id di un quasi-duplicato già presente, o None.
+
+        Il confronto avviene con i chunk indicizzati nella collection e con
+        quelli che precedono nella stessa lista (il primo di un gruppo resta).
+        """
+        result: List[Optional[str]] = []
+        accepted: Dict[Tuple[int, int], List[int]] = {}
+        with self._lock:
+            for row, (point_id, signature) in enumerate(zip(point_ids, signatures)):
+                keys = self._band_keys(signature)
+                duplicate = None
+
+                local = {j for band, key in enumerate(keys) for j in accepted.get((band, key), [])}
+                for j in sorted(local):
+                    if self._similarity(signature, signatures[j]) >= self.threshold:
+                        duplicate = str(point_ids[j])
+                        break
+
+                if duplicate is None:
+                    candidates = self._conn.execute(
+                        "SELECT DISTINCT s.point_id, s.signature FROM buckets b "
+                        "JOIN signatures s ON s.collection = b.collection AND s.point_id = b.point_id "
+                        f"WHERE b.collection = ? AND ({' OR '.join(['(b.band = ? AND b.bucket = ?)'] * len(keys))})",
+                        (collection, *[v for band, key in enumerate(keys) for v in (band, key)]),
+                    ).fetchall()
+                    for candidate_id, blob in candidates:
+                        if candidate_id == str(point_id):
+                            continue
+                        if self._similarity(signature, np.frombuffer(blob, dtype=np.uint32)) >= self.threshold:
+                            duplicate = candidate_id
+                            break
+
+                if duplicate is None:
+                    for band, key in enumerate(keys):
+                        accepted.setdefault((band, key), []).append(row)
+                result.append(duplicate)
+        return result
+
+    def add(self, collection: str, document_id: int, point_ids: Sequence[str],
+            signatures: Sequence[np.ndarray]) -> None:
+        signature_rows = []
+        bucket_rows = []
+        for point_id, signature in zip(point_ids, signatures):
+            signature_rows.append((collection, str(point_id), document_id,
+                                   np.asarray(signature, dtype=np.uint32).tobytes()))
+            bucket_rows.extend((collection, band, key, str(point_id))
+                               for band, key in enumerate(self._band_keys(signature)))
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO signatures (collection, point_id, document_id, signature) "
+                "VALUES (?, ?, ?, ?)",
+                signature_rows,
+            )
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO buckets (collection, band, bucket, point_id) VALUES (?, ?, ?, ?)",
+                bucket_rows,
+            )
+            self._conn.commit()
+
+    def set_duplicates(self, collection: str, document_id: int, total_chunks: int,
+                       pairs: Sequence[Tuple[str, str]]) -> None:
+        """Sostituisce i chunk scartati del documento con (point_id scartato, point_id che lo rappresenta)."""
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO documents (collection, document_id, total_chunks) VALUES (?, ?, ?)",
+                (collection, document_id, total_chunks),
+            )
+            self._conn.execute(
+                "DELETE FROM duplicates WHERE collection = ? AND document_id = ?",
+                (collection, document_id),
+            )
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO duplicates (collection, point_id, document_id, canonical_id) "
+                "VALUES (?, ?, ?, ?)",
+                [(collection, str(pid), document_id, str(canonical)) for pid, canonical in pairs],
+            )
+            self._conn.commit()
+
+    def orphaned_documents(self, collection: str) -> Set[int]:
+        """Documenti con chunk scartati il cui rappresentante non è più indicizzato."""
+        with self._lock:
+            return {int(row[0]) for row in self._conn.execute(
+                "SELECT DISTINCT d.document_id FROM duplicates d "
+                "LEFT JOIN signatures s ON s.collection = d.collection AND s.point_id = d.canonical_id "
+                "WHERE d.collection = ? AND s.point_id IS NULL",
+                (collection,),
+            )}
+
+    def document_chunks(self, collection: str) -> Dict[int, Tuple[int, int]]:
+        """document_id -> (chunk scartati come quasi-duplicati, chunk totali)."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT d.document_id, COUNT(x.point_id), d.total_chunks FROM documents d "
+                "LEFT JOIN duplicates x ON x.collection = d.collection AND x.document_id = d.document_id "
+                "WHERE d.collection = ? GROUP BY d.document_id, d.total_chunks",
+                (collection,),
+            ).fetchall()
+        return {int(document_id): (int(discarded), int(total)) for document_id, discarded, total in rows}
+
+    def _delete_points(self, collection: str, point_ids: Sequence[str]) -> None:
+        for i in range(0, len(point_ids), 500):
+            part = [str(pid) for pid in point_ids[i:i + 500]]
+            placeholders = ",".join("?" * len(part))
+            self._conn.execute(
+                f"DELETE FROM buckets WHERE collection = ? AND point_id IN ({placeholders})",
+                (collection, *part),
+            )
+            self._conn.execute(
+                f"DELETE FROM signatures WHERE collection = ? AND point_id IN ({placeholders})",
+                (collection, *part),
+            )
+
+    def remove_points(self, collection: str, point_ids: Sequence[str]) -> None:
+        with self._lock:
+            self._delete_points(collection, point_ids)
+            self._conn.commit()
+
+    def remove_document(self, collection: str, document_id: int) -> None:
+        with self._lock:
+            point_ids = [row[0] for row in self._conn.execute(
+                "SELECT point_id FROM signatures WHERE collection = ? AND document_id = ?",
+                (collection, document_id),
+            )]
+            self._delete_points(collection, point_ids)
+            self._conn.execute(
+                "DELETE FROM duplicates WHERE collection = ? AND document_id = ?",
+                (collection, document_id),
+            )
+            self._conn.execute(
+                "DELETE FROM documents WHERE collection = ? AND document_id = ?",
+                (collection, document_id),
+            )
+            self._conn.commit()
+
+    def drop_collection(self, collection: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM buckets WHERE collection = ?", (collection,))
+            self._conn.execute("DELETE FROM signatures WHERE collection = ?", (collection,))
+            self._conn.execute("DELETE FROM duplicates WHERE collection = ?", (collection,))
+            self._conn.execute("DELETE FROM documents WHERE collection = ?", (collection,))
+            self._conn.commit()
+
+    def collections(self) -> List[str]:
+        with self._lock:
+            return [row[0] for row in self._conn.execute("SELECT DISTINCT collection FROM signatures")]
+
+    def size(self, collection: str) -> int:
+        with self._lock:
+            return int(self._conn.execute(
+                "SELECT COUNT(*) FROM signatures WHERE collection = ?", (collection,)
+            ).fetchone()[0])
+
+    def close(self) -> None:
+        with self._lock:
+            try:
+                self._conn.close()
+            except Exception:
+                pass
@@ -0,0 +1,53 @@
+"""Piccolo archivio JSON di metadati RAG accanto a ./qdrant_db.
+
+Contiene informazioni costose da ricalcolare ma stabili, come la dimensione
+degli embedding per (provider, modello), così all'avvio non serve una
+chiamata di prova al servizio di embedding.
+"""
+from __future__ import annotations
+
+import json
+import os
+import threading
+from pathlib import Path
+from typing import Any, Dict
+
+
+class RAGMetadataStore:
+    def __init__(self, path: str):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._data: Dict[str, Dict[str, Any]] = self._load()
+
+    def _load(self) -> Dict[str, Dict[str, Any]]:
+        if not self.path.exists():
+            return {}
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            return data if isinstance(data, dict) else {}
+        except Exception as e:
+            print(f"[RAG] Metadati RAG illeggibili ({e}): li ricreo")
+            return {}
+
+    def _save(self) -> None:
+        tmp_path = self.path.with_suffix(".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._data, f, indent=2)
+        # Sostituzione atomica: un crash non lascia il file a metà
+        os.replace(tmp_path, self.path)
+
+    def get(self, section: str, key: str, default: Any = None) -> Any:
+        with self._lock:
+            return self._data.get(section, {}).get(key, default)
+
+    def set(self, section: str, key: str, value: Any) -> None:
+        with self._lock:
+            self._data.setdefault(section, {})[key] = value
+            self._save()
+
+    def delete(self, section: str, key: str) -> None:
+        with self._lock:
+            if self._data.get(section, {}).pop(key, None) is not None:
+                self._save()
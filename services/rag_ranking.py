@@ -0,0 +1,92 @@
+"""Fusione e riordinamento dei risultati di retrieval."""
+from __future__ import annotations
+
+from typing import Dict, Hashable, List, Sequence, Tuple
+
+import numpy as np
+
+
+def reciprocal_rank_fusion(rankings: Sequence[Sequence[Hashable]], k: int = 60,
+                           weights: Sequence[float] = None) -> List[Tuple[Hashable, float]]:
+    """Reciprocal rank fusion: somma di w / (k + rango) su tutte le liste.
+
+    Non richiede punteggi confrontabili (coseno e BM25 hanno scale diverse),
+    solo l'ordine dei risultati di ciascun retriever.
+    """
+    weights = weights or [1.0] * len(rankings)
+    fused: Dict[Hashable, float] = {}
+    for ranking, weight in zip(rankings, weights):
+        for rank, item in enumerate(ranking, start=1):
+            fused[item] = fused.get(item, 0.0) + weight / (k + rank)
+    return sorted(fused.items(), key=lambda item: item[1], reverse=True)
+
+
+def mmr_select(query_vector: np.ndarray, vectors: np.ndarray, k: int,
+               lambda_mult: float = 0.7, lengths: Sequence[int] = None,
+               char_budget: int = 0) -> List[int]:
+    """Maximal marginal relevance: indici scelti in ordine di selezione.
+
+    Ad ogni passo sceglie il candidato che massimizza
+    λ·sim(query, c) − (1−λ)·max sim(c, già scelti), tutto su matrici numpy.
+    Con `char_budget` > 0 i candidati che non entrano nel budget residuo
+    vengono saltati, così il contesto finale resta sotto il limite.
+    """
+    n = len(vectors)
+    if n == 0 or k <= 0:
+        return []
+
+    matrix = np.asarray(vectors, dtype=np.float32)
+    matrix = matrix / np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+    query = np.asarray(query_vector, dtype=np.float32)
+    query = query / max(float(np.linalg.norm(query)), 1e-12)
+
+    relevance = matrix @ query
+    similarity = matrix @ matrix.T
+    max_redundancy = np.full(n, -np.inf, dtype=np.float32)
+    available = np.ones(n, dtype=bool)
+    remaining_budget = char_budget if char_budget > 0 else None
+    sizes = np.asarray(lengths if lengths is not None else np.zeros(n), dtype=np.int64)
+
+    selected: List[int] = []
+    while len(selected) < k:
+        if remaining_budget is not None:
+            available &= sizes <= remaining_budget
+        if not available.any():
+            break
+        redundancy = np.where(np.isfinite(max_redundancy), max_redundancy, 0.0)
+        scores = lambda_mult * relevance - (1.0 - lambda_mult) * redundancy
+        scores[~available] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        available[best] = False
+        max_redundancy = np.maximum(max_redundancy, similarity[best])
+        if remaining_budget is not None:
+            remaining_budget -= int(sizes[best])
+    return selected
+
+
+def farthest_point_select(vectors: np.ndarray, k: int) -> List[int]:
+    """Selezione farthest-point (coseno): k indici che coprono lo spazio dei vettori.
+
+    Parte dal vettore più vicino al centroide (il chunk più "tipico") e poi
+    aggiunge ogni volta quello meno simile a tutti i già scelti. A differenza
+    di k-means è deterministica, costa O(n·k) e restituisce punti esistenti.
+    """
+    n = len(vectors)
+    if n == 0 or k <= 0:
+        return []
+
+    matrix = np.asarray(vectors, dtype=np.float32)
+    matrix = matrix / np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+    centroid = matrix.mean(axis=0)
+
+    first = int(np.argmax(matrix @ centroid))
+    selected = [first]
+    max_similarity = matrix @ matrix[first]
+    max_similarity[first] = np.inf
+    while len(selected) < min(k, n):
+        best = int(np.argmin(max_similarity))
+        selected.append(best)
+        max_similarity = np.maximum(max_similarity, matrix @ matrix[best])
+        max_similarity[selected] = np.inf
+    return selected
@@ -1,55 +1,227 @@
 from __future__ import annotations
 
+import hashlib
+import itertools
 import os
+import queue
+import re
+import threading
 import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-from typing import Any, Dict, List
+from typing import Any, Callable, Dict, Iterator, List, Set, Tuple
 import time
 
+import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
 from google import genai
-from qdrant_client import QdrantClient
-from qdrant_client.models import (Distance, FieldCondition, Filter, MatchValue,
-                                  PointStruct, VectorParams)
+from qdrant_client.models import (BinaryQuantization, BinaryQuantizationConfig,
+                                  Distance, FieldCondition, Filter, MatchValue,
+                                  PayloadSchemaType, PointIdsList, PointStruct,
+                                  QuantizationSearchParams, ScalarQuantization,
+                                  ScalarQuantizationConfig, ScalarType,
+                                  ScoredPoint, SearchParams, SearchRequest,
+                                  VectorParams)
+
+from config.env_loader import get_env_bool
+from services import chunker
+from services.bm25_index import BM25Index
+from services.document_text import DocumentTextResolver
+from services.embedding_cache import (CachedEmbeddingFunction, EmbeddingCache,
+                                      QueryEmbeddingCache)
+from services.embedding_report import format_report, recall_report
+from services.key_scheduler import get_key_scheduler
+from services.near_duplicates import NearDuplicateIndex
+from services.rag_metadata import RAGMetadataStore
+from services.rag_ranking import farthest_point_select, mmr_select, reciprocal_rank_fusion
+from services.rate_limiter import KeyRateLimiter, is_quota_error
+from services.result_cache import SearchResultCache
+from services.topic_clusters import TopicClusterIndex, lexical_terms
+from services.vector_store import create_vector_store
+
+try:
+    # Backend di embedding in-process opzionale (ONNX su CPU)
+    import onnxruntime as ort  # type: ignore
+    from tokenizers import Tokenizer  # type: ignore
+except Exception:  # pragma: no cover - nessun errore se mancano
+    ort = None  # type: ignore
+    Tokenizer = None  # type: ignore
+
+
+_CHUNK_ID_NAMESPACE = uuid.UUID("5d0b7c2e-8f43-4c1e-9a57-3b1f0e6d2a91")
+# Nome logico delle collection per materia: subject_{id}_{nome}
+_SUBJECT_COLLECTION_RE = re.compile(r"^subject_(\d+)_")
+
+
+def chunk_point_id(document_id: int, chunk: str) -> str:
+    """ID Qdrant deterministico per (documento, hash del contenuto del chunk)."""
+    digest = hashlib.sha256(chunk.encode("utf-8")).hexdigest()
+    return str(uuid.uuid5(_CHUNK_ID_NAMESPACE, f"{document_id}:{digest}"))
+
+
+def _empty_embeddings(n: int, dim: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+    return np.zeros((n, dim), dtype=np.float32), np.zeros(n, dtype=bool)
+
+
+def _rows_to_matrix(rows: List[Any]) -> Tuple[np.ndarray, np.ndarray]:
+    """Converte una lista di vettori (None = fallito) in matrice float32 + maschera."""
+    mask = np.fromiter((r is not None and len(r) > 0 for r in rows), dtype=bool, count=len(rows))
+    if not mask.any():
+        return _empty_embeddings(len(rows))
+    if mask.all():
+        return np.asarray(rows, dtype=np.float32), mask
+    dim = len(rows[int(np.argmax(mask))])
+    matrix = np.zeros((len(rows), dim), dtype=np.float32)
+    valid = np.flatnonzero(mask)
+    matrix[valid] = np.asarray([rows[i] for i in valid], dtype=np.float32)
+    return matrix, mask
+
+
+def _stack_batches(n: int, starts: List[int],
+                   results: List[Tuple[np.ndarray, np.ndarray]]) -> Tuple[np.ndarray, np.ndarray]:
+    """Copia i risultati dei sotto-batch in un'unica matrice contigua (n, d)."""
+    dim = next((m.shape[1] for m, ok in results if ok.any()), 0)
+    matrix, mask = _empty_embeddings(n, dim)
+    for start, (batch_matrix, batch_mask) in zip(starts, results):
+        if not batch_mask.any() or batch_matrix.shape[1] != dim:
+            continue
+        end = start + len(batch_mask)
+        matrix[start:end][batch_mask] = batch_matrix[batch_mask]
+        mask[start:end] = batch_mask
+    return matrix, mask
 
 
 class OllamaEmbeddingFunction:
+    provider = "ollama"
+
     def __init__(self, base_url: str = "http://127.0.0.1:11434/v1",
                  model: str = "nomic-embed-text:latest",
-                 api_key: str | None = None):
+                 api_key: str | None = None,
+                 batch_size: int = 32,
+                 batch_chars: int = 24000,
+                 max_workers: int = 4,
+                 max_retries: int = 3,
+                 timeout: float = 120):
         self.base_url = base_url.rstrip("/")
         self.model_name = model
         self._headers = {"Content-Type": "application/json"}
         if api_key:
             self._headers["Authorization"] = f"Bearer {api_key}"
 
-    def embed(self, texts: List[str]) -> List[List[float]]:
-        if not texts:
-            return []
+        self.batch_size = max(1, batch_size)
+        self.batch_chars = max(1, batch_chars)
+        self.max_workers = max(1, max_workers)
+        self.max_retries = max(1, max_retries)
+        self.timeout = timeout
+
+        # Sessione keep-alive condivisa dai thread del pool
+        self._session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=self.max_workers
+        )
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        self._session.headers.update(self._headers)
+
+        self.last_batch_stats: List[Dict[str, Any]] = []
+
+    @property
+    def embedding_id(self) -> str:
+        return self.model_name
+
+    def _make_batches(self, texts: List[str]) -> List[Tuple[int, List[str]]]:
+        """Divide i testi in sotto-batch limitati per numero e per caratteri totali."""
+        batches = []
+        start = 0
+        current: List[str] = []
+        current_chars = 0
+        for i, text in enumerate(texts):
+            if current and (len(current) >= self.batch_size
+                            or current_chars + len(text) > self.batch_chars):
+                batches.append((start, current))
+                start, current, current_chars = i, [], 0
+            current.append(text)
+            current_chars += len(text)
+        if current:
+            batches.append((start, current))
+        return batches
+
+    def _post_batch(self, batch: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+        for attempt in range(self.max_retries):
+            try:
+                resp = self._session.post(
+                    f"{self.base_url}/embeddings",
+                    json={"model": self.model_name, "input": batch},
+                    timeout=self.timeout,
+                )
+                resp.raise_for_status()
+                data = resp.json()
+
+                rows: List[Any] = [None] * len(batch)
+                for j, item in enumerate(data.get("data", [])):
+                    emb = item.get("embedding")
+                    if isinstance(emb, dict):
+                        emb = emb.get("values")
+                    index = item.get("index", j)
+                    if emb and 0 <= index < len(batch):
+                        rows[index] = emb
+                return _rows_to_matrix(rows)
+            except requests.exceptions.ConnectionError:
+                # Server non raggiungibile: inutile riprovare gli altri batch
+                raise
+            except requests.exceptions.RequestException as e:
+                status = e.response.status_code if e.response is not None else None
+                if status is not None and 400 <= status < 500 and status != 429:
+                    # Modello assente, input non valido...: un nuovo tentativo non cambia nulla
+                    raise
+                if attempt == self.max_retries - 1:
+                    raise
+                wait_time = 2 ** attempt
+                print(f"[RAG] Batch Ollama fallito ({e}). Riprovo tra {wait_time}s "
+                      f"(Tentativo {attempt + 1}/{self.max_retries})")
+                time.sleep(wait_time)
+        return _rows_to_matrix([None] * len(batch))
+
+    def _embed_batch(self, index: int, batch: List[str]) -> Tuple[Tuple[np.ndarray, np.ndarray], Dict[str, Any]]:
+        started = time.perf_counter()
+        result = self._post_batch(batch)
+        latency = time.perf_counter() - started
+        return result, {
+            "batch": index,
+            "texts": len(batch),
+            "chars": sum(len(t) for t in batch),
+            "latency_s": latency,
+        }
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        return self.embed_with_mask(texts)[0]
+
+    def embed_with_mask(self, texts: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """Ritorna una matrice float32 (n, d) e la maschera dei testi embeddati con successo."""
         if isinstance(texts, str):
             texts = [texts]
+        if not texts:
+            return _empty_embeddings(0)
+
+        batches = self._make_batches(texts)
+        results: List[Tuple[np.ndarray, np.ndarray]] = [None] * len(batches)
+        stats: List[Dict[str, Any]] = [{} for _ in batches]
+        started = time.perf_counter()
 
         try:
-            resp = requests.post(
-                f"{self.base_url}/embeddings",
-                headers=self._headers,
-                json={"model": self.model_name, "input": texts},
-                timeout=120,
-            )
-            resp.raise_for_status()
-            data = resp.json()
-            embeddings = [item.get("embedding") for item in data.get("data", [])]
-            
-            out = []
-            for emb in embeddings:
-                if emb is None:
-                    continue
-                try:
-                    out.append([float(x) for x in emb])
-                except Exception:
-                    vals = emb.get("values") if isinstance(emb, dict) else None
-                    out.append([float(x) for x in (vals or [])])
-            return out
+            if len(batches) == 1:
+                results[0], stats[0] = self._embed_batch(0, batches[0][1])
+            else:
+                workers = min(self.max_workers, len(batches))
+                with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ollama-embed") as pool:
+                    futures = {
+                        pool.submit(self._embed_batch, idx, batch): idx
+                        for idx, (_, batch) in enumerate(batches)
+                    }
+                    for future in as_completed(futures):
+                        idx = futures[future]
+                        results[idx], stats[idx] = future.result()
         except requests.exceptions.ConnectionError as e:
             raise ConnectionError(
                 f"Impossibile connettersi a Ollama su {self.base_url}. "
@@ -58,12 +230,141 @@ class OllamaEmbeddingFunction:
         except requests.exceptions.RequestException as e:
             raise RuntimeError(f"Errore durante la richiesta di embedding a Ollama: {e}") from e
 
+        self.last_batch_stats = stats
+        if len(batches) > 1:
+            elapsed = time.perf_counter() - started
+            latencies = [s["latency_s"] for s in stats]
+            print(f"[RAG] Ollama: {len(texts)} testi in {len(batches)} batch "
+                  f"({min(self.max_workers, len(batches))} in parallelo) in {elapsed:.2f}s - "
+                  f"latenza batch media {sum(latencies) / len(latencies):.2f}s, max {max(latencies):.2f}s")
+
+        # Ricomposizione nell'ordine di input
+        return _stack_batches(len(texts), [start for start, _ in batches], results)
+
+
+
+class OnnxEmbeddingFunction:
+    """Modello sentence-embedding ONNX eseguito in-process su CPU.
+
+    La cartella del modello deve contenere `model.onnx` (o `onnx/model.onnx`) e
+    `tokenizer.json`, ad esempio un export di sentence-transformers/all-MiniLM-L6-v2.
+    """
+    provider = "onnx"
+
+    def __init__(self, model_dir: str, batch_size: int = 64,
+                 num_threads: int | None = None, max_length: int = 256):
+        if ort is None or Tokenizer is None:
+            raise RuntimeError(
+                "Embedding ONNX non disponibile: installa 'onnxruntime' e 'tokenizers' "
+                "(pip install onnxruntime tokenizers)."
+            )
+
+        model_path = Path(model_dir)
+        onnx_file = model_path / "model.onnx"
+        if not onnx_file.exists():
+            onnx_file = model_path / "onnx" / "model.onnx"
+        tokenizer_file = model_path / "tokenizer.json"
+        if not onnx_file.exists() or not tokenizer_file.exists():
+            raise RuntimeError(
+                f"Modello ONNX non trovato in {model_dir}: servono model.onnx e tokenizer.json"
+            )
+
+        self.model_name = model_path.resolve().name
+        self.batch_size = max(1, batch_size)
+
+        self._tokenizer = Tokenizer.from_file(str(tokenizer_file))
+        self._tokenizer.enable_truncation(max_length=max_length)
+        self._tokenizer.enable_padding()
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = num_threads or os.cpu_count() or 1
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self._session = ort.InferenceSession(
+            str(onnx_file), sess_options=options, providers=["CPUExecutionProvider"]
+        )
+        self._input_names = {i.name for i in self._session.get_inputs()}
+        output_names = [o.name for o in self._session.get_outputs()]
+        # Alcuni export includono già il pooling
+        self._pooled_output = "sentence_embedding" if "sentence_embedding" in output_names else None
+
+        print(f"[RAG] OnnxEmbeddingFunction: {self.model_name} "
+              f"({options.intra_op_num_threads} thread, batch {self.batch_size})")
+
+    @property
+    def embedding_id(self) -> str:
+        return self.model_name
+
+    def _run_batch(self, batch: List[str]) -> np.ndarray:
+        encodings = self._tokenizer.encode_batch(batch)
+        input_ids = np.asarray([e.ids for e in encodings], dtype=np.int64)
+        attention_mask = np.asarray([e.attention_mask for e in encodings], dtype=np.int64)
+        feeds = {"input_ids": input_ids, "attention_mask": attention_mask}
+        if "token_type_ids" in self._input_names:
+            feeds["token_type_ids"] = np.zeros_like(input_ids)
+        feeds = {k: v for k, v in feeds.items() if k in self._input_names}
+
+        if self._pooled_output:
+            pooled = self._session.run([self._pooled_output], feeds)[0]
+        else:
+            # Mean pooling sui token reali
+            hidden = self._session.run(None, feeds)[0]
+            weights = attention_mask[:, :, None].astype(np.float32)
+            pooled = (hidden * weights).sum(axis=1) / np.clip(weights.sum(axis=1), 1e-9, None)
+
+        pooled = np.asarray(pooled, dtype=np.float32)
+        norms = np.linalg.norm(pooled, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return pooled / norms
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        return self.embed_with_mask(texts)[0]
+
+    def embed_with_mask(self, texts: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+        if isinstance(texts, str):
+            texts = [texts]
+        if not texts:
+            return _empty_embeddings(0)
+
+        # Ordina per lunghezza: batch omogenei riducono il padding
+        order = sorted((i for i, t in enumerate(texts) if t and t.strip()),
+                       key=lambda i: len(texts[i]))
+        matrix = None
+        mask = np.zeros(len(texts), dtype=bool)
+        for start in range(0, len(order), self.batch_size):
+            idx = order[start:start + self.batch_size]
+            try:
+                vectors = self._run_batch([texts[i] for i in idx])
+            except Exception as e:
+                print(f"[RAG] Errore inferenza ONNX su batch da {len(idx)} testi: {e}")
+                continue
+            if matrix is None:
+                matrix = np.zeros((len(texts), vectors.shape[1]), dtype=np.float32)
+            matrix[idx] = vectors
+            mask[idx] = True
+
+        if matrix is None:
+            return _empty_embeddings(len(texts))
+        return matrix, mask
+
 
 
 class GeminiEmbeddingFunction:
-    def __init__(self, api_keys: List[str] | str, model: str = "gemini-embedding-001"):
+    provider = "gemini"
+
+    MAX_BATCH_SIZE = 100
+
+    def __init__(self, api_keys: List[str] | str, model: str = "gemini-embedding-001",
+                 rpm_per_key: float = 100, tpm_per_key: float = 30000,
+                 max_retries: int = 5, output_dim: int | None = None):
         """
-        Initialize GeminiEmbeddingFunction with one or multiple API keys for round-robin usage.
+        Initialize GeminiEmbeddingFunction with one or multiple API keys.
+
+        Batches are dispatched concurrently, one worker per key; every batch is sent
+        on the healthiest key picked by the shared scheduler, and each key has its
+        own RPM/TPM token buckets so a 429 only slows down the key that received it.
+
+        With `output_dim` set, vectors are truncated Matryoshka-style to that size
+        and renormalized, so collections store much smaller vectors.
         """
         if isinstance(api_keys, str):
             self.api_keys = [api_keys]
@@ -73,168 +374,215 @@ class GeminiEmbeddingFunction:
         if not self.api_keys:
             raise ValueError("Almeno una chiave API Gemini valida deve essere fornita")
 
-        # Create a pool of clients
+        # Create a pool of clients, each with its own rate limiter
         self.clients = [genai.Client(api_key=k) for k in self.api_keys]
-        self.current_client_index = 0
+        self.limiters = [KeyRateLimiter(rpm_per_key, tpm_per_key) for _ in self.clients]
+        self._key_index = {k: i for i, k in enumerate(self.api_keys)}
+        self.max_retries = max_retries
+        self.output_dim = output_dim or None
+        # Cooldown e salute delle chiavi condivisi con AIService
+        self.scheduler = get_key_scheduler()
+        self.scheduler.register(self.api_keys)
         
         if not model.startswith("models/"):
             self.model_name = f"models/{model}"
         else:
             self.model_name = model
             
-        print(f"[RAG] GeminiEmbeddingFunction inizializzata con {len(self.clients)} chiavi API")
+        print(f"[RAG] GeminiEmbeddingFunction inizializzata con {len(self.clients)} chiavi API "
+              f"({rpm_per_key:g} RPM / {tpm_per_key:g} TPM per chiave)")
 
-    def _get_next_client(self):
-        """Returns the next client in the rotation"""
-        client = self.clients[self.current_client_index]
-        self.current_client_index = (self.current_client_index + 1) % len(self.clients)
-        return client
+    @property
+    def embedding_id(self) -> str:
+        # I vettori troncati non sono intercambiabili con quelli a piena dimensione
+        if self.output_dim:
+            return f"{self.model_name}@{self.output_dim}"
+        return self.model_name
 
-    def embed(self, texts: List[str]) -> List[List[float]]:
-        if not texts:
-            return []
-        
-        if isinstance(texts, str):
-            texts = [texts]
+    def _truncate(self, matrix: np.ndarray, mask: np.ndarray) -> np.ndarray:
+        if not self.output_dim or matrix.shape[1] == 0:
+            return matrix
+        matrix = np.ascontiguousarray(matrix[:, :self.output_dim])
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[~mask] = 1.0
+        norms[norms == 0] = 1.0
+        matrix /= norms
+        return matrix
 
-        print(f"[DEBUG] Embedding {len(texts)} testi con Gemini (Round Robin)...")
-        
-        valid_texts_map = {}
-        for i, text in enumerate(texts):
-            if text and text.strip():
-                valid_texts_map[i] = text
-        
-        batchable_texts = list(valid_texts_map.values())
-        
-        if not batchable_texts:
-            print("[DEBUG] Nessun testo valido. Ritorno vettori di zeri.")
-            return [[0.0] * 768] * len(texts)
+    @staticmethod
+    def _estimate_tokens(texts: List[str]) -> int:
+        return sum(len(t) for t in texts) // 4 + 1
 
-        MAX_BATCH_SIZE = 100
-        valid_embeddings_map = {}
-        
-        def _call_api_with_retry(func, *args, **kwargs):
-            max_retries = 5
-            base_delay = 2
-            
-            # Use current client first, then iterate others if needed
-            # Or just rotate on every call? 
-            # Better: rotate only on error? No, User wants Round Robin for Rate Limits.
-            # So rotate on every batch/call.
-            
-            # We must get a client. But here we are inside a helper.
-            # Let's pass client from outside loop or get it here?
-            # Ideally we pick a client for the attempt.
-            
-            for attempt in range(max_retries):
-                # Pick a client (Round Robin)
-                current_client = self._get_next_client()
-                
-                try:
-                    # func is expected to be bound to a client, but here we change client.
-                    # So we cannot pass client.models.embed_content as func.
-                    # We should pass just the method name or use the client directly.
-                    return current_client.models.embed_content(*args, **kwargs)
-                except Exception as e:
-                    is_quota = "429" in str(e) or "RESOURCE_EXHAUSTED" in str(e) or "quota" in str(e).lower()
-                    if is_quota and attempt < max_retries - 1:
-                        wait_time = base_delay * (2 ** attempt)
-                        print(f"[RAG] Quota superata con chiave {self.current_client_index-1}. Riprovo tra {wait_time}s con altra chiave... (Tentativo {attempt+1}/{max_retries})")
-                        time.sleep(wait_time)
-                    else:
-                        raise e
+    @staticmethod
+    def _extract_values(e) -> Any:
+        if e is None:
+            return None
+        values = getattr(e, "values", None)
+        if values is None and isinstance(e, dict):
+            values = e.get("values") or e.get("embedding", {}).get("values")
+        if values is None and isinstance(e, (list, tuple)):
+            values = e
+        return values
 
+    def _embed_with_client(self, contents) -> Any:
+        """Una chiamata embed_content sulla chiave più sana scelta dallo scheduler."""
+        texts = [contents] if isinstance(contents, str) else contents
+        config = {"output_dimensionality": self.output_dim} if self.output_dim else None
+        key = self.scheduler.acquire(self.api_keys)
+        key_index = self._key_index[key]
         try:
-            for i in range(0, len(batchable_texts), MAX_BATCH_SIZE):
-                batch_texts = batchable_texts[i:i + MAX_BATCH_SIZE]
-                
-                print(f"[DEBUG] Batch {i//MAX_BATCH_SIZE + 1}/{(len(batchable_texts)-1)//MAX_BATCH_SIZE + 1}")
-                
+            self.limiters[key_index].acquire(self._estimate_tokens(texts))
+            # La latenza registrata non include l'attesa del rate limiter locale
+            started = time.perf_counter()
+            res = self.clients[key_index].models.embed_content(
+                model=self.model_name,
+                contents=contents,
+                config=config,
+            )
+        except Exception as e:
+            self.scheduler.release(key, error=e)
+            if is_quota_error(e):
+                self.limiters[key_index].drain()
+            raise
+        self.scheduler.release(key, latency=time.perf_counter() - started)
+        return res
+
+    def _embed_batch_single(self, batch_texts: List[str]) -> List[Any]:
+        """Fallback: una chiamata per testo."""
+        batch_embeddings = []
+        for t in batch_texts:
+            try:
+                single = self._embed_with_client(t)
+                emb_obj = getattr(single, "embedding", None)
+                if emb_obj is None:
+                    embeddings_attr = getattr(single, "embeddings", None) or []
+                    emb_obj = embeddings_attr[0] if embeddings_attr else None
+                if emb_obj is None and isinstance(single, dict):
+                    emb_obj = single.get("embedding")
+                batch_embeddings.append(self._extract_values(emb_obj))
+            except Exception as inner_e:
+                print(f"[DEBUG] Errore embedding singolo: {inner_e}")
+                batch_embeddings.append(None)
+        return batch_embeddings
+
+    def _embed_worker(self, work: "queue.Queue",
+                      results: Dict[int, Tuple[np.ndarray, np.ndarray]],
+                      state: Dict[str, int], state_lock: threading.Lock,
+                      done: threading.Event) -> None:
+        while not done.is_set():
+            try:
+                batch_index, batch_texts, attempt = work.get(timeout=0.2)
+            except queue.Empty:
+                continue
+
+            requeued = False
+            try:
                 try:
-                    res = _call_api_with_retry(
-                        None, # dummy func
-                        model=self.model_name,
-                        contents=batch_texts,
-                    )
+                    res = self._embed_with_client(batch_texts)
                 except Exception as e:
-                    print(f"[DEBUG] Errore batch ({e}), passo a fallback singolo...")
-                    # Fallback: una chiamata per testo
-                    batch_embeddings = []
-                    for t in batch_texts:
-                        try:
-                            single = _call_api_with_retry(
-                                None,
-                                model=self.model_name,
-                                contents=t,
-                            )
-                            emb_obj = getattr(single, "embedding", None)
-                            values = getattr(emb_obj, "values", None) if emb_obj is not None else None
-                            if values is None and isinstance(single, dict):
-                                values = single.get("embedding", {}).get("values")
-                            batch_embeddings.append([float(x) for x in (values or [])])
-                        except Exception as inner_e:
-                            print(f"[DEBUG] Errore embedding singolo: {inner_e}")
-                            batch_embeddings.append(None)
-                    
-                    for j, emb in enumerate(batch_embeddings):
-                        valid_embeddings_map[i + j] = emb
-                    continue
-                
-                # Normalizza il risultato
-                embeddings_attr = getattr(res, "embeddings", None)
-                if embeddings_attr is None:
-                    emb_obj = getattr(res, "embedding", None)
-                    embeddings_attr = [emb_obj] if emb_obj is not None else []
-                
-                batch_embeddings = []
-                for e in embeddings_attr:
-                    if e is None:
-                        batch_embeddings.append(None)
+                    if is_quota_error(e) and attempt < self.max_retries - 1:
+                        # La chiave è in cooldown: lo scheduler assegna il batch a un'altra
+                        print(f"[RAG] Quota superata. Batch {batch_index} "
+                              f"riassegnato (Tentativo {attempt + 1}/{self.max_retries})")
+                        work.put((batch_index, batch_texts, attempt + 1))
+                        requeued = True
                         continue
-                    values = getattr(e, "values", None)
-                    if values is None and isinstance(e, dict):
-                        values = e.get("values")
-                    if values is None and isinstance(e, (list, tuple)):
-                        values = e
-                    if values is None:
-                        batch_embeddings.append(None)
-                    else:
-                        batch_embeddings.append([float(x) for x in values])
-                
-                for j, emb in enumerate(batch_embeddings):
-                    valid_embeddings_map[i + j] = emb
+                    print(f"[DEBUG] Errore batch {batch_index} ({e}), passo a fallback singolo...")
+                    batch_embeddings = self._embed_batch_single(batch_texts)
+                else:
+                    try:
+                        embeddings_attr = getattr(res, "embeddings", None)
+                        if embeddings_attr is None:
+                            emb_obj = getattr(res, "embedding", None)
+                            embeddings_attr = [emb_obj] if emb_obj is not None else []
+                        batch_embeddings = [self._extract_values(e) for e in embeddings_attr]
+                    except Exception as e:
+                        print(f"[DEBUG] Risposta batch {batch_index} non valida: {e}")
+                        batch_embeddings = []
+
+                batch_embeddings = list(batch_embeddings[:len(batch_texts)])
+                batch_embeddings += [None] * (len(batch_texts) - len(batch_embeddings))
+                results[batch_index] = _rows_to_matrix(batch_embeddings)
+            except Exception as e:
+                print(f"[DEBUG] Batch {batch_index} fallito: {e}")
+                results[batch_index] = _empty_embeddings(len(batch_texts))
+            finally:
+                work.task_done()
+                # Senza questo un errore imprevisto lascerebbe embed_with_mask in attesa per sempre
+                if not requeued:
+                    with state_lock:
+                        state["pending"] -= 1
+                        if state["pending"] <= 0:
+                            done.set()
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        return self.embed_with_mask(texts)[0]
+
+    def embed_with_mask(self, texts: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """Ritorna una matrice float32 (n, d) e la maschera dei testi embeddati con successo."""
+        if isinstance(texts, str):
+            texts = [texts]
+        if not texts:
+            return _empty_embeddings(0)
+
+        valid_indices = np.fromiter(
+            (i for i, text in enumerate(texts) if text and text.strip()), dtype=np.int64
+        )
+        batchable_texts = [texts[i] for i in valid_indices]
+        
+        if not batchable_texts:
+            print("[DEBUG] Nessun testo valido da embeddare.")
+            return _empty_embeddings(len(texts))
+
+        batches = [
+            batchable_texts[i:i + self.MAX_BATCH_SIZE]
+            for i in range(0, len(batchable_texts), self.MAX_BATCH_SIZE)
+        ]
+        workers = min(len(self.clients), len(batches))
+        print(f"[DEBUG] Embedding {len(texts)} testi con Gemini: {len(batches)} batch su {workers} chiavi in parallelo...")
+
+        work: "queue.Queue" = queue.Queue()
+        for batch_index, batch_texts in enumerate(batches):
+            work.put((batch_index, batch_texts, 0))
+
+        results: Dict[int, Tuple[np.ndarray, np.ndarray]] = {}
+        state = {"pending": len(batches)}
+        state_lock = threading.Lock()
+        done = threading.Event()
 
+        threads = [
+            threading.Thread(
+                target=self._embed_worker,
+                args=(work, results, state, state_lock, done),
+                name=f"gemini-embed-{n}",
+                daemon=True,
+            )
+            for n in range(workers)
+        ]
+        try:
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
         except Exception as e:
             print(f"ERRORE API: {e}")
             import traceback
             traceback.print_exc()
-        
-        # Ricostruisci lista finale
-        embedding_dim = 768
-        for emb in valid_embeddings_map.values():
-            if emb is not None:
-                embedding_dim = len(emb)
-                break
-
-        zero_vector = [0.0] * embedding_dim
-        final_embeddings = []
-        
-        reconstructed_map = {}
-        valid_indices_list = list(valid_texts_map.keys())
-        
-        for i, emb in valid_embeddings_map.items():
-            original_index = valid_indices_list[i]
-            reconstructed_map[original_index] = emb
-
-        for i in range(len(texts)):
-            emb = reconstructed_map.get(i)
-            if emb is not None:
-                final_embeddings.append(emb)
-            else:
-                final_embeddings.append(zero_vector)
 
-        print(f"[DEBUG] Embedding completato. {len(final_embeddings)} vettori.")
-        return final_embeddings
+        # Ricostruisci la matrice finale nell'ordine di input
+        starts = list(range(0, len(batchable_texts), self.MAX_BATCH_SIZE))
+        batch_results = [
+            results.get(i) or _empty_embeddings(len(b)) for i, b in enumerate(batches)
+        ]
+        valid_matrix, valid_mask = _stack_batches(len(batchable_texts), starts, batch_results)
+
+        valid_matrix = self._truncate(valid_matrix, valid_mask)
+        matrix, mask = _empty_embeddings(len(texts), valid_matrix.shape[1])
+        matrix[valid_indices] = valid_matrix
+        mask[valid_indices] = valid_mask
+
+        print(f"[DEBUG] Embedding completato. {int(mask.sum())}/{len(texts)} vettori.")
+        return matrix, mask
 
 
 
@@ -255,9 +603,10 @@ class RAGService:
             
         print(f"[RAG] Inizializzazione RAGService con persist_directory: {persist_directory}")
         self.persist_directory = persist_directory
-        Path(persist_directory).mkdir(parents=True, exist_ok=True)
         
-        self.client = QdrantClient(path=persist_directory)
+        # Qdrant embedded su persist_directory, server Qdrant (QDRANT_URL)
+        # o vector store piatto (RAG_VECTOR_STORE=flat)
+        self.client = create_vector_store(persist_directory)
         self._initialized = True
         
         self.use_local_llm = os.getenv("USE_LOCAL_LLM", "true").lower() == "true"
@@ -265,6 +614,9 @@ class RAGService:
         self.chunk_size = int(os.getenv("RAG_CHUNK_SIZE", "800"))
         self.chunk_overlap = int(os.getenv("RAG_CHUNK_OVERLAP", "100"))
         self.chunks_per_topic = int(os.getenv("RAG_CHUNKS_PER_TOPIC", "15"))
+        # Indicizzazione a batch: embedding del batch N+1 in parallelo all'upsert del batch N
+        self.index_batch_size = max(1, int(os.getenv("RAG_INDEX_BATCH_SIZE", "256")))
+        self.index_pipeline = get_env_bool("RAG_INDEX_PIPELINE", default=True)
         
         try:
             self.score_threshold = float(os.getenv("RAG_SCORE_THRESHOLD", "0.25"))
@@ -273,10 +625,46 @@ class RAGService:
 
         print(f"[RAG CONFIG] Chunk size: {self.chunk_size}, Overlap: {self.chunk_overlap}, Chunks per topic: {self.chunks_per_topic}")
         print(f"[RAG CONFIG] Score threshold: {self.score_threshold}")
+
+        # Quantizzazione dei vettori salvati: none | int8 | binary (rescoring a precisione piena)
+        self.quantization = os.getenv("RAG_QUANTIZATION", "none").strip().lower()
+        if self.quantization not in ("none", "int8", "binary"):
+            print(f"[RAG] RAG_QUANTIZATION '{self.quantization}' non valida: uso 'none'")
+            self.quantization = "none"
+        self.quantization_oversampling = float(os.getenv("RAG_QUANTIZATION_OVERSAMPLING", "2.0"))
+        if self.quantization != "none":
+            print(f"[RAG CONFIG] Quantizzazione: {self.quantization} "
+                  f"(oversampling {self.quantization_oversampling})")
             
-        if self.use_local_llm:
+        # Layout: per_subject (una collection per materia) | shared (una per modello, filtro subject_id)
+        self.collection_layout = os.getenv("RAG_COLLECTION_LAYOUT", "per_subject").strip().lower()
+        if self.collection_layout not in ("per_subject", "shared"):
+            print(f"[RAG] RAG_COLLECTION_LAYOUT '{self.collection_layout}' non valido: uso 'per_subject'")
+            self.collection_layout = "per_subject"
+        if self.collection_layout == "shared":
+            print("[RAG CONFIG] Layout collection: condiviso (filtro per subject_id)")
+            
+        # Provider di embedding: ollama | gemini | onnx (default in base a USE_LOCAL_LLM)
+        default_provider = "ollama" if self.use_local_llm else "gemini"
+        self.embedding_provider = os.getenv("EMBEDDING_PROVIDER", "").strip().lower() or default_provider
+        if self.embedding_provider not in ("ollama", "gemini", "onnx"):
+            print(f"[RAG] EMBEDDING_PROVIDER '{self.embedding_provider}' non valido: uso '{default_provider}'")
+            self.embedding_provider = default_provider
+
+        if self.embedding_provider == "onnx":
+            self.onnx_model_dir = os.getenv("LOCAL_EMBED_MODEL_DIR", "./models/all-MiniLM-L6-v2")
+            self.onnx_batch_size = int(os.getenv("LOCAL_EMBED_BATCH_SIZE", "64"))
+            self.onnx_threads = int(os.getenv("LOCAL_EMBED_THREADS", "0")) or None
+        elif self.embedding_provider == "ollama":
             self.local_base_url = os.getenv("LOCAL_LLM_BASE_URL", "http://127.0.0.1:11434/v1")
             self.local_model = os.getenv("EMBEDDING_MODEL", "nomic-embed-text:latest")
+            # Sotto-batch paralleli: di default tanti worker quanti OLLAMA_NUM_PARALLEL
+            self.ollama_batch_size = int(os.getenv("OLLAMA_EMBED_BATCH_SIZE", "32"))
+            self.ollama_batch_chars = int(os.getenv("OLLAMA_EMBED_BATCH_CHARS", "24000"))
+            self.ollama_workers = int(os.getenv("OLLAMA_EMBED_WORKERS",
+                                                os.getenv("OLLAMA_NUM_PARALLEL", "4")))
+            print(f"[RAG CONFIG] Ollama embedding batch: {self.ollama_batch_size} testi / "
+                  f"{self.ollama_batch_chars} caratteri, {self.ollama_workers} worker")
         else:
             # Raccogli tutte le chiavi disponibili per il round-robin
             self.gemini_api_keys = []
@@ -301,28 +689,167 @@ class RAGService:
                  print(f"[RAG] Trovate {len(self.gemini_api_keys)} chiavi API per embedding")
             
             self.gemini_embed_model = "gemini-embedding-001"
+            # Quote per singola chiave (free tier gemini-embedding-001)
+            self.gemini_embed_rpm = float(os.getenv("GEMINI_EMBED_RPM", "100"))
+            self.gemini_embed_tpm = float(os.getenv("GEMINI_EMBED_TPM", "30000"))
+            # Opzionale: troncamento Matryoshka (es. 256 o 768) invece della dimensione piena
+            self.gemini_embed_dim = int(os.getenv("GEMINI_EMBED_DIM", "0")) or None
         
+        # Cache persistente degli embedding (accanto a ./qdrant_db)
+        self.cache_directory = os.getenv(
+            "RAG_CACHE_DIR",
+            str(Path(persist_directory).resolve().parent / "rag_cache"),
+        )
+        self.metadata = RAGMetadataStore(str(Path(self.cache_directory) / "rag_meta.json"))
+        self.use_embedding_cache = get_env_bool("RAG_EMBED_CACHE", default=True)
+        self.embedding_cache = None
+        if self.use_embedding_cache:
+            max_mb = int(os.getenv("RAG_EMBED_CACHE_MAX_MB", "512"))
+            self.embedding_cache = EmbeddingCache(
+                str(Path(self.cache_directory) / "embeddings.sqlite3"),
+                max_bytes=max_mb * 1024 * 1024,
+            )
+            print(f"[RAG CONFIG] Embedding cache: {self.cache_directory} (max {max_mb} MB)")
+
         self.embedder = self._create_embedding_function()
+
+        # LRU delle query: i topic si ripetono fra una generazione e l'altra.
+        # Con RAG_QUERY_CACHE_DISK=true i miss passano anche dalla cache su disco.
+        self.query_cache = QueryEmbeddingCache(int(os.getenv("RAG_QUERY_CACHE_SIZE", "512")))
+        self.query_cache_disk = get_env_bool("RAG_QUERY_CACHE_DISK", default=True)
         
         self._embedding_dim = None
+        # collection -> document_id con tutti i chunk indicizzati (riempito con uno scroll)
+        self._indexed_documents: Dict[str, Set[int]] = {}
+        # In modalità locale payload_schema resta vuoto: evita di ripetere la richiesta
+        self._payload_indexed: Set[str] = set()
+        # Versione per collection logica, monotona anche fra eliminazione e ricreazione
+        # (orologio unico di processo): invalida la cache dei risultati di ricerca
+        self._collection_versions: Dict[str, int] = {}
+        self._version_clock = itertools.count(1)
+        result_cache_size = int(os.getenv("RAG_RESULT_CACHE_SIZE", "256"))
+        self.result_cache = SearchResultCache(result_cache_size) if result_cache_size > 0 else None
+        # Registro in memoria: nome -> {dim, points, embedding_model, version}
+        self._collections: Dict[str, Dict[str, Any]] | None = None
+
+        # Layout del payload: text (testo nel payload) | offsets (solo offset,
+        # testo ritagliato al volo dal contenuto del documento in SQLite)
+        self.payload_layout = os.getenv("RAG_PAYLOAD_LAYOUT", "text").strip().lower()
+        if self.payload_layout not in ("text", "offsets"):
+            print(f"[RAG] RAG_PAYLOAD_LAYOUT '{self.payload_layout}' non valido: uso 'text'")
+            self.payload_layout = "text"
+        self.text_resolver = DocumentTextResolver(
+            max_documents=int(os.getenv("RAG_TEXT_CACHE_DOCUMENTS", "8")),
+        )
+        if self.payload_layout == "offsets":
+            print("[RAG CONFIG] Payload: solo offset, testo letto da SQLite")
+
+        # Retrieval ibrido: BM25 locale fuso con la ricerca densa (reciprocal rank fusion)
+        self.hybrid_search = get_env_bool("RAG_HYBRID", default=True)
+        self.rrf_k = int(os.getenv("RAG_RRF_K", "60"))
+        self.bm25 = None
+        self._bm25_checked = set()
+        if self.hybrid_search:
+            self.bm25 = BM25Index(str(Path(self.cache_directory) / "bm25.sqlite3"))
+            print(f"[RAG CONFIG] Retrieval ibrido BM25 + vettoriale (RRF k={self.rrf_k})")
+
+        # MMR: sottoinsieme di chunk pertinenti ma non ridondanti, entro un budget di caratteri
+        self.use_mmr = get_env_bool("RAG_MMR", default=False)
+        self.mmr_lambda = float(os.getenv("RAG_MMR_LAMBDA", "0.7"))
+        self.context_char_budget = int(os.getenv("RAG_CONTEXT_CHAR_BUDGET", "0"))
+        if self.use_mmr:
+            budget = f"{self.context_char_budget} caratteri" if self.context_char_budget > 0 else "nessun budget"
+            print(f"[RAG CONFIG] MMR attivo (lambda {self.mmr_lambda}, {budget})")
+
+        # Campionamento per l'estrazione dei topic: chunk rappresentativi dell'intero corpus
+        self.topic_sample_size = max(1, int(os.getenv("RAG_TOPIC_SAMPLE_SIZE", "10")))
+        self.topic_sample_candidates = max(1, int(os.getenv("RAG_TOPIC_SAMPLE_CANDIDATES", "2000")))
+
+        # Cluster di argomenti aggiornati in indicizzazione: topic e chunk senza LLM né ricerca
+        self.topic_clusters = None
+        self._topic_clusters_checked = set()
+        if get_env_bool("RAG_TOPIC_CLUSTERS", default=False):
+            threshold = float(os.getenv("RAG_TOPIC_CLUSTER_THRESHOLD", "0.6"))
+            max_clusters = max(1, int(os.getenv("RAG_TOPIC_MAX_CLUSTERS", "32")))
+            self.topic_clusters = TopicClusterIndex(
+                str(Path(self.cache_directory) / "topic_clusters.sqlite3"),
+                threshold=threshold,
+                max_clusters=max_clusters,
+            )
+            print(f"[RAG CONFIG] Cluster di argomenti attivi (soglia {threshold}, max {max_clusters})")
+
+        # Quasi-duplicati (MinHash/LSH): scartati prima dell'embedding
+        self.near_duplicates = None
+        self._near_duplicates_checked = set()
+        if get_env_bool("RAG_NEAR_DEDUP", default=True):
+            self.near_duplicates = NearDuplicateIndex(
+                str(Path(self.cache_directory) / "near_duplicates.sqlite3"),
+                threshold=float(os.getenv("RAG_NEAR_DEDUP_THRESHOLD", "0.9")),
+            )
 
     def _create_embedding_function(self):
-        if self.use_local_llm:
+        if self.embedding_provider == "onnx":
+            print(f"[RAG] Provider: ONNX in-process ({self.onnx_model_dir})")
+            embedder = OnnxEmbeddingFunction(
+                model_dir=self.onnx_model_dir,
+                batch_size=self.onnx_batch_size,
+                num_threads=self.onnx_threads,
+            )
+        elif self.embedding_provider == "ollama":
             print(f"[RAG] Provider: Ollama ({self.local_model})")
-            return OllamaEmbeddingFunction(base_url=self.local_base_url, model=self.local_model)
+            embedder = OllamaEmbeddingFunction(
+                base_url=self.local_base_url,
+                model=self.local_model,
+                batch_size=self.ollama_batch_size,
+                batch_chars=self.ollama_batch_chars,
+                max_workers=self.ollama_workers,
+            )
         else:
             if not self.gemini_api_keys:
-                raise RuntimeError("GEMINI_API_KEY non impostata e USE_LOCAL_LLM=false")
+                raise RuntimeError("GEMINI_API_KEY non impostata e EMBEDDING_PROVIDER=gemini")
             print(f"[RAG] Provider: Gemini ({self.gemini_embed_model})")
             # Passa la LISTA delle chiavi
-            return GeminiEmbeddingFunction(api_keys=self.gemini_api_keys, model=self.gemini_embed_model)
+            embedder = GeminiEmbeddingFunction(
+                api_keys=self.gemini_api_keys,
+                model=self.gemini_embed_model,
+                rpm_per_key=self.gemini_embed_rpm,
+                tpm_per_key=self.gemini_embed_tpm,
+                output_dim=self.gemini_embed_dim,
+            )
+
+        if self.embedding_cache is not None:
+            return CachedEmbeddingFunction(embedder, self.embedding_cache)
+        return embedder
+
+    def embedding_cache_stats(self) -> Dict[str, float]:
+        if self.embedding_cache is None:
+            return {}
+        return self.embedding_cache.stats()
 
+    def _embed_queries(self, queries: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+        embedder = self.embedder
+        if not self.query_cache_disk and isinstance(embedder, CachedEmbeddingFunction):
+            embedder = embedder.embedder
+        return self.query_cache.embed_queries(embedder, queries)
+
+
+    def _embedding_key(self) -> str:
+        provider = getattr(self.embedder, "provider", type(self.embedder).__name__)
+        model = getattr(self.embedder, "embedding_id", self.embedder.model_name)
+        return f"{provider}:{model}"
 
     def _get_embedding_dim(self) -> int:
         if self._embedding_dim is None:
+            # La dimensione è salvata per (provider, modello): la chiamata di prova
+            # serve solo quando cambia il provider o il modello di embedding
+            embedding_key = self._embedding_key()
+            stored_dim = self.metadata.get("embedding_dims", embedding_key)
+            if stored_dim:
+                self._embedding_dim = int(stored_dim)
+                return self._embedding_dim
+
             try:
-                test_emb = self.embedder.embed(["test"])
-                self._embedding_dim = len(test_emb[0]) if test_emb else 768
+                test_emb, ok = self.embedder.embed_with_mask(["test"])
             except ConnectionError as e:
                 print(f"[RAG ERRORE] {e}")
                 raise ConnectionError(
@@ -333,118 +860,277 @@ class RAGService:
             except Exception as e:
                 print(f"[RAG ERRORE] Errore durante il calcolo della dimensione embedding: {e}")
                 raise
+
+            if ok.any():
+                self._embedding_dim = int(test_emb.shape[1])
+                self.metadata.set("embedding_dims", embedding_key, self._embedding_dim)
+                print(f"[RAG] Dimensione embedding per {embedding_key}: {self._embedding_dim} (salvata)")
+            else:
+                # Non salvare il valore di ripiego: al prossimo avvio si riprova
+                self._embedding_dim = 768
         return self._embedding_dim
 
-    def _collection_name(self, subject_id: int, subject_name: str) -> str:
+    def collection_name(self, subject_id: int, subject_name: str) -> str:
+        """Nome della collection di una materia, senza chiamate a Qdrant."""
         return f"subject_{subject_id}_{subject_name.lower().replace(' ', '_').replace('-', '_')}"
 
+    # ------------------ Registro collection ------------------
+    def _load_collection_registry(self) -> None:
+        """Riempie il registro con i nomi delle collection (una sola get_collections)."""
+        if self._collections is not None:
+            return
+        self._collections = {
+            col.name: {"dim": None, "points": None, "embedding_model": None, "version": 0}
+            for col in self.client.get_collections().collections
+        }
+
+    def _register_collection(self, collection_name: str, dim: int, points: int = 0) -> None:
+        self._load_collection_registry()
+        model = self.metadata.get("collections", collection_name) or self._embedding_key()
+        self._collections[collection_name] = {
+            "dim": dim,
+            "points": points,
+            "embedding_model": model,
+            "version": 0,
+        }
+
+    def _touch_collection(self, collection_name: str, added_points: int = None) -> None:
+        """Aggiorna il registro dopo una modifica dei punti (None = conteggio da rileggere)."""
+        self._bump_collection_version(collection_name)
+        self._touch_collection_physical(self._target(collection_name)[0], added_points)
+
+    def collection_version(self, collection_name: str) -> int:
+        """Versione corrente della collection logica (0 = mai modificata in questa sessione)."""
+        return self._collection_versions.get(collection_name, 0)
+
+    def _bump_collection_version(self, collection_name: str) -> None:
+        self._collection_versions[collection_name] = next(self._version_clock)
+
+    def _touch_collection_physical(self, physical_name: str, added_points: int = None) -> None:
+        entry = (self._collections or {}).get(physical_name)
+        if entry is None:
+            return
+        entry["version"] += 1
+        if added_points is None or entry["points"] is None:
+            entry["points"] = None
+        else:
+            entry["points"] += added_points
+
+    def collection_exists(self, collection_name: str) -> bool:
+        self._load_collection_registry()
+        return self._target(collection_name)[0] in self._collections
+
+    def get_collection_info(self, collection_name: str) -> Dict[str, Any] | None:
+        """{dim, points, embedding_model, version} dal registro; legge Qdrant solo per i campi mancanti.
+
+        Con il layout condiviso `points` conta solo i chunk della materia.
+        """
+        self._load_collection_registry()
+        physical_name, subject_filter = self._target(collection_name)
+        entry = self._collections.get(physical_name)
+        if entry is None:
+            return None
+        if entry["dim"] is None:
+            entry["dim"] = self._read_collection_dim(physical_name)
+            entry["embedding_model"] = (self.metadata.get("collections", physical_name)
+                                        or entry["embedding_model"])
+        if entry["points"] is None:
+            entry["points"] = self.client.count(physical_name, exact=True).count
+        info = dict(entry)
+        if subject_filter is not None:
+            info["points"] = self.client.count(physical_name, count_filter=subject_filter, exact=True).count
+        return info
+
+    def _read_collection_dim(self, collection_name: str) -> int | None:
+        return self._collection_info_dim(self.client.get_collection(collection_name))
+
+    @staticmethod
+    def _collection_info_dim(coll_info) -> int | None:
+        """Dimensione dei vettori da una risposta di get_collection già letta."""
+        # Verifica se config.params o config.params.vectors sono validi
+        if coll_info and coll_info.config and coll_info.config.params:
+            # Qdrant client recenti usano 'vectors' che potrebbe essere un dict o un oggetto
+            vec_config = coll_info.config.params.vectors
+            # Se è VectorParams (oggetto)
+            if hasattr(vec_config, 'size'):
+                return vec_config.size
+            # Se è dict o altro
+            if isinstance(vec_config, dict) and 'size' in vec_config:
+                return vec_config['size']
+        return None
+
+    def _quantization_config(self):
+        if self.quantization == "int8":
+            return ScalarQuantization(
+                scalar=ScalarQuantizationConfig(type=ScalarType.INT8, quantile=0.99, always_ram=True)
+            )
+        if self.quantization == "binary":
+            return BinaryQuantization(binary=BinaryQuantizationConfig(always_ram=True))
+        return None
+
+    def _search_params(self) -> SearchParams | None:
+        if self.quantization == "none":
+            return None
+        return SearchParams(
+            quantization=QuantizationSearchParams(
+                rescore=True,
+                oversampling=self.quantization_oversampling,
+            )
+        )
+
+    # ------------------ Layout delle collection ------------------
+    def _shared_collection_name(self, embedding_key: str = None) -> str:
+        """Collection fisica condivisa da tutte le materie, una per modello di embedding."""
+        key = embedding_key or self._embedding_key()
+        return "synapse_" + re.sub(r"[^a-z0-9]+", "_", key.lower()).strip("_")
+
+    def _target(self, collection_name: str) -> Tuple[str, Filter | None]:
+        """(collection fisica, filtro per materia) di una collection logica.
+
+        Con RAG_COLLECTION_LAYOUT=per_subject coincidono; con shared la
+        materia è il campo indicizzato subject_id della collection condivisa.
+        """
+        subject_id = self._subject_id(collection_name)
+        if self.collection_layout == "shared" and subject_id is not None:
+            return self._shared_collection_name(), self._subject_filter(subject_id)
+        return collection_name, None
+
+    @staticmethod
+    def _subject_id(collection_name: str) -> int | None:
+        match = _SUBJECT_COLLECTION_RE.match(collection_name)
+        return int(match.group(1)) if match else None
+
+    @staticmethod
+    def _subject_filter(subject_id: int) -> Filter:
+        return Filter(must=[FieldCondition(key="subject_id", match=MatchValue(value=subject_id))])
+
     def create_collection(self, subject_id: int, subject_name: str) -> str:
-        collection_name = self._collection_name(subject_id, subject_name)
-        
-        collections = self.client.get_collections().collections
-        collection_exists = any(col.name == collection_name for col in collections)
-        
+        """Prepara la collection della materia e ne ritorna il nome logico."""
+        collection_name = self.collection_name(subject_id, subject_name)
+        physical_name, _ = self._target(collection_name)
+        self._ensure_physical_collection(physical_name)
+        return collection_name
+
+    def _ensure_physical_collection(self, collection_name: str) -> None:
         target_dim = self._get_embedding_dim()
-        
+
+        # Percorso veloce: collection già verificata in questa sessione
+        self._load_collection_registry()
+        entry = self._collections.get(collection_name)
+        if entry is not None and entry["dim"] == target_dim:
+            return
+
+        collection_exists = entry is not None
         if collection_exists:
             try:
                 coll_info = self.client.get_collection(collection_name)
-                # Verifica se config.params o config.params.vectors sono validi
-                current_dim = None
-                if coll_info and coll_info.config and coll_info.config.params:
-                    # Qdrant client recenti usano 'vectors' che potrebbe essere un dict o un oggetto
-                    vec_config = coll_info.config.params.vectors
-                    # Se è VectorParams (oggetto)
-                    if hasattr(vec_config, 'size'):
-                        current_dim = vec_config.size
-                    # Se è dict o altro
-                    elif isinstance(vec_config, dict) and 'size' in vec_config:
-                        current_dim = vec_config['size']
+                current_dim = self._collection_info_dim(coll_info)
                 
                 if current_dim is not None and current_dim != target_dim:
                     print(f"[RAG] Dimensione mismatch ({current_dim} vs {target_dim}). Ricreazione...")
                     self.client.delete_collection(collection_name)
+                    self._drop_side_indexes(collection_name)
+                    self._forget_collection(collection_name)
                     collection_exists = False
                 else:
                     print(f"[RAG] Collection esistente: {collection_name} (dim: {current_dim})")
+                    model = self.metadata.get("collections", collection_name)
+                    if model and model != self._embedding_key():
+                        print(f"[RAG] ATTENZIONE: {collection_name} è stata indicizzata con {model}, "
+                              f"non con {self._embedding_key()}")
+                    if (collection_name not in self._payload_indexed
+                            and "document_id" not in (coll_info.payload_schema or {})):
+                        self._create_payload_indexes(collection_name)
+                    quantization = self._quantization_config()
+                    if quantization is not None and coll_info.config.quantization_config is None:
+                        print(f"[RAG] Attivo quantizzazione {self.quantization} su {collection_name}")
+                        self.client.update_collection(
+                            collection_name=collection_name,
+                            quantization_config=quantization,
+                        )
+                    self._register_collection(collection_name, current_dim or target_dim,
+                                              points=coll_info.points_count)
             except Exception as e:
                 print(f"[RAG] Errore controllo dimensione collection: {e}. Procedo.")
 
         if not collection_exists:
             print(f"[RAG] Creazione nuova collection: {collection_name}")
+            # Indici laterali rimasti da un'altra collection con lo stesso nome
+            # (es. cambio di RAG_VECTOR_STORE): riferirebbero punti inesistenti
+            self._drop_side_indexes(collection_name)
             self.client.create_collection(
                 collection_name=collection_name,
                 vectors_config=VectorParams(
                     size=target_dim,
                     distance=Distance.COSINE
-                )
+                ),
+                quantization_config=self._quantization_config(),
             )
-        
-        return collection_name
-
-    # ------------------ Chunking ------------------
-    def chunk_text_recursive(self, text: str, chunk_size: int = None, chunk_overlap: int = None) -> List[str]:
-        final_chunk_size = chunk_size if chunk_size is not None else self.chunk_size
-        final_overlap = chunk_overlap if chunk_overlap is not None else self.chunk_overlap
+            self._create_payload_indexes(collection_name)
+            self._indexed_documents[collection_name] = set()
+            self.metadata.set("collections", collection_name, self._embedding_key())
+            self._register_collection(collection_name, target_dim)
 
-        separators = ["\n\n", "\n", ". ", " ", ""]
-        
-        final_chunks = []
-        
-        def _recursive_split(text: str, current_separators: List[str]):
-            if len(text) <= final_chunk_size:
-                if text.strip():
-                    final_chunks.append(text.strip())
-                return
+    def _drop_side_indexes(self, physical_name: str) -> None:
+        """Svuota BM25, cluster e firme di ogni collection logica salvata su `physical_name`.
 
-            if not current_separators:
-                for i in range(0, len(text), final_chunk_size - final_overlap):
-                    chunk = text[i : i + final_chunk_size]
-                    if chunk.strip():
-                        final_chunks.append(chunk.strip())
-                return
+        Questi indici sono per nome logico: col layout condiviso la collection
+        fisica synapse_<modello> ospita tutte le subject_<id>_<nome>.
+        """
+        for index in (self.bm25, self.topic_clusters, self.near_duplicates):
+            if index is None:
+                continue
+            for name in index.collections():
+                if name == physical_name or self._target(name)[0] == physical_name:
+                    index.drop_collection(name)
+                    self._bm25_checked.discard(name)
+                    self._topic_clusters_checked.discard(name)
+                    self._near_duplicates_checked.discard(name)
+                    self._bump_collection_version(name)
 
-            separator = current_separators[0]
-            remaining_separators = current_separators[1:]
+    def _forget_collection(self, collection_name: str) -> None:
+        """Invalida tutto ciò che è in memoria per una collection eliminata."""
+        if self._collections is not None:
+            self._collections.pop(collection_name, None)
+        self._indexed_documents.pop(collection_name, None)
+        self._payload_indexed.discard(collection_name)
+        self._bm25_checked.discard(collection_name)
+        self._topic_clusters_checked.discard(collection_name)
+        self._near_duplicates_checked.discard(collection_name)
+        self._bump_collection_version(collection_name)
+        self.metadata.delete("collections", collection_name)
+        if collection_name.startswith("synapse_"):
+            # Collection condivisa: le cache per materia non sono più valide
+            self._indexed_documents.clear()
+            self._bm25_checked.clear()
+            self._topic_clusters_checked.clear()
+            self._near_duplicates_checked.clear()
+            if self.result_cache is not None:
+                self.result_cache.clear()
 
-            if separator == "":
-                splits = list(text) 
-            else:
-                splits = text.split(separator)
+    def _create_payload_indexes(self, collection_name: str) -> None:
+        """Indici su document_id e subject_id: filtri per documento/materia senza scansione completa."""
+        self._payload_indexed.add(collection_name)
+        for field_name in ("document_id", "subject_id"):
+            try:
+                self.client.create_payload_index(
+                    collection_name=collection_name,
+                    field_name=field_name,
+                    field_schema=PayloadSchemaType.INTEGER,
+                )
+            except Exception as e:
+                print(f"[RAG] Impossibile creare l'indice su {field_name} per {collection_name}: {e}")
 
-            current_chunk = ""
-            for i, part in enumerate(splits):
-                if i < len(splits) - 1:
-                    part_with_separator = part + separator
-                else:
-                    part_with_separator = part
-                
-                if len(current_chunk) + len(part_with_separator) > final_chunk_size:
-                    
-                    if current_chunk:
-                        _recursive_split(current_chunk.strip(), remaining_separators)
-                    
-                    overlap_text = current_chunk[-final_overlap:]
-                    
-                    if len(part_with_separator) > final_chunk_size:
-                        _recursive_split(part_with_separator.strip(), remaining_separators)
-                        current_chunk = "" 
-                    else:
-                        current_chunk = overlap_text + part_with_separator
-                
-                else:
-                    current_chunk += part_with_separator
-            
-            if current_chunk.strip():
-                if len(current_chunk) > final_chunk_size:
-                    _recursive_split(current_chunk.strip(), remaining_separators)
-                else:
-                    final_chunks.append(current_chunk.strip())
+    # ------------------ Chunking ------------------
+    def chunk_text_recursive(self, text: str, chunk_size: int = None, chunk_overlap: int = None) -> List[str]:
+        return [chunk for chunk, _, _ in self.chunk_text_with_offsets(text, chunk_size, chunk_overlap)]
 
-        _recursive_split(text, separators)
-        
-        unique_chunks = list(dict.fromkeys(final_chunks))
-        return [chunk for chunk in unique_chunks if chunk]
+    def chunk_text_with_offsets(self, text: str, chunk_size: int = None,
+                                chunk_overlap: int = None) -> List[Tuple[str, int, int]]:
+        """Chunk unici con offset (char_start, char_end) nel testo originale."""
+        final_chunk_size = chunk_size if chunk_size is not None else self.chunk_size
+        final_overlap = chunk_overlap if chunk_overlap is not None else self.chunk_overlap
+        return chunker.chunk_text(text, final_chunk_size, final_overlap)
 
     """
     def chunk_text(self, text: str, chunk_size: int = None, overlap: int = None) -> List[str]:
@@ -487,143 +1173,925 @@ class RAGService:
         return chunks
     """
 
+    def _document_filter(self, document_id: int) -> Filter:
+        return Filter(
+            must=[
+                FieldCondition(
+                    key="document_id",
+                    match=MatchValue(value=document_id)
+                )
+            ]
+        )
+
+    def _iter_points(self, physical_name: str, scroll_filter: Filter | None = None,
+                     with_payload: Any = True, with_vectors: bool = False,
+                     batch_size: int = 1000, max_points: int | None = None) -> Iterator[List[Any]]:
+        """Scorre una collection fisica con scroll, una lista di punti per pagina.
+
+        Con `max_points` si ferma dopo averne letti al più tanti.
+        """
+        next_offset = None
+        read = 0
+        while max_points is None or read < max_points:
+            limit = batch_size if max_points is None else min(batch_size, max_points - read)
+            points, next_offset = self.client.scroll(
+                collection_name=physical_name,
+                scroll_filter=scroll_filter,
+                limit=limit,
+                offset=next_offset,
+                with_payload=with_payload,
+                with_vectors=with_vectors,
+            )
+            if points:
+                read += len(points)
+                yield points
+            if not points or next_offset is None:
+                return
+
+    def _existing_document_points(self, collection_name: str, document_id: int) -> Dict[str, Dict[str, Any]]:
+        """{point_id: payload ridotto} dei chunk già indicizzati per il documento."""
+        physical_name, _ = self._target(collection_name)
+        existing: Dict[str, Dict[str, Any]] = {}
+        for points in self._iter_points(
+            physical_name, self._document_filter(document_id),
+            with_payload=["chunk_index", "total_chunks", "char_start", "text"],
+        ):
+            for p in points:
+                payload = p.payload or {}
+                existing[str(p.id)] = {
+                    "chunk_index": payload.get("chunk_index"),
+                    "total_chunks": payload.get("total_chunks"),
+                    "char_start": payload.get("char_start"),
+                    "has_text": "text" in payload,
+                }
+        return existing
+
     def index_document(self, collection_name: str, document_id: int,
-                       document_name: str, content: str) -> None:
-        chunks = self.chunk_text_recursive(content)
-        if not chunks:
+                       document_name: str, content: str,
+                       progress_callback: Callable[[int, int], None] = None) -> None:
+        """Indicizza i chunk nuovi del documento a batch, rendendoli cercabili man mano.
+
+        `progress_callback(fatti, totale)` viene chiamato dopo ogni batch salvato.
+        """
+        physical_name, _ = self._target(collection_name)
+        subject_id = self._subject_id(collection_name)
+        spans = self.chunk_text_with_offsets(content)
+        if not spans:
             return
+        chunks = [chunk for chunk, _, _ in spans]
 
-        print(f"[RAG] Indicizzazione documento {document_name}: {len(chunks)} chunks")
-        
-        embeddings = self.embedder.embed(chunks)
-        
-        if not embeddings:
-            print("[RAG] Nessun embedding generato!")
+        # ID deterministici: lo stesso chunk dello stesso documento ha sempre lo stesso punto
+        point_ids = [chunk_point_id(document_id, chunk) for chunk in chunks]
+        existing = self._existing_document_points(collection_name, document_id)
+
+        current = set(point_ids)
+        vanished = [pid for pid in existing if pid not in current]
+        new_rows = [i for i, pid in enumerate(point_ids) if pid not in existing]
+        moved = [
+            i for i, pid in enumerate(point_ids)
+            if pid in existing and (existing[pid].get("chunk_index") != i
+                                    or existing[pid].get("total_chunks") != len(chunks)
+                                    or existing[pid].get("char_start") != spans[i][1]
+                                    or existing[pid].get("has_text") != (self.payload_layout == "text"))
+        ]
+
+        # Quasi-duplicati di chunk già presenti (o di chunk precedenti dello stesso
+        # documento): non vengono né embeddati né salvati
+        signatures: Dict[int, np.ndarray] = {}
+        duplicates: Set[int] = set()
+        if self.near_duplicates is not None and vanished:
+            self.near_duplicates.remove_points(collection_name, vanished)
+        if self.near_duplicates is not None and new_rows:
+            self._ensure_near_duplicates(collection_name)
+            signatures = {i: self.near_duplicates.signature(chunks[i]) for i in new_rows}
+            matches = self.near_duplicates.find_duplicates(
+                collection_name,
+                [point_ids[i] for i in new_rows],
+                [signatures[i] for i in new_rows],
+            )
+            duplicates = {i for i, match in zip(new_rows, matches) if match is not None}
+            # Si ricorda chi rappresenta ogni chunk scartato: se quel punto viene
+            # rimosso, questo documento torna fra quelli da indicizzare
+            self.near_duplicates.set_duplicates(collection_name, document_id, len(chunks), [
+                (point_ids[i], match) for i, match in zip(new_rows, matches) if match is not None
+            ])
+            new_rows = [i for i in new_rows if i not in duplicates]
+        elif self.near_duplicates is not None:
+            self.near_duplicates.set_duplicates(collection_name, document_id, len(chunks), [])
+
+        print(f"[RAG] Indicizzazione documento {document_name}: {len(chunks)} chunks "
+              f"({len(new_rows)} nuovi, {len(vanished)} rimossi, "
+              f"{len(chunks) - len(new_rows) - len(duplicates)} invariati"
+              + (f", {len(duplicates)} quasi-duplicati scartati)" if duplicates else ")"))
+
+        # Il contenuto potrebbe essere cambiato: gli offset vanno risolti sul nuovo testo
+        self.text_resolver.invalidate(document_id)
+
+        def _payload(i: int) -> Dict[str, Any]:
+            payload = {
+                "document_id": document_id,
+                "document_name": document_name,
+                "subject_id": subject_id,
+                "chunk_index": int(i),
+                "total_chunks": len(chunks),
+                "char_start": spans[i][1],
+                "char_end": spans[i][2],
+            }
+            if self.payload_layout == "text":
+                payload["text"] = chunks[i]
+            return payload
+
+        if vanished:
+            self._uncluster_points(collection_name, vanished)
+            self.client.delete(
+                collection_name=physical_name,
+                points_selector=PointIdsList(points=vanished),
+            )
+            self._touch_collection(collection_name, -len(vanished))
+            if self.near_duplicates is not None:
+                self._report_orphaned_documents(collection_name)
+
+        if moved:
+            # Aggiorna solo posizione/totale/offset/layout riusando i vettori già salvati
+            stored = self.client.retrieve(
+                collection_name=physical_name,
+                ids=[point_ids[i] for i in moved],
+                with_payload=False,
+                with_vectors=True,
+            )
+            vectors_by_id = {str(p.id): p.vector for p in stored}
+            self.client.upsert(
+                collection_name=physical_name,
+                points=[
+                    PointStruct(id=point_ids[i], vector=vectors_by_id[point_ids[i]], payload=_payload(i))
+                    for i in moved if point_ids[i] in vectors_by_id
+                ],
+            )
+            self._touch_collection(collection_name, 0)
+
+        if self.bm25 is not None and (new_rows or vanished
+                                      or not self.bm25.has_document(collection_name, document_id)):
+            self._ensure_bm25(collection_name)
+            stored = [i for i in range(len(chunks)) if i not in duplicates]
+            self.bm25.replace_document(collection_name, document_id,
+                                       [point_ids[i] for i in stored], [chunks[i] for i in stored])
+
+        indexed = self._indexed_documents.get(collection_name, set())
+        if not new_rows:
+            indexed.add(document_id)
+            print("[RAG] Nessun chunk nuovo da indicizzare.")
             return
-        
-        points = []
-        for i, (chunk, embedding) in enumerate(zip(chunks, embeddings)):
-            point_id = str(uuid.uuid4())  # ID univoco
-            points.append(
-                PointStruct(
-                    id=point_id,
-                    vector=embedding,
-                    payload={
-                        "document_id": document_id,
-                        "document_name": document_name,
-                        "chunk_index": i,
-                        "total_chunks": len(chunks),
-                        "text": chunk
-                    }
+        # Completo di nuovo solo quando tutti i chunk mancanti sono stati salvati
+        indexed.discard(document_id)
+
+        if self.topic_clusters is not None:
+            self._ensure_topic_clusters(collection_name)
+
+        def _store(vectors: np.ndarray, payloads: List[Dict[str, Any]], ids: List[str],
+                   batch_signatures: List[np.ndarray]) -> int:
+            stored = self._upload_batch(physical_name, vectors, payloads, ids)
+            # Indici laterali aggiornati solo per i punti effettivamente salvati
+            if batch_signatures:
+                self.near_duplicates.add(collection_name, document_id, ids, batch_signatures)
+            if self.topic_clusters is not None:
+                self.topic_clusters.add_points(collection_name, ids, [document_id] * len(ids), vectors)
+            return stored
+
+        # Embedding del batch successivo mentre il precedente viene salvato:
+        # al massimo un batch in volo, quindi memoria limitata a due batch
+        added = 0
+        failed = 0
+        done = 0
+        pending = None
+        completed = False
+        uploader = ThreadPoolExecutor(max_workers=1) if self.index_pipeline else None
+        try:
+            for start in range(0, len(new_rows), self.index_batch_size):
+                rows = new_rows[start:start + self.index_batch_size]
+                vectors, ok = self.embedder.embed_with_mask([chunks[i] for i in rows])
+                kept = np.flatnonzero(ok)
+                failed += len(rows) - len(kept)
+
+                if pending is not None:
+                    added += pending.result()
+                    if progress_callback:
+                        progress_callback(done, len(new_rows))
+
+                batch = (
+                    vectors[kept],
+                    [_payload(rows[j]) for j in kept],
+                    [point_ids[rows[j]] for j in kept],
+                    [signatures[rows[j]] for j in kept] if signatures else [],
                 )
-            )
+                done = start + len(rows)
+                if uploader is not None:
+                    pending = uploader.submit(_store, *batch)
+                else:
+                    added += _store(*batch)
+                    if progress_callback:
+                        progress_callback(done, len(new_rows))
+
+            if pending is not None:
+                added += pending.result()
+                if progress_callback:
+                    progress_callback(done, len(new_rows))
+            completed = True
+        finally:
+            if uploader is not None:
+                uploader.shutdown(wait=True)
+            if not completed:
+                # Interruzione a metà: i batch già salvati sono cercabili, quindi la
+                # versione va incrementata comunque (conteggio punti da rileggere)
+                self._touch_collection(collection_name)
+
+        if failed:
+            print(f"[RAG] {failed} chunk senza embedding esclusi dall'indice")
+        else:
+            indexed.add(document_id)
+        if not added:
+            print("[RAG] Nessun embedding generato!")
+            return
         
-        self.client.upsert(
+        self._touch_collection(collection_name, added)
+        print(f"[RAG] Indicizzazione completata. {added} chunks aggiunti.")
+        if self.embedding_cache is not None:
+            stats = self.embedding_cache.stats()
+            print(f"[RAG] Embedding cache: {stats['hits']} hit, {stats['misses']} miss "
+                  f"(hit rate {stats['hit_rate']:.0%}, {stats['entries']} vettori)")
+
+    def _upload_batch(self, collection_name: str, vectors: np.ndarray,
+                      payloads: List[Dict[str, Any]], ids: List[str]) -> int:
+        if not ids:
+            return 0
+        self.client.upload_collection(
             collection_name=collection_name,
-            points=points
+            vectors=vectors,
+            payload=payloads,
+            ids=ids,
+            batch_size=256,
+            wait=True,
         )
-        
-        print(f"[RAG] Indicizzazione completata. {len(chunks)} chunks aggiunti.")
+        return len(ids)
+
+    def _uncluster_points(self, collection_name: str, point_ids: List[str]) -> None:
+        """Toglie dai cluster i punti che stanno per essere eliminati (servono i loro vettori)."""
+        if self.topic_clusters is None or not point_ids:
+            return
+        physical_name, _ = self._target(collection_name)
+        try:
+            stored = self.client.retrieve(
+                collection_name=physical_name,
+                ids=list(point_ids),
+                with_payload=False,
+                with_vectors=True,
+            )
+            stored = [p for p in stored if p.vector is not None]
+            if stored:
+                self.topic_clusters.remove_points(
+                    collection_name,
+                    [str(p.id) for p in stored],
+                    np.vstack([np.asarray(p.vector, dtype=np.float32) for p in stored]),
+                )
+        except Exception as e:
+            print(f"[RAG] Errore aggiornamento cluster di {collection_name}: {e}")
 
     def remove_document(self, collection_name: str, document_id: int) -> None:
+        physical_name, _ = self._target(collection_name)
+        if self.topic_clusters is not None:
+            self._uncluster_points(collection_name,
+                                   self.topic_clusters.document_points(collection_name, document_id))
         self.client.delete(
-            collection_name=collection_name,
-            points_selector=Filter(
-                must=[
-                    FieldCondition(
-                        key="document_id",
-                        match=MatchValue(value=document_id)
-                    )
-                ]
-            )
+            collection_name=physical_name,
+            points_selector=self._document_filter(document_id)
         )
+        self.text_resolver.invalidate(document_id)
+        self._indexed_documents.get(collection_name, set()).discard(document_id)
+        self._touch_collection(collection_name)
+        if self.bm25 is not None:
+            self.bm25.remove_document(collection_name, document_id)
+        if self.near_duplicates is not None:
+            self.near_duplicates.remove_document(collection_name, document_id)
+            self._report_orphaned_documents(collection_name)
         
         print(f"[RAG] Rimossi tutti i chunk del documento {document_id}")
 
-    def is_document_indexed(self, collection_name: str, document_id: int) -> bool:
+    def _report_orphaned_documents(self, collection_name: str) -> None:
+        orphaned = self.near_duplicates.orphaned_documents(collection_name)
+        if orphaned:
+            print(f"[RAG] Documenti da reindicizzare in {collection_name} "
+                  f"(quasi-duplicati di chunk rimossi): {sorted(orphaned)}")
+
+    def get_indexed_document_ids(self, collection_name: str) -> Set[int]:
+        """document_id indicizzati per intero: uno scroll la prima volta, poi dalla memoria.
+
+        Esclude i documenti con chunk scartati come quasi-duplicati di punti
+        poi rimossi, così il chiamante li reindicizza.
+        """
+        orphaned = (self.near_duplicates.orphaned_documents(collection_name)
+                    if self.near_duplicates is not None else set())
+        physical_name, subject_filter = self._target(collection_name)
+        cached = self._indexed_documents.get(collection_name)
+        if cached is not None:
+            return set(cached) - orphaned
+
+        # Un documento è completo quando punti salvati + quasi-duplicati scartati
+        # coprono total_chunks: un'indicizzazione interrotta lascia solo una parte dei punti
+        stored: Dict[int, int] = {}
+        totals: Dict[int, int] = {}
         try:
-            count_res = self.client.count(
-                collection_name=collection_name,
-                count_filter=Filter(
-                    must=[
-                        FieldCondition(
-                            key="document_id",
-                            match=MatchValue(value=document_id)
-                        )
-                    ]
-                ),
-                exact=False,
-            )
-            total = getattr(count_res, "count", None)
-            if total is None:
-                total = int(count_res) if count_res is not None else 0
-            return (total or 0) > 0
+            for points in self._iter_points(physical_name, subject_filter,
+                                            with_payload=["document_id", "total_chunks"]):
+                for p in points:
+                    payload = p.payload or {}
+                    document_id = payload.get("document_id")
+                    if document_id is None:
+                        continue
+                    stored[document_id] = stored.get(document_id, 0) + 1
+                    totals[document_id] = max(totals.get(document_id, 0), payload.get("total_chunks") or 0)
         except Exception as e:
-            print(f"[RAG] Errore in is_document_indexed: {e}")
-            return False
+            print(f"[RAG] Errore in get_indexed_document_ids: {e}")
+            return set()
+
+        # Documenti con chunk scartati: compresi quelli fatti solo di quasi-duplicati,
+        # che non hanno punti salvati e di cui il totale arriva dall'indice delle firme
+        discarded: Dict[int, int] = {}
+        if self.near_duplicates is not None:
+            for document_id, (count, total) in self.near_duplicates.document_chunks(collection_name).items():
+                discarded[document_id] = count
+                totals.setdefault(document_id, total)
+        candidates = set(stored) | {document_id for document_id, count in discarded.items() if count}
+        document_ids = {
+            document_id for document_id in candidates
+            if stored.get(document_id, 0) + discarded.get(document_id, 0) >= totals[document_id]
+        }
+        if len(document_ids) < len(candidates):
+            print(f"[RAG] {len(candidates) - len(document_ids)} documenti indicizzati solo in parte "
+                  f"in {collection_name}")
+
+        self._indexed_documents[collection_name] = document_ids
+        return set(document_ids) - orphaned
+
+    def is_document_indexed(self, collection_name: str, document_id: int) -> bool:
+        return document_id in self.get_indexed_document_ids(collection_name)
 
     def get_all_chunks_texts(self, collection_name: str, batch_size: int = 1000) -> List[str]:
+        physical_name, subject_filter = self._target(collection_name)
         texts: List[str] = []
-        next_offset = None
         try:
-            while True:
-                points, next_offset = self.client.scroll(
-                    collection_name=collection_name,
-                    limit=batch_size,
-                    offset=next_offset,
-                    with_payload=True,
-                    with_vectors=False,
-                )
-                if not points:
-                    break
-                for p in points:
-                    payload = getattr(p, "payload", None) or {}
-                    t = payload.get("text")
-                    if isinstance(t, str) and t.strip():
+            for points in self._iter_points(physical_name, subject_filter, batch_size=batch_size):
+                payloads = [getattr(p, "payload", None) or {} for p in points]
+                for t in self.text_resolver.resolve_many(payloads):
+                    if t.strip():
                         texts.append(t)
-                if not next_offset:
-                    break
         except Exception as e:
             print(f"[RAG] Errore in get_all_chunks_texts: {e}")
         return texts
 
+    def sample_representative_chunks(self, collection_name: str, k: int = None,
+                                     max_candidates: int = None, batch_size: int = 512,
+                                     seed: int = 0) -> List[str]:
+        """k chunk che coprono l'intera collection, senza caricarne tutti i testi.
+
+        Scorre i vettori a blocchi tenendo un reservoir per documento (così i
+        documenti lunghi non oscurano quelli brevi e la memoria resta
+        limitata a `max_candidates` vettori), sceglie fra i candidati k punti
+        con farthest_point_select e solo per questi legge il testo.
+        """
+        k = k or self.topic_sample_size
+        max_candidates = max_candidates or self.topic_sample_candidates
+        physical_name, subject_filter = self._target(collection_name)
+        document_count = max(1, len(self.get_indexed_document_ids(collection_name)))
+        per_document = max(1, max_candidates // document_count)
+
+        rng = np.random.default_rng(seed)
+        reservoirs: Dict[Any, Tuple[List[Any], List[np.ndarray]]] = {}
+        seen: Dict[Any, int] = {}
+        try:
+            for points in self._iter_points(physical_name, subject_filter, with_payload=["document_id"],
+                                            with_vectors=True, batch_size=batch_size):
+                for p in points:
+                    if p.vector is None:
+                        continue
+                    document_id = (p.payload or {}).get("document_id")
+                    ids, vectors = reservoirs.setdefault(document_id, ([], []))
+                    seen[document_id] = seen.get(document_id, 0) + 1
+                    if len(ids) < per_document:
+                        ids.append(p.id)
+                        vectors.append(np.asarray(p.vector, dtype=np.float32))
+                        continue
+                    # Algorithm R: ogni chunk del documento resta con probabilità per_document / visti
+                    slot = int(rng.integers(0, seen[document_id]))
+                    if slot < per_document:
+                        ids[slot] = p.id
+                        vectors[slot] = np.asarray(p.vector, dtype=np.float32)
+
+            candidate_ids = [pid for ids, _ in reservoirs.values() for pid in ids]
+            if not candidate_ids:
+                return []
+            matrix = np.vstack([v for _, vectors in reservoirs.values() for v in vectors])
+            chosen = [candidate_ids[i] for i in farthest_point_select(matrix, k)]
+            points = self.client.retrieve(
+                collection_name=physical_name,
+                ids=chosen,
+                with_payload=True,
+                with_vectors=False,
+            )
+        except Exception as e:
+            print(f"[RAG] Errore in sample_representative_chunks: {e}")
+            return []
+
+        # retrieve non garantisce l'ordine: si mantiene quello della selezione
+        by_id = {str(p.id): p for p in points}
+        ordered = [by_id[str(pid)] for pid in chosen if str(pid) in by_id]
+        texts = self.text_resolver.resolve_many([p.payload or {} for p in ordered])
+        print(f"[RAG] Campione di {len(texts)} chunk da {len(candidate_ids)} candidati "
+              f"({len(reservoirs)} documenti)")
+        return [t for t in texts if t.strip()]
+
+    def _format_results(self, results,
+                        rrf_scores: Dict[str, float] | None = None) -> List[Dict[str, Any]]:
+        formatted = []
+        texts = self.text_resolver.resolve_many([result.payload or {} for result in results])
+        for result, text in zip(results, texts):
+            if not text:
+                # Documento non più presente in SQLite: il chunk non è risolvibile
+                continue
+            item = {
+                "content": text,
+                "metadata": {
+                    "subject_id": result.payload.get("subject_id"),
+                    "document_id": result.payload.get("document_id"),
+                    "document_name": result.payload.get("document_name"),
+                    "chunk_index": result.payload.get("chunk_index"),
+                    "total_chunks": result.payload.get("total_chunks"),
+                },
+                "score": result.score,
+                "distance": 1 - result.score, 
+            }
+            if rrf_scores is not None:
+                # Punteggio della fusione con BM25, che determina l'ordine dei risultati
+                item["rrf_score"] = rrf_scores.get(str(result.id), 0.0)
+            formatted.append(item)
+        return formatted
+
     def search_relevant_chunks(self, collection_name: str,
                                query: str, n_results: int = 10) -> List[Dict[str, Any]]:
-        query_embedding = self.embedder.embed([query])
-        if not query_embedding:
+        physical_name, subject_filter = self._target(collection_name)
+        if self.bm25 is not None or self.use_mmr or self.result_cache is not None:
+            return self.search_relevant_chunks_batch(collection_name, [query], n_results)[0]
+
+        query_embedding, ok = self._embed_queries([query])
+        if not ok.any():
             return []
         
         results = self.client.search(
-            collection_name=collection_name,
+            collection_name=physical_name,
             query_vector=query_embedding[0],
+            query_filter=subject_filter,
             limit=n_results,
             score_threshold=self.score_threshold,
             with_payload=True,
             with_vectors=False,
+            search_params=self._search_params(),
         )
         
-        formatted = []
-        for result in results:
-            formatted.append({
-                "content": result.payload.get("text", ""),
-                "metadata": {
-                    "document_id": result.payload.get("document_id"),
-                    "document_name": result.payload.get("document_name"),
-                    "chunk_index": result.payload.get("chunk_index"),
-                    "total_chunks": result.payload.get("total_chunks"),
-                },
-                "score": result.score,
-                "distance": 1 - result.score, 
-            })
-        
-        return formatted
+        return self._format_results(results)
+
+    def _result_cache_key(self, collection_name: str, query: str, n_results: int) -> Tuple:
+        """Chiave della cache risultati: collection, versione, query e ogni opzione che cambia il ranking."""
+        return (
+            collection_name,
+            self.collection_version(collection_name),
+            QueryEmbeddingCache.normalize(query),
+            n_results,
+            self.score_threshold,
+            self._embedding_key(),
+            self.quantization,
+            self.bm25 is not None and self.rrf_k,
+            self.use_mmr and (self.mmr_lambda, self.context_char_budget),
+        )
+
+    def search_relevant_chunks_batch(self, collection_name: str, queries: List[str],
+                                     n_results: int = 10) -> List[List[Dict[str, Any]]]:
+        """Come search_relevant_chunks per più query: un solo embedding e una sola search_batch.
+
+        Con RAG_RESULT_CACHE_SIZE > 0 le query già cercate sulla stessa versione
+        della collection non toccano né l'embedder né Qdrant.
+        """
+        if not queries:
+            return []
+        if self.result_cache is None:
+            return self._search_batch(collection_name, queries, n_results)[0]
+
+        # La chiave si calcola prima della ricerca: se la collection cambia nel
+        # frattempo il risultato finisce sotto la versione vecchia e non verrà più letto
+        keys = [self._result_cache_key(collection_name, q, n_results) for q in queries]
+        results = [self.result_cache.get(key) for key in keys]
+        missing: Dict[Tuple, str] = {}
+        for key, query, cached in zip(keys, queries, results):
+            if cached is None:
+                missing.setdefault(key, query)
+        if missing:
+            fresh, ok = self._search_batch(collection_name, list(missing.values()), n_results)
+            fresh_by_key = dict(zip(missing, fresh))
+            for key, found, embedded in zip(missing, fresh, ok):
+                # Query senza embedding: risultato parziale, non va in cache
+                if embedded:
+                    self.result_cache.put(key, found)
+            results = [cached if cached is not None else fresh_by_key[key]
+                       for key, cached in zip(keys, results)]
+        return results
+
+    def _search_batch(self, collection_name: str, queries: List[str],
+                      n_results: int) -> Tuple[List[List[Dict[str, Any]]], np.ndarray]:
+        """Ricerca vera e propria: (risultati per query, maschera delle query con embedding)."""
+        physical_name, subject_filter = self._target(collection_name)
+        query_embeddings, ok = self._embed_queries(queries)
+        rows = np.flatnonzero(ok)
+        dense: List[List[Any]] = [[] for _ in queries]
+        if len(rows) == 0 and self.bm25 is None:
+            return [[] for _ in queries], ok
+
+        # Con BM25 o MMR si pescano più candidati, poi fusi/diversificati fino a n_results
+        candidates = n_results * 2 if (self.bm25 is not None or self.use_mmr) else n_results
+        batch_results = self.client.search_batch(
+            collection_name=physical_name,
+            requests=[
+                SearchRequest(
+                    vector=query_embeddings[i].tolist(),
+                    filter=subject_filter,
+                    limit=candidates,
+                    score_threshold=self.score_threshold,
+                    with_payload=True,
+                    with_vector=self.use_mmr,
+                    params=self._search_params(),
+                )
+                for i in rows
+            ],
+        ) if len(rows) else []
+        for i, results in zip(rows, batch_results):
+            dense[i] = results
+
+        rrf_scores: List[Dict[str, float] | None] = [None] * len(queries)
+        if self.bm25 is not None:
+            dense, rrf_scores = self._fuse_with_bm25(
+                collection_name, queries, query_embeddings, ok, dense,
+                candidates if self.use_mmr else n_results,
+            )
+        if self.use_mmr:
+            dense = [
+                self._diversify(query_embeddings[i], results, n_results) if ok[i] else results[:n_results]
+                for i, results in enumerate(dense)
+            ]
+        return [self._format_results(results, scores) for results, scores in zip(dense, rrf_scores)], ok
+
+    def _diversify(self, query_vector: np.ndarray, results: List[Any], n_results: int) -> List[Any]:
+        """Riordina i candidati con MMR rispettando RAG_CONTEXT_CHAR_BUDGET."""
+        results = [r for r in results if r.vector is not None]
+        if not results:
+            return []
+        texts = self.text_resolver.resolve_many([r.payload or {} for r in results])
+        selected = mmr_select(
+            query_vector,
+            np.asarray([r.vector for r in results], dtype=np.float32),
+            k=n_results,
+            lambda_mult=self.mmr_lambda,
+            lengths=[len(t) for t in texts],
+            char_budget=self.context_char_budget,
+        )
+        return [results[i] for i in selected]
+
+    def _backfill_side_index(self, collection_name: str, index: Any, checked: Set[str],
+                             sink: Callable[[List[Any], List[str] | None], int],
+                             with_vectors: bool = False) -> int:
+        """Riempie un indice laterale (BM25, firme, cluster) con i chunk già salvati.
+
+        Gira una volta per collection e solo se l'indice è vuoto, quindi va
+        chiamato prima di aggiungere i chunk nuovi: dopo, size > 0 lo salterebbe.
+        `sink(punti, testi)` riceve ogni pagina di punti con document_id (con
+        `with_vectors` i testi sono None) e ritorna quanti chunk ha aggiunto.
+        """
+        if collection_name in checked:
+            return 0
+        checked.add(collection_name)
+        if index.size(collection_name) > 0:
+            return 0
+
+        physical_name, subject_filter = self._target(collection_name)
+        added = 0
+        for points in self._iter_points(physical_name, subject_filter,
+                                        with_payload=["document_id"] if with_vectors else True,
+                                        with_vectors=with_vectors):
+            points = [p for p in points if (p.payload or {}).get("document_id") is not None]
+            texts = None
+            if with_vectors:
+                points = [p for p in points if p.vector is not None]
+            else:
+                resolved = self.text_resolver.resolve_many([p.payload for p in points])
+                points, texts = [p for p, t in zip(points, resolved) if t], [t for t in resolved if t]
+            if points:
+                added += sink(points, texts)
+        return added
+
+    def _ensure_bm25(self, collection_name: str) -> None:
+        """Costruisce l'indice BM25 per collection indicizzate prima di RAG_HYBRID."""
+        chunks = []
+
+        def _collect(points: List[Any], texts: List[str]) -> int:
+            # replace_document lavora per documento intero: si ricostruisce alla fine
+            chunks.extend((str(p.id), p.payload["document_id"], t) for p, t in zip(points, texts))
+            return len(points)
+
+        if self._backfill_side_index(collection_name, self.bm25, self._bm25_checked, _collect):
+            count = self.bm25.rebuild_collection(collection_name, chunks)
+            print(f"[RAG] Indice BM25 ricostruito per {collection_name}: {count} chunks")
+
+    def _ensure_near_duplicates(self, collection_name: str) -> None:
+        """Calcola le firme MinHash dei chunk indicizzati prima di RAG_NEAR_DEDUP."""
+        def _sign(points: List[Any], texts: List[str]) -> int:
+            by_document: Dict[int, Tuple[List[str], List[np.ndarray]]] = {}
+            for p, text in zip(points, texts):
+                ids, sigs = by_document.setdefault(p.payload["document_id"], ([], []))
+                ids.append(str(p.id))
+                sigs.append(self.near_duplicates.signature(text))
+            for document_id, (ids, sigs) in by_document.items():
+                self.near_duplicates.add(collection_name, document_id, ids, sigs)
+            return len(points)
+
+        added = self._backfill_side_index(collection_name, self.near_duplicates,
+                                          self._near_duplicates_checked, _sign)
+        if added:
+            print(f"[RAG] Firme dei quasi-duplicati calcolate per {collection_name}: {added} chunks")
+
+    def _ensure_topic_clusters(self, collection_name: str) -> None:
+        """Assegna ai cluster le collection indicizzate prima di RAG_TOPIC_CLUSTERS."""
+        def _assign(points: List[Any], _texts: None) -> int:
+            self.topic_clusters.add_points(
+                collection_name,
+                [str(p.id) for p in points],
+                [p.payload["document_id"] for p in points],
+                np.vstack([np.asarray(p.vector, dtype=np.float32) for p in points]),
+            )
+            return len(points)
+
+        added = self._backfill_side_index(collection_name, self.topic_clusters,
+                                          self._topic_clusters_checked, _assign, with_vectors=True)
+        if added:
+            print(f"[RAG] Cluster di argomenti costruiti per {collection_name}: {added} chunks")
+
+    def _label_topic_clusters(self, collection_name: str, sample_size: int = 8) -> None:
+        """Etichette lessicali dei cluster nuovi o cambiati, dai chunk più vicini al centroide."""
+        stale = self.topic_clusters.stale_clusters(collection_name)
+        if not stale:
+            return
+        physical_name, _ = self._target(collection_name)
+        members = {cid: self.topic_clusters.members(collection_name, cid, sample_size) for cid in stale}
+        points = self.client.retrieve(
+            collection_name=physical_name,
+            ids=[pid for ids in members.values() for pid in ids],
+            with_payload=True,
+            with_vectors=False,
+        )
+        payload_by_id = {str(p.id): p.payload or {} for p in points}
+        terms_by_cluster = {}
+        for cluster_id, ids in members.items():
+            payloads = [payload_by_id[pid] for pid in ids if pid in payload_by_id]
+            terms_by_cluster[cluster_id] = lexical_terms(self.text_resolver.resolve_many(payloads))
+        self.topic_clusters.set_terms(collection_name, terms_by_cluster)
+        print(f"[RAG] Etichettati {len(stale)} cluster di {collection_name}")
+
+    def get_topic_clusters(self, collection_name: str, num_topics: int,
+                           chunks_per_topic: int = None) -> List[Tuple[str, List[Dict[str, Any]]]]:
+        """[(etichetta, chunk formattati)] dei cluster più grandi, senza embedding né ricerca.
+
+        Lista vuota se i cluster non sono attivi o la collection non ne ha:
+        il chiamante ripiega sull'estrazione dei topic con l'LLM.
+        """
+        if self.topic_clusters is None:
+            return []
+        chunks_per_topic = chunks_per_topic or self.chunks_per_topic
+        try:
+            self._ensure_topic_clusters(collection_name)
+            self._label_topic_clusters(collection_name)
+
+            topics = []
+            seen_labels = set()
+            for cluster_id, label, _ in self.topic_clusters.topics(collection_name, num_topics * 2):
+                if label in seen_labels:
+                    continue
+                seen_labels.add(label)
+                topics.append((label, self.topic_clusters.members(collection_name, cluster_id,
+                                                                  chunks_per_topic)))
+                if len(topics) >= num_topics:
+                    break
+            if not topics:
+                return []
+
+            physical_name, _ = self._target(collection_name)
+            points = self.client.retrieve(
+                collection_name=physical_name,
+                ids=[pid for _, ids in topics for pid in ids],
+                with_payload=True,
+                with_vectors=False,
+            )
+        except Exception as e:
+            print(f"[RAG] Errore in get_topic_clusters: {e}")
+            return []
+
+        by_id = {str(p.id): p for p in points}
+        result = []
+        for label, ids in topics:
+            # Membri scelti per appartenenza al cluster, non per similarità a una query
+            members = [ScoredPoint(id=by_id[pid].id, version=0, score=1.0,
+                                   payload=by_id[pid].payload, vector=None)
+                       for pid in ids if pid in by_id]
+            result.append((label, self._format_results(members)))
+        return result
+
+    def _fuse_with_bm25(self, collection_name: str, queries: List[str],
+                        query_embeddings: np.ndarray, ok: np.ndarray,
+                        dense: List[List[Any]], n_results: int
+                        ) -> Tuple[List[List[Any]], List[Dict[str, float]]]:
+        """Fonde per ogni query i risultati densi con quelli BM25 (RRF).
+
+        Ritorna i punti nell'ordine fuso, che conservano il punteggio coseno,
+        e per ogni query i punteggi RRF per point_id.
+        """
+        physical_name, _ = self._target(collection_name)
+        self._ensure_bm25(collection_name)
+
+        fused_ids: List[List[Tuple[str, float]]] = []
+        points_by_id: Dict[str, Any] = {}
+        for query, results in zip(queries, dense):
+            for r in results:
+                points_by_id[str(r.id)] = r
+            lexical = self.bm25.search(collection_name, query, limit=n_results * 2)
+            fused = reciprocal_rank_fusion(
+                [[str(r.id) for r in results], [pid for pid, _ in lexical]], k=self.rrf_k
+            )
+            fused_ids.append(fused[:n_results])
+
+        # Payload dei chunk trovati solo da BM25: una sola retrieve per tutte le query
+        missing = list({pid for fused in fused_ids for pid, _ in fused if pid not in points_by_id})
+        # (con i vettori: serve il loro punteggio coseno rispetto alla query)
+        records: Dict[str, Any] = {}
+        if missing:
+            for record in self.client.retrieve(
+                collection_name=physical_name, ids=missing,
+                with_payload=True, with_vectors=True,
+            ):
+                records[str(record.id)] = record
 
+        output = []
+        for i, fused in enumerate(fused_ids):
+            points = []
+            for pid, _ in fused:
+                if pid in points_by_id:
+                    points.append(points_by_id[pid])
+                elif pid in records:
+                    record = records[pid]
+                    score = 0.0
+                    if ok[i] and record.vector is not None:
+                        vector = np.asarray(record.vector, dtype=np.float32)
+                        norm = float(np.linalg.norm(vector) * np.linalg.norm(query_embeddings[i]))
+                        score = float(vector @ query_embeddings[i]) / norm if norm else 0.0
+                    points.append(ScoredPoint(
+                        id=record.id, version=0, score=score, payload=record.payload,
+                        vector=record.vector if self.use_mmr else None,
+                    ))
+            output.append(points)
+        return output, [dict(fused) for fused in fused_ids]
+
+    def search_all_subjects(self, query: str, n_results: int = 10) -> List[Dict[str, Any]]:
+        """Ricerca densa su tutte le materie ("cerca in tutti i miei appunti").
+
+        Con il layout condiviso è una sola search senza filtro; con una
+        collection per materia interroga ogni collection e unisce per punteggio.
+        """
+        query_embedding, ok = self._embed_queries([query])
+        if not ok.any():
+            return []
+
+        self._load_collection_registry()
+        if self.collection_layout == "shared":
+            targets = [name for name in [self._shared_collection_name()] if name in self._collections]
+        else:
+            targets = [name for name in self._collections if self._subject_id(name) is not None]
+
+        results = []
+        for name in targets:
+            try:
+                hits = self.client.search(
+                    collection_name=name,
+                    query_vector=query_embedding[0],
+                    limit=n_results,
+                    score_threshold=self.score_threshold,
+                    with_payload=True,
+                    with_vectors=False,
+                    search_params=self._search_params(),
+                )
+            except Exception as e:
+                # Es. collection creata con un altro modello (dimensione diversa)
+                print(f"[RAG] Ricerca globale: salto {name} ({e})")
+                continue
+            for hit in hits:
+                if hit.payload is not None and "subject_id" not in hit.payload:
+                    hit.payload["subject_id"] = self._subject_id(name)
+            results.extend(hits)
+
+        results.sort(key=lambda r: r.score, reverse=True)
+        return self._format_results(results[:n_results])
+
+    def migrate_to_shared_layout(self, delete_old: bool = False, batch_size: int = 256) -> int:
+        """Copia le collection per materia nella collection condivisa del loro modello.
+
+        I vettori non vengono ricalcolati; gli ID dei punti restano gli stessi,
+        quindi anche l'indice BM25 resta valido. Ritorna i punti copiati.
+        """
+        self._load_collection_registry()
+        copied = 0
+        for name in sorted(self._collections):
+            subject_id = self._subject_id(name)
+            if subject_id is None:
+                continue
+            model = self.metadata.get("collections", name) or self._embedding_key()
+            shared_name = self._shared_collection_name(model)
+            dim = self._read_collection_dim(name)
+            if shared_name not in self._collections:
+                print(f"[RAG] Creazione collection condivisa {shared_name} (dim: {dim})")
+                self.client.create_collection(
+                    collection_name=shared_name,
+                    vectors_config=VectorParams(size=dim, distance=Distance.COSINE),
+                    quantization_config=self._quantization_config(),
+                )
+                self._create_payload_indexes(shared_name)
+                self.metadata.set("collections", shared_name, model)
+                self._register_collection(shared_name, dim)
+
+            moved = 0
+            for points in self._iter_points(name, with_vectors=True, batch_size=batch_size):
+                self.client.upsert(
+                    collection_name=shared_name,
+                    points=[
+                        PointStruct(id=p.id, vector=p.vector,
+                                    payload={**(p.payload or {}), "subject_id": subject_id})
+                        for p in points
+                    ],
+                )
+                moved += len(points)
+            self._touch_collection_physical(shared_name)
+            if self.result_cache is not None:
+                self.result_cache.clear()
+            copied += moved
+            print(f"[RAG] Migrata {name}: {moved} punti in {shared_name}")
+
+            if delete_old:
+                self.client.delete_collection(collection_name=name)
+                self._forget_collection(name)
+        return copied
+
+    def embedding_storage_report(self, collection_name: str, dims: List[int] = None,
+                                 k: int = 10, n_queries: int = 200,
+                                 max_points: int = 20000) -> List[Dict[str, float]]:
+        """Recall@k rispetto a spazio occupato per dimensioni ridotte e formati quantizzati.
+
+        Il troncamento ha senso solo se la collection contiene vettori a piena
+        dimensione di un modello Matryoshka (es. gemini-embedding-001).
+        """
+        physical_name, subject_filter = self._target(collection_name)
+        dims = dims or [256, 512, 768, 1536]
+        vectors: List[Any] = []
+        for points in self._iter_points(physical_name, subject_filter, with_payload=False,
+                                        with_vectors=True, max_points=max_points):
+            vectors.extend(p.vector for p in points if p.vector)
+
+        matrix = np.asarray(vectors, dtype=np.float32)
+        rows = recall_report(matrix, dims, k=k, n_queries=n_queries,
+                             oversampling=self.quantization_oversampling)
+        print(f"[RAG] Report {collection_name}: {matrix.shape[0]} vettori da {matrix.shape[1]} dimensioni")
+        print(format_report(rows, k=k))
+        return rows
 
     def delete_collection(self, subject_id: int, subject_name: str) -> None:
-        collection_name = self._collection_name(subject_id, subject_name)
+        collection_name = self.collection_name(subject_id, subject_name)
+        
+        physical_name, subject_filter = self._target(collection_name)
         
         try:
-            self.client.delete_collection(collection_name=collection_name)
+            if subject_filter is not None:
+                # Layout condiviso: si eliminano solo i punti della materia
+                if self.collection_exists(collection_name):
+                    self.client.delete(collection_name=physical_name, points_selector=subject_filter)
+                self._touch_collection(collection_name)
+            else:
+                self.client.delete_collection(collection_name=collection_name)
+            self._forget_collection(collection_name)
+            if self.bm25 is not None:
+                self.bm25.drop_collection(collection_name)
+            if self.topic_clusters is not None:
+                self.topic_clusters.drop_collection(collection_name)
+            if self.near_duplicates is not None:
+                self.near_duplicates.drop_collection(collection_name)
             print(f"[RAG] Collection eliminata: {collection_name}")
         except Exception as e:
             print(f"[RAG] Errore eliminazione collection {collection_name}: {e}")
@@ -632,8 +2100,19 @@ class RAGService:
     def close(cls):
         if cls._instance is not None and hasattr(cls._instance, 'client'):
             try:
+                if cls._instance.client is not None:
+                    # Rilascia il lock su ./qdrant_db o le connessioni verso il server
+                    cls._instance.client.close()
                 cls._instance.client = None
                 print("[RAG] Client Qdrant chiuso")
+                if getattr(cls._instance, "embedding_cache", None) is not None:
+                    cls._instance.embedding_cache.close()
+                if getattr(cls._instance, "bm25", None) is not None:
+                    cls._instance.bm25.close()
+                if getattr(cls._instance, "topic_clusters", None) is not None:
+                    cls._instance.topic_clusters.close()
+                if getattr(cls._instance, "near_duplicates", None) is not None:
+                    cls._instance.near_duplicates.close()
             except Exception as e:
                 print(f"[RAG] Errore durante chiusura client: {e}")
             finally:
@@ -0,0 +1,97 @@
+"""Limitatori di frequenza per le chiavi API (token bucket).
+
+Ogni chiave Gemini ha quote indipendenti di richieste e token al minuto:
+un limitatore per chiave permette di rallentare solo quella chiave mentre
+le altre continuano a lavorare.
+"""
+from __future__ import annotations
+
+import re
+import threading
+import time
+from typing import Optional
+
+
+_RETRY_DELAY_PATTERNS = (
+    re.compile(r"retry[_ ]?delay['\"]?\s*[:=]\s*['\"]?(\d+(?:\.\d+)?)s", re.IGNORECASE),
+    re.compile(r"retry (?:in|after) (\d+(?:\.\d+)?)\s*s", re.IGNORECASE),
+)
+
+
+def is_quota_error(error: Exception) -> bool:
+    msg = str(error)
+    return "429" in msg or "RESOURCE_EXHAUSTED" in msg or "quota" in msg.lower()
+
+
+def parse_retry_delay(error: Exception) -> Optional[float]:
+    """Estrae il ritardo suggerito dal server (es. "retryDelay": "23s"), se presente."""
+    msg = str(error)
+    for pattern in _RETRY_DELAY_PATTERNS:
+        match = pattern.search(msg)
+        if match:
+            return float(match.group(1))
+    return None
+
+
+class TokenBucket:
+    """Bucket con ricarica continua: `rate_per_minute` unità disponibili al minuto."""
+
+    def __init__(self, rate_per_minute: float, capacity: Optional[float] = None):
+        self.rate = max(rate_per_minute, 1e-6) / 60.0
+        self.capacity = capacity if capacity is not None else max(rate_per_minute, 1.0)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        elapsed = now - self._updated
+        if elapsed > 0:
+            self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+            self._updated = now
+
+    def try_acquire(self, amount: float = 1.0) -> float:
+        """Preleva `amount` unità; ritorna 0 se riuscito, altrimenti i secondi da attendere."""
+        amount = min(amount, self.capacity)
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if self._tokens >= amount:
+                self._tokens -= amount
+                return 0.0
+            return (amount - self._tokens) / self.rate
+
+    def acquire(self, amount: float = 1.0, timeout: Optional[float] = None) -> bool:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = self.try_acquire(amount)
+            if wait <= 0:
+                return True
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            time.sleep(min(wait, 1.0))
+
+    def drain(self) -> None:
+        """Svuota il bucket (usato quando il server segnala la quota esaurita)."""
+        with self._lock:
+            self._tokens = 0.0
+            self._updated = time.monotonic()
+
+
+class KeyRateLimiter:
+    """Quota RPM/TPM di una singola chiave.
+
+    Il cooldown dopo un 429 è gestito da `services.key_scheduler`, condiviso
+    con gli altri servizi che usano la stessa chiave.
+    """
+
+    def __init__(self, rpm: float, tpm: float):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+
+    def drain(self) -> None:
+        self.requests.drain()
+
+    def acquire(self, tokens: float) -> None:
+        """Blocca il chiamante finché la chiave può accettare una richiesta da `tokens` token."""
+        self.requests.acquire(1)
+        self.tokens.acquire(tokens)
@@ -0,0 +1,56 @@
+"""LRU in memoria dei risultati di retrieval.
+
+La chiave include la versione della collection: ogni indicizzazione,
+rimozione o eliminazione la incrementa, quindi le voci vecchie non vengono
+più trovate e si limitano a uscire dall'LRU. Nessuna invalidazione esplicita.
+"""
+from __future__ import annotations
+
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional
+
+
+class SearchResultCache:
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max(1, max_entries)
+        self._entries: "OrderedDict[Hashable, List[Dict[str, Any]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _copy(results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        # Il chiamante può modificare i dict: in cache resta l'originale
+        return [{**r, "metadata": dict(r.get("metadata") or {})} for r in results]
+
+    def get(self, key: Hashable) -> Optional[List[Dict[str, Any]]]:
+        with self._lock:
+            results = self._entries.get(key)
+            if results is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._copy(results)
+
+    def put(self, key: Hashable, results: List[Dict[str, Any]]) -> None:
+        with self._lock:
+            self._entries[key] = self._copy(results)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits / lookups) if lookups else 0.0,
+                "entries": len(self._entries),
+            }
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
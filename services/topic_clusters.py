@@ -0,0 +1,296 @@
+"""Cluster di argomenti per collection, calcolati in indicizzazione.
+
+Ogni chunk nuovo viene assegnato al cluster col centroide più simile
+(clustering "leader" incrementale): se nessun centroide supera la soglia
+e c'è ancora spazio si apre un nuovo cluster. I centroidi sono salvati come
+somma dei vettori dei membri, così aggiunte e rimozioni li aggiornano in
+modo esatto senza ricalcolare nulla. L'etichetta lessicale di un cluster
+si ricava una volta dai chunk più centrali e resta in cache finché il
+cluster non cambia sensibilmente dimensione.
+"""
+from __future__ import annotations
+
+import json
+import math
+import sqlite3
+import threading
+from collections import Counter
+from pathlib import Path
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+
+from services.bm25_index import tokenize
+
+# Termini salvati per cluster (servono anche a calcolare l'idf fra cluster)
+_MAX_TERMS = 40
+
+
+def lexical_terms(texts: Sequence[str]) -> Counter:
+    """Frequenze dei termini utili per un'etichetta: niente numeri né token corti."""
+    counts: Counter = Counter()
+    for text in texts:
+        counts.update(t for t in tokenize(text) if len(t) > 2 and not t.replace(".", "").isdigit())
+    return Counter(dict(counts.most_common(_MAX_TERMS)))
+
+
+class TopicClusterIndex:
+    def __init__(self, db_path: str, threshold: float = 0.6, max_clusters: int = 32,
+                 label_terms: int = 3):
+        self.db_path = db_path
+        self.threshold = threshold
+        self.max_clusters = max_clusters
+        self.label_terms = label_terms
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS clusters (
+                collection TEXT NOT NULL,
+                cluster_id INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                centroid BLOB NOT NULL,
+                label TEXT,
+                terms TEXT,
+                labeled_size INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (collection, cluster_id)
+            )
+        ''')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS members (
+                collection TEXT NOT NULL,
+                point_id TEXT NOT NULL,
+                document_id INTEGER NOT NULL,
+                cluster_id INTEGER NOT NULL,
+                similarity REAL NOT NULL,
+                PRIMARY KEY (collection, point_id)
+            )
+        ''')
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_members_document ON members (collection, document_id)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_members_cluster ON members (collection, cluster_id, similarity)"
+        )
+        self._conn.commit()
+
+        # collection -> (cluster_id, somme dei vettori, dimensioni), caricato alla prima scrittura
+        self._centroids: Dict[str, Tuple[List[int], np.ndarray, np.ndarray]] = {}
+
+    @staticmethod
+    def _normalize(vectors: np.ndarray) -> np.ndarray:
+        matrix = np.asarray(vectors, dtype=np.float32)
+        return matrix / np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+
+    def _load(self, collection: str, dim: int) -> Tuple[List[int], np.ndarray, np.ndarray]:
+        cached = self._centroids.get(collection)
+        if cached is not None and cached[1].shape[1] == dim:
+            return cached
+        rows = self._conn.execute(
+            "SELECT cluster_id, size, centroid FROM clusters WHERE collection = ? ORDER BY cluster_id",
+            (collection,),
+        ).fetchall()
+        rows = [r for r in rows if len(r[2]) == dim * 4]
+        ids = [int(r[0]) for r in rows]
+        sums = (np.vstack([np.frombuffer(r[2], dtype=np.float32) for r in rows])
+                if rows else np.zeros((0, dim), dtype=np.float32))
+        sizes = np.asarray([int(r[1]) for r in rows], dtype=np.int64)
+        cached = (ids, sums.copy(), sizes)
+        self._centroids[collection] = cached
+        return cached
+
+    def _save_clusters(self, collection: str, changed: Sequence[int]) -> None:
+        ids, sums, sizes = self._centroids[collection]
+        for row in sorted(set(changed)):
+            if sizes[row] <= 0:
+                self._conn.execute(
+                    "DELETE FROM clusters WHERE collection = ? AND cluster_id = ?",
+                    (collection, ids[row]),
+                )
+                continue
+            updated = self._conn.execute(
+                "UPDATE clusters SET size = ?, centroid = ? WHERE collection = ? AND cluster_id = ?",
+                (int(sizes[row]), sums[row].astype(np.float32).tobytes(), collection, ids[row]),
+            ).rowcount
+            if not updated:
+                self._conn.execute(
+                    "INSERT INTO clusters (collection, cluster_id, size, centroid) VALUES (?, ?, ?, ?)",
+                    (collection, ids[row], int(sizes[row]), sums[row].astype(np.float32).tobytes()),
+                )
+        # I cluster vuoti spariscono anche dalla cache in memoria
+        keep = [row for row in range(len(ids)) if sizes[row] > 0]
+        if len(keep) != len(ids):
+            self._centroids[collection] = ([ids[row] for row in keep], sums[keep], sizes[keep])
+
+    def add_points(self, collection: str, point_ids: Sequence[str],
+                   document_ids: Sequence[int], vectors: np.ndarray) -> None:
+        """Assegna i nuovi chunk ai cluster, aprendone di nuovi se serve."""
+        if len(point_ids) == 0:
+            return
+        matrix = self._normalize(vectors)
+        with self._lock:
+            ids, sums, sizes = self._load(collection, matrix.shape[1])
+            sums = np.vstack([sums, np.zeros((len(matrix), matrix.shape[1]), dtype=np.float32)])
+            sizes = np.concatenate([sizes, np.zeros(len(matrix), dtype=np.int64)])
+            n_clusters = len(ids)
+            next_id = max(ids, default=-1) + 1
+            changed: List[int] = []
+            member_rows = []
+
+            for point_id, document_id, vector in zip(point_ids, document_ids, matrix):
+                best, similarity = -1, -1.0
+                if n_clusters:
+                    centroids = self._normalize(sums[:n_clusters])
+                    scores = centroids @ vector
+                    best = int(np.argmax(scores))
+                    similarity = float(scores[best])
+                if best < 0 or (similarity < self.threshold and n_clusters < self.max_clusters):
+                    best = n_clusters
+                    n_clusters += 1
+                    ids.append(next_id)
+                    next_id += 1
+                    similarity = 1.0
+                sums[best] += vector
+                sizes[best] += 1
+                changed.append(best)
+                member_rows.append((collection, str(point_id), int(document_id), ids[best], similarity))
+
+            self._centroids[collection] = (ids, sums[:n_clusters], sizes[:n_clusters])
+            self._save_clusters(collection, changed)
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO members (collection, point_id, document_id, cluster_id, similarity) "
+                "VALUES (?, ?, ?, ?, ?)",
+                member_rows,
+            )
+            self._conn.commit()
+
+    def remove_points(self, collection: str, point_ids: Sequence[str], vectors: np.ndarray) -> None:
+        """Toglie i chunk dai cluster, sottraendo i loro vettori dai centroidi."""
+        if len(point_ids) == 0:
+            return
+        matrix = self._normalize(vectors)
+        with self._lock:
+            ids, sums, sizes = self._load(collection, matrix.shape[1])
+            row_of = {cluster_id: row for row, cluster_id in enumerate(ids)}
+            membership = dict(self._select_members(collection, point_ids))
+            changed = []
+            for point_id, vector in zip(point_ids, matrix):
+                row = row_of.get(membership.get(str(point_id)))
+                if row is None:
+                    continue
+                sums[row] -= vector
+                sizes[row] -= 1
+                changed.append(row)
+            self._save_clusters(collection, changed)
+            self._delete_members(collection, point_ids)
+            self._conn.commit()
+
+    def _select_members(self, collection: str, point_ids: Sequence[str]) -> List[Tuple[str, int]]:
+        rows: List[Tuple[str, int]] = []
+        for i in range(0, len(point_ids), 500):
+            part = [str(pid) for pid in point_ids[i:i + 500]]
+            rows.extend(self._conn.execute(
+                f"SELECT point_id, cluster_id FROM members WHERE collection = ? "
+                f"AND point_id IN ({','.join('?' * len(part))})",
+                (collection, *part),
+            ).fetchall())
+        return rows
+
+    def _delete_members(self, collection: str, point_ids: Sequence[str]) -> None:
+        for i in range(0, len(point_ids), 500):
+            part = [str(pid) for pid in point_ids[i:i + 500]]
+            self._conn.execute(
+                f"DELETE FROM members WHERE collection = ? AND point_id IN ({','.join('?' * len(part))})",
+                (collection, *part),
+            )
+
+    def document_points(self, collection: str, document_id: int) -> List[str]:
+        with self._lock:
+            return [row[0] for row in self._conn.execute(
+                "SELECT point_id FROM members WHERE collection = ? AND document_id = ?",
+                (collection, document_id),
+            )]
+
+    def drop_collection(self, collection: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM members WHERE collection = ?", (collection,))
+            self._conn.execute("DELETE FROM clusters WHERE collection = ?", (collection,))
+            self._conn.commit()
+            self._centroids.pop(collection, None)
+
+    def collections(self) -> List[str]:
+        with self._lock:
+            return [row[0] for row in self._conn.execute("SELECT DISTINCT collection FROM members")]
+
+    def size(self, collection: str) -> int:
+        """Numero di chunk assegnati a un cluster nella collection."""
+        with self._lock:
+            return int(self._conn.execute(
+                "SELECT COUNT(*) FROM members WHERE collection = ?", (collection,)
+            ).fetchone()[0])
+
+    def stale_clusters(self, collection: str) -> List[int]:
+        """Cluster senza etichetta o cresciuti/calati di oltre la metà dall'ultima etichettatura."""
+        with self._lock:
+            return [int(row[0]) for row in self._conn.execute(
+                "SELECT cluster_id FROM clusters WHERE collection = ? AND "
+                "(label IS NULL OR size >= 2 * labeled_size OR 2 * size <= labeled_size)",
+                (collection,),
+            )]
+
+    def members(self, collection: str, cluster_id: int, limit: int) -> List[str]:
+        """point_id del cluster, dal più vicino al centroide."""
+        with self._lock:
+            return [row[0] for row in self._conn.execute(
+                "SELECT point_id FROM members WHERE collection = ? AND cluster_id = ? "
+                "ORDER BY similarity DESC LIMIT ?",
+                (collection, cluster_id, limit),
+            )]
+
+    def set_terms(self, collection: str, terms_by_cluster: Dict[int, Counter]) -> None:
+        """Salva i termini dei cluster rietichettati e ricalcola le etichette con l'idf fra cluster."""
+        with self._lock:
+            for cluster_id, terms in terms_by_cluster.items():
+                self._conn.execute(
+                    "UPDATE clusters SET terms = ?, labeled_size = size WHERE collection = ? AND cluster_id = ?",
+                    (json.dumps(dict(terms)), collection, cluster_id),
+                )
+            rows = self._conn.execute(
+                "SELECT cluster_id, terms FROM clusters WHERE collection = ? AND terms IS NOT NULL",
+                (collection,),
+            ).fetchall()
+            all_terms = {int(cid): json.loads(raw) for cid, raw in rows}
+            document_frequency = Counter(t for terms in all_terms.values() for t in terms)
+            n = len(all_terms)
+            for cluster_id in terms_by_cluster:
+                terms = all_terms.get(cluster_id) or {}
+                ranked = sorted(
+                    terms,
+                    key=lambda t: terms[t] * math.log(1.0 + n / document_frequency[t]),
+                    reverse=True,
+                )
+                label = " ".join(ranked[:self.label_terms]) or None
+                self._conn.execute(
+                    "UPDATE clusters SET label = ? WHERE collection = ? AND cluster_id = ?",
+                    (label, collection, cluster_id),
+                )
+            self._conn.commit()
+
+    def topics(self, collection: str, limit: int) -> List[Tuple[int, str, int]]:
+        """[(cluster_id, etichetta, dimensione)] dei cluster etichettati più grandi."""
+        with self._lock:
+            return [(int(cid), label, int(size)) for cid, label, size in self._conn.execute(
+                "SELECT cluster_id, label, size FROM clusters WHERE collection = ? AND label IS NOT NULL "
+                "ORDER BY size DESC, cluster_id LIMIT ?",
+                (collection, limit),
+            )]
+
+    def close(self) -> None:
+        with self._lock:
+            try:
+                self._conn.close()
+            except Exception:
+                pass
@@ -0,0 +1,70 @@
+"""Creazione del client del vector store usato da RAGService.
+
+Di default Qdrant gira embedded su ./qdrant_db (un solo processo alla volta,
+per via del lock sulla cartella). Con QDRANT_URL impostato ci si collega
+invece a un server Qdrant, con la stessa API: l'indice può essere condiviso
+fra più processi Synapse e con i tool da riga di comando. Con
+RAG_VECTOR_STORE=flat si usa invece FlatVectorStore (file NumPy in mmap),
+che espone lo stesso sottoinsieme di API.
+"""
+from __future__ import annotations
+
+import os
+from pathlib import Path
+
+import httpx
+from qdrant_client import QdrantClient
+
+from config.env_loader import get_env_bool
+from services.flat_vector_store import FlatVectorStore
+
+
+def qdrant_server_url() -> str | None:
+    return os.getenv("QDRANT_URL", "").strip() or None
+
+
+def create_qdrant_client(persist_directory: str = "./qdrant_db",
+                         url: str = None, api_key: str = None) -> QdrantClient:
+    """Client server se è configurato un URL, altrimenti embedded su `persist_directory`.
+
+    Variabili per la modalità server: QDRANT_URL, QDRANT_API_KEY,
+    QDRANT_PREFER_GRPC, QDRANT_GRPC_PORT, QDRANT_TIMEOUT (secondi) e
+    QDRANT_POOL_SIZE (connessioni HTTP keep-alive riutilizzate).
+    """
+    url = url or qdrant_server_url()
+    if not url:
+        Path(persist_directory).mkdir(parents=True, exist_ok=True)
+        return QdrantClient(path=persist_directory)
+
+    api_key = api_key or os.getenv("QDRANT_API_KEY") or None
+    prefer_grpc = get_env_bool("QDRANT_PREFER_GRPC", default=False)
+    grpc_port = int(os.getenv("QDRANT_GRPC_PORT", "6334"))
+    timeout = int(os.getenv("QDRANT_TIMEOUT", "30"))
+    pool_size = max(1, int(os.getenv("QDRANT_POOL_SIZE", "8")))
+
+    print(f"[RAG] Qdrant server: {url} ({'gRPC' if prefer_grpc else 'REST'}, "
+          f"pool {pool_size}, timeout {timeout}s)")
+    return QdrantClient(
+        url=url,
+        api_key=api_key,
+        prefer_grpc=prefer_grpc,
+        grpc_port=grpc_port,
+        timeout=timeout,
+        # Connessioni persistenti: niente handshake TCP/TLS a ogni search/upsert
+        limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+    )
+
+
+def create_vector_store(persist_directory: str = "./qdrant_db"):
+    """Backend scelto con RAG_VECTOR_STORE: qdrant (default) | flat."""
+    backend = os.getenv("RAG_VECTOR_STORE", "qdrant").strip().lower()
+    if backend == "flat":
+        flat_directory = os.getenv(
+            "RAG_FLAT_STORE_DIR",
+            str(Path(persist_directory).resolve().parent / "flat_vectors"),
+        )
+        print(f"[RAG] Vector store piatto (NumPy mmap): {flat_directory}")
+        return FlatVectorStore(flat_directory)
+    if backend != "qdrant":
+        print(f"[RAG] RAG_VECTOR_STORE '{backend}' non valido: uso 'qdrant'")
+    return create_qdrant_client(persist_directory)
@@ -36,6 +36,7 @@ from ui.subject_styles import (get_caption_label_style,
 class DocumentUploadThread(QThread):
     """Thread per caricare e indicizzare documenti in background"""
     finished = pyqtSignal(bool, str)  # (success, message)
+    progress = pyqtSignal(int, int)   # (chunk indicizzati, chunk totali)
     
     def __init__(self, file_path, subject_id, subject_name, file_service, db, rag_service):
         super().__init__()
@@ -67,7 +68,8 @@ class DocumentUploadThread(QThread):
                         collection_name,
                         doc['id'],
                         doc['name'],
-                        doc['content']
+                        doc['content'],
+                        progress_callback=self.progress.emit
                     )
             except Exception as e:
                 print(f"RAG indexing error: {e}")
@@ -181,14 +183,11 @@ class GenerationThread(QThread):
             # Step 2: Index ONLY documents not yet present in Qdrant
             self.progress.emit(10, "Checking document indexing...")
             print("[DEBUG] 3. Checking/indexing RAG...")
+            indexed_ids = self.rag_service.get_indexed_document_ids(collection_name)
             for i, doc in enumerate(self.documents):
                 if not doc.get('content'):
                     continue
-                try:
-                    already = self.rag_service.is_document_indexed(collection_name, doc['id'])
-                except Exception:
-                    already = False
-                if already:
+                if doc['id'] in indexed_ids:
                     progress_pct = 10 + (i + 1) * 5 // max(1, len(self.documents))
                     self.progress.emit(progress_pct, f"Already indexed: {doc['name']}")
                     continue
@@ -204,45 +203,75 @@ class GenerationThread(QThread):
             print("[DEBUG] 3. RAG checking/indexing completed.")
 
             
-            # Step 3: ALWAYS use chunks saved in Qdrant for topic analysis
-            print("[DEBUG] 4. Reading chunks from collection...")
-            self.progress.emit(25, "Retrieving indexed content...")
-            all_chunks = self.rag_service.get_all_chunks_texts(collection_name)
-            if not all_chunks:
-                # Fallback (non dovrebbe succedere): ricava dai documenti in memoria
-                print("[DEBUG] Nessun chunk trovato in Qdrant: fallback a chunking in memoria")
-                for doc in self.documents:
-                    if doc.get('content'):
-                        all_chunks.extend(self.rag_service.chunk_text(doc['content']))
+            # Topic e chunk dai cluster calcolati in indicizzazione (RAG_TOPIC_CLUSTERS):
+            # niente chiamata LLM per i topic né ricerca vettoriale per topic
+            clustered = []
+            if not (self.user_query and self.user_query.strip()):
+                clustered = self.rag_service.get_topic_clusters(collection_name, self.num_cards)
+
+            if clustered:
+                print(f"[DEBUG] 4. Using {len(clustered)} topic clusters from the index")
+                topics = [label for label, _ in clustered]
+                chunks_by_topic = [chunks for _, chunks in clustered]
+                self.progress.emit(35, f"Identified {len(topics)} topics")
+            else:
+                # Step 3: ALWAYS use chunks saved in Qdrant for topic analysis
+                # (campione rappresentativo dell'intero corpus, non tutti i chunk)
+                print("[DEBUG] 4. Sampling representative chunks from collection...")
+                self.progress.emit(25, "Retrieving indexed content...")
+                all_chunks = self.rag_service.sample_representative_chunks(collection_name)
+                if not all_chunks:
+                    # Fallback (non dovrebbe succedere): ricava dai documenti in memoria
+                    print("[DEBUG] Nessun chunk trovato in Qdrant: fallback a chunking in memoria")
+                    for doc in self.documents:
+                        if doc.get('content'):
+                            all_chunks.extend(self.rag_service.chunk_text_recursive(doc['content']))
             
-            # Step 4: Extract main topics
-            print("[DEBUG] 5. Extracting topics...")
+                # Step 4: Extract main topics
+                print("[DEBUG] 5. Extracting topics...")
             
-            # If user provided a query, use it to focus topics
-            if self.user_query and self.user_query.strip():
-                user_q = self.user_query.strip()
-                self.progress.emit(30, f"Searching content for: {user_q}")
-                print(f"[DEBUG] Using user query: {user_q}")
+                # If user provided a query, use it to focus topics
+                if self.user_query and self.user_query.strip():
+                    user_q = self.user_query.strip()
+                    self.progress.emit(30, f"Searching content for: {user_q}")
+                    print(f"[DEBUG] Using user query: {user_q}")
 
-                # IMPORTANT: If user asks a specific question, 
-                # topics must be extracted FROM THE QUESTION, not from documents!
-                # Documents only serve as context to answer.
+                    # IMPORTANT: If user asks a specific question, 
+                    # topics must be extracted FROM THE QUESTION, not from documents!
+                    # Documents only serve as context to answer.
                 
-                print(f"[DEBUG] Extracting topics FROM USER QUERY (not from documents)")
-                topics = self.reflection_service.extract_topics([user_q], self.num_cards)
-                if not topics:
-                    topics = [user_q]
-                self.progress.emit(35, f"Identified {len(topics)} topics from user query")
-            else:
-                # Otherwise extract topics automatically
-                topics = self.reflection_service.extract_topics(all_chunks, self.num_cards)
-                self.progress.emit(35, f"Identified {len(topics)} topics")
+                    print(f"[DEBUG] Extracting topics FROM USER QUERY (not from documents)")
+                    topics = self.reflection_service.extract_topics([user_q], self.num_cards)
+                    if not topics:
+                        topics = [user_q]
+                    self.progress.emit(35, f"Identified {len(topics)} topics from user query")
+                else:
+                    # Otherwise extract topics automatically
+                    topics = self.reflection_service.extract_topics(all_chunks, self.num_cards)
+                    self.progress.emit(35, f"Identified {len(topics)} topics")
 
-            # Limita i topic al numero richiesto
-            topics = topics[:self.num_cards]
+                # Limita i topic al numero richiesto
+                topics = topics[:self.num_cards]
+            
+                # Step 5: Retrieve chunks for all topics at once (one embedding call + one batch search)
+                print("[DEBUG] 6. Retrieving chunks for all topics...")
+                if self.user_query and self.user_query.strip():
+                    search_queries = [
+                        f"{topic} (in the context of: {self.user_query.strip()})" for topic in topics
+                    ]
+                    print(f"[RAG-DEBUG] Searching chunks for {len(topics)} topics in user query context")
+                else:
+                    search_queries = list(topics)
+                    print(f"[RAG-DEBUG] Searching chunks for {len(topics)} topics")
+            
+                chunks_by_topic = self.rag_service.search_relevant_chunks_batch(
+                    collection_name,
+                    search_queries,
+                    n_results=self.rag_service.chunks_per_topic
+                )
             
-            # Step 5: For each topic, generate flashcard with RAG + Reflection
-            print("[DEBUG] 6. Starting generation per topic...")
+            # Step 6: For each topic, generate flashcard with RAG + Reflection
+            print("[DEBUG] 7. Starting generation per topic...")
             topics_with_no_chunks = 0 
             
             for i, topic in enumerate(topics):
@@ -251,18 +280,7 @@ class GenerationThread(QThread):
                     
                     self.progress.emit(base_progress, f"Analyzing: {topic}")
                     
-                    if self.user_query and self.user_query.strip():
-                        search_query = f"{topic} (in the context of: {self.user_query.strip()})"
-                        print(f"[RAG-DEBUG] Searching chunks for topic '{topic}' in user query context")
-                    else:
-                        search_query = topic
-                        print(f"[RAG-DEBUG] Searching chunks for topic: '{topic}'")
-                    
-                    relevant_chunks = self.rag_service.search_relevant_chunks(
-                        collection_name, 
-                        search_query, 
-                        n_results=self.rag_service.chunks_per_topic
-                    )
+                    relevant_chunks = chunks_by_topic[i]
                     
                     print(f"[RAG-DEBUG] Trovati {len(relevant_chunks)} chunks rilevanti per '{topic}'")
                     
@@ -341,7 +359,7 @@ class GenerationThread(QThread):
                     )
                     return []
             
-            print("[DEBUG] 7. _generate_with_rag generation completed.")
+            print("[DEBUG] 8. _generate_with_rag generation completed.")
             self.progress.emit(100, "Generation completed!")
             return flashcards
 
@@ -1089,6 +1107,12 @@ class SubjectWindow(QMainWindow):
                 except ValueError:
                     pass
 
+        def on_progress(done, total):
+            loading.setRange(0, total)
+            loading.setValue(done)
+            loading.setLabelText(f"Indexing... {done}/{total} chunks")
+
+        upload_thread.progress.connect(on_progress)
         upload_thread.finished.connect(on_finished)
 
         # Conserva un riferimento per evitare GC anticipata quando carichiamo più file
@@ -1143,11 +1167,12 @@ class SubjectWindow(QMainWindow):
         if reply == QMessageBox.StandardButton.Yes:
             # Rimuovi dal vector database prima di eliminare dal DB
             try:
-                collection_name = self.rag_service.create_collection(
+                collection_name = self.rag_service.collection_name(
                     self.subject_data['id'],
                     self.subject_data['name']
                 )
-                self.rag_service.remove_document(collection_name, doc_id)
+                if self.rag_service.collection_exists(collection_name):
+                    self.rag_service.remove_document(collection_name, doc_id)
             except Exception as e:
                 print(f"Error removing from RAG: {e}")
                 # Continue anyway with DB deletion